@@ -0,0 +1,344 @@
+import os
+import tempfile
+import threading
+import numpy as np
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Variables
+# ----------------------------------------------------------------------------------------------------------------------
+ENCODING_SIZE = 128         # Size of a face encoding
+N_SUBVECTORS = 16           # Number of sub-vectors of an encoding, each quantized with its own codebook
+N_CODES = 256               # Number of codewords of each codebook, so that a code fits in a byte
+N_PROBE = 16                # Number of coarse lists searched for each probe
+SHORTLIST = 64              # Minimum number of candidates returned for the exact re-ranking
+TRAIN_SAMPLE = 20000        # Maximum number of encodings used to train the quantizers
+TRAIN_ITERATIONS = 12       # Number of k-means iterations
+INITIAL_CAPACITY = 16       # Initial number of members allocated for each coarse list
+GROWTH_FACTOR = 2           # Factor used to grow a coarse list when it is full
+SEED = 0                    # Seed of the k-means initialization, so that the same gallery gives the same index
+
+
+# Class that indexes the face encodings for approximate nearest-neighbour search (IVF-PQ)
+#
+# The encodings are split into coarse lists, one for each k-means centroid; inside a list, the residual of each
+# encoding from its centroid is product-quantized into N_SUBVECTORS bytes. A query visits only the nearest lists and
+# estimates the distances from lookup tables, so its cost grows with the size of a few lists instead of the whole
+# gallery. The index only returns a shortlist of candidates: their exact distances are computed by the FaceGallery.
+class AnnIndex:
+    # Fields and methods of the class
+    __n_lists = 0           # Number of coarse lists
+    __n_probe = N_PROBE     # Number of coarse lists searched for each probe
+    __centroids = None      # Coarse centroids (n_lists x ENCODING_SIZE, float32)
+    __centroid_norms = None     # Squared norm of each coarse centroid
+    __codebooks = None      # Codebooks of the residuals (N_SUBVECTORS x codewords x sub-vector size, float32)
+    __codebook_norms = None     # Squared norm of each codeword (N_SUBVECTORS x codewords)
+    __codebook_columns = None   # Codebooks with the codewords as columns, for the lookup tables
+    __members = []          # Gallery indices of the encodings of each coarse list (growable int64 arrays)
+    __codes = []            # Codes of the encodings of each coarse list (growable uint8 arrays)
+    __sizes = None          # Number of encodings in each coarse list
+    __count = 0             # Number of encodings indexed
+    __store_id = None       # ID of the gallery store the index has been saved for, None if unknown
+    __write_lock = None     # Lock held while encodings are being added
+
+    # Builder method
+    def __init__(self, n_lists, n_probe=N_PROBE):
+        """
+        :param n_lists: number of coarse lists, e.g. 4 * sqrt(number of encodings).
+        :param n_probe: number of coarse lists searched for each probe; more lists give better recall and slower
+                        queries.
+        """
+        self.__n_lists = n_lists
+        self.__n_probe = n_probe
+        self.__centroids = None
+        self.__centroid_norms = None
+        self.__codebooks = None
+        self.__codebook_norms = None
+        self.__codebook_columns = None
+        self.__members = []
+        self.__codes = []
+        self.__sizes = np.zeros(n_lists, dtype=np.int64)
+        self.__count = 0
+        self.__store_id = None
+        self.__write_lock = threading.Lock()
+
+    def __len__(self):
+        return self.__count
+
+    @property
+    def is_trained(self):
+        """
+        :return: True once the quantizers have been trained, so that encodings can be added.
+        """
+        return self.__centroids is not None
+
+    @property
+    def store_id(self):
+        """
+        :return: the ID of the gallery store the index has been saved for, None if unknown.
+        """
+        return self.__store_id
+
+    @property
+    def n_probe(self):
+        return self.__n_probe
+
+    @n_probe.setter
+    def n_probe(self, value):
+        self.__n_probe = value
+
+    def train(self, encodings, iterations=TRAIN_ITERATIONS, sample=TRAIN_SAMPLE):
+        """
+        Trains the coarse quantizer and the codebooks of the residuals on a sample of the encodings.
+
+        :param encodings: (n x ENCODING_SIZE) array of face encodings, with n >= number of coarse lists.
+        :param iterations: number of k-means iterations.
+        :param sample: maximum number of encodings used for the training.
+        """
+        rows = np.asarray(encodings, dtype=np.float32).reshape(-1, ENCODING_SIZE)
+        if len(rows) < self.__n_lists:
+            raise ValueError(f"At least {self.__n_lists} encodings are needed to train the index")
+        random = np.random.default_rng(SEED)
+        if len(rows) > sample:
+            rows = rows[random.choice(len(rows), sample, replace=False)]
+
+        # Coarse quantizer, then one codebook for each sub-vector of the residuals
+        centroids = self.__kmeans(rows, self.__n_lists, iterations, random)
+        residuals = rows - centroids[self.__assign(rows, centroids)]
+        subvectors = residuals.reshape(len(rows), N_SUBVECTORS, -1)
+        n_codes = min(N_CODES, len(rows))   # Small galleries get smaller codebooks
+        codebooks = np.stack([self.__kmeans(np.ascontiguousarray(subvectors[:, m]), n_codes, iterations, random)
+                              for m in range(N_SUBVECTORS)])
+
+        with self.__write_lock:
+            self.__centroids = centroids
+            self.__centroid_norms = np.einsum("ij,ij->i", centroids, centroids)
+            self.__codebooks = codebooks
+            self.__codebook_norms = np.einsum("mkd,mkd->mk", codebooks, codebooks)
+            self.__codebook_columns = np.ascontiguousarray(codebooks.transpose(0, 2, 1))
+            self.__members = [np.empty(INITIAL_CAPACITY, dtype=np.int64) for _ in range(self.__n_lists)]
+            self.__codes = [np.empty((INITIAL_CAPACITY, N_SUBVECTORS), dtype=np.uint8) for _ in range(self.__n_lists)]
+            self.__sizes = np.zeros(self.__n_lists, dtype=np.int64)
+            self.__count = 0
+
+    def add(self, encodings, start):
+        """
+        Adds encodings to the index, without retraining it.
+
+        :param encodings: a face encoding, or a (n x ENCODING_SIZE) array of face encodings.
+        :param start: gallery index of the first encoding; the others follow in order.
+        """
+        if not self.is_trained:
+            raise RuntimeError("The index must be trained before adding encodings")
+        rows = np.asarray(encodings, dtype=np.float32).reshape(-1, ENCODING_SIZE)
+        lists = self.__assign(rows, self.__centroids)
+        codes = self.__encode(rows - self.__centroids[lists])
+
+        # Group the encodings by coarse list with a single sort
+        order = np.argsort(lists, kind="stable")
+        list_ids, firsts, counts = np.unique(lists[order], return_index=True, return_counts=True)
+
+        with self.__write_lock:
+            for list_id, first, count in zip(list_ids, firsts, counts):
+                selected = order[first:first + count]
+                size = int(self.__sizes[list_id])
+                self.__reserve(list_id, size + len(selected))
+                self.__members[list_id][size:size + len(selected)] = start + selected
+                self.__codes[list_id][size:size + len(selected)] = codes[selected]
+                # The new members become visible to the queries only once they are completely written
+                self.__sizes[list_id] = size + len(selected)
+            self.__count += len(rows)
+
+    def search(self, probes, shortlist=SHORTLIST):
+        """
+        Finds, for each probe face, the candidates nearest to it according to the quantized distances.
+
+        :param probes: a face encoding, or a (n_probes x ENCODING_SIZE) array of face encodings.
+        :param shortlist: maximum number of candidates returned for each probe.
+        :return: a list with, for each probe, the array of the gallery indices of its candidates.
+        """
+        probes = np.asarray(probes, dtype=np.float32).reshape(-1, ENCODING_SIZE)
+        if not self.is_trained or self.__count == 0:
+            return [np.empty(0, dtype=np.int64) for _ in probes]
+
+        # Nearest coarse lists of each probe
+        centroids = self.__centroids
+        n_probe = min(self.__n_probe, self.__n_lists)
+        coarse = self.__centroid_norms - 2 * (probes @ centroids.T)   # |p|^2 is the same for all the lists
+        probed_lists = np.argpartition(coarse, n_probe - 1, axis=1)[:, :n_probe]
+
+        candidates = []
+        for probe, lists in zip(probes, probed_lists):
+            # Read the sizes first, so a concurrent add() never exposes a partially written member
+            sizes = self.__sizes[lists].copy()
+            members = [self.__members[list_id] for list_id in lists]
+            codes = [self.__codes[list_id] for list_id in lists]
+            if sizes.sum() == 0:
+                candidates.append(np.empty(0, dtype=np.int64))
+                continue
+
+            # Lookup table of the squared distances between each sub-vector of the residuals and each codeword,
+            # one table for each probed list: |r - c|^2 = |r|^2 + |c|^2 - 2 r.c
+            residuals = (probe - centroids[lists]).reshape(n_probe, N_SUBVECTORS, -1).transpose(1, 0, 2)
+            tables = residuals @ self.__codebook_columns    # (N_SUBVECTORS x n_probe x codewords)
+            tables *= -2
+            tables += self.__codebook_norms[:, np.newaxis, :]
+            tables += np.square(residuals).sum(axis=2)[:, :, np.newaxis]
+
+            # Quantized distance of every member of the probed lists, summing one table entry for each sub-vector
+            member_ids = np.concatenate([members[i][:size] for i, size in enumerate(sizes)])
+            member_codes = np.concatenate([codes[i][:size] for i, size in enumerate(sizes)])
+            table_ids = np.repeat(np.arange(n_probe), sizes)
+            distances = tables[np.arange(N_SUBVECTORS), table_ids[:, np.newaxis], member_codes].sum(axis=1)
+
+            if len(distances) > shortlist:
+                selected = np.argpartition(distances, shortlist - 1)[:shortlist]
+                member_ids = member_ids[selected]
+            candidates.append(member_ids)
+        return candidates
+
+    def save(self, path, store_id=None):
+        """
+        Writes the index in a file, replacing it atomically.
+
+        :param path: path of the index file (.npz).
+        :param store_id: ID of the gallery store whose encodings are indexed, so that the index is not reused for
+                         another store.
+        """
+        with self.__write_lock:
+            sizes = self.__sizes.copy()
+            members = np.concatenate([self.__members[i][:size] for i, size in enumerate(sizes)])
+            codes = np.concatenate([self.__codes[i][:size] for i, size in enumerate(sizes)])
+            centroids, codebooks = self.__centroids, self.__codebooks
+        # A temporary file of its own in the same directory, so that concurrent saves never write the same file and
+        # the final rename never crosses file systems
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(path) or ".", delete=False) as file:
+            try:
+                np.savez(file, n_probe=self.__n_probe, centroids=centroids, codebooks=codebooks, sizes=sizes,
+                         members=members, codes=codes, store_id=-1 if store_id is None else store_id)
+                file.flush()
+                os.fsync(file.fileno())
+            except BaseException:
+                file.close()
+                os.remove(file.name)
+                raise
+        os.replace(file.name, path)
+        self.__store_id = store_id
+
+    @classmethod
+    def load(cls, path):
+        """
+        Reads an index written by save().
+
+        :param path: path of the index file (.npz).
+        :return: the index.
+        """
+        with np.load(path) as data:
+            index = cls(len(data["centroids"]), int(data["n_probe"]))
+            index.__restore(data["centroids"], data["codebooks"], data["sizes"], data["members"], data["codes"])
+            # The indices saved by the previous versions don't know their store
+            if "store_id" in data.files and int(data["store_id"]) >= 0:
+                index.__store_id = int(data["store_id"])
+        return index
+
+    def __restore(self, centroids, codebooks, sizes, members, codes):
+        """
+        Restores the trained quantizers and the coarse lists of a saved index.
+
+        :param centroids: coarse centroids.
+        :param codebooks: codebooks of the residuals.
+        :param sizes: number of encodings in each coarse list.
+        :param members: gallery indices of the encodings, list after list.
+        :param codes: codes of the encodings, list after list.
+        """
+        self.__centroids = centroids.astype(np.float32)
+        self.__centroid_norms = np.einsum("ij,ij->i", self.__centroids, self.__centroids)
+        self.__codebooks = codebooks.astype(np.float32)
+        self.__codebook_norms = np.einsum("mkd,mkd->mk", self.__codebooks, self.__codebooks)
+        self.__codebook_columns = np.ascontiguousarray(self.__codebooks.transpose(0, 2, 1))
+        offsets = np.concatenate([[0], np.cumsum(sizes)])
+        self.__members = [members[offsets[i]:offsets[i + 1]].astype(np.int64) for i in range(len(sizes))]
+        self.__codes = [codes[offsets[i]:offsets[i + 1]].astype(np.uint8) for i in range(len(sizes))]
+        self.__sizes = sizes.astype(np.int64)
+        self.__count = int(sizes.sum())
+
+    def __encode(self, residuals):
+        """
+        Quantizes the residuals, choosing for each sub-vector the nearest codeword.
+
+        :param residuals: (n x ENCODING_SIZE) array of residuals from the coarse centroids.
+        :return: (n x N_SUBVECTORS) array of codes.
+        """
+        subvectors = residuals.reshape(len(residuals), N_SUBVECTORS, -1)
+        codes = np.empty((len(residuals), N_SUBVECTORS), dtype=np.uint8)
+        for m in range(N_SUBVECTORS):
+            codes[:, m] = self.__assign(subvectors[:, m], self.__codebooks[m])
+        return codes
+
+    def __reserve(self, list_id, size):
+        """
+        Grows a coarse list so that it can hold at least size members.
+        The old arrays are never modified, so the queries already running on them stay consistent.
+
+        :param list_id: index of the coarse list.
+        :param size: number of members needed.
+        """
+        capacity = len(self.__members[list_id])
+        if size <= capacity:
+            return
+        capacity = max(capacity, 1)
+        while capacity < size:
+            capacity *= GROWTH_FACTOR
+        count = int(self.__sizes[list_id])
+        members = np.empty(capacity, dtype=np.int64)
+        codes = np.empty((capacity, N_SUBVECTORS), dtype=np.uint8)
+        members[:count] = self.__members[list_id][:count]
+        codes[:count] = self.__codes[list_id][:count]
+        self.__members[list_id] = members
+        self.__codes[list_id] = codes
+
+    @staticmethod
+    def __squared_distances(rows, centroids):
+        """
+        Computes the squared Euclidean distance between each row and each centroid.
+
+        :param rows: (n x d) array.
+        :param centroids: (k x d) array.
+        :return: (n x k) array of squared distances.
+        """
+        squared = np.einsum("ij,ij->i", centroids, centroids)[np.newaxis, :] - 2 * (rows @ centroids.T)
+        squared += np.einsum("ij,ij->i", rows, rows)[:, np.newaxis]
+        return squared
+
+    @staticmethod
+    def __assign(rows, centroids):
+        """
+        Assigns each row to its nearest centroid.
+
+        :param rows: (n x d) array.
+        :param centroids: (k x d) array.
+        :return: array with the index of the nearest centroid of each row.
+        """
+        return np.argmin(AnnIndex.__squared_distances(rows, centroids), axis=1)
+
+    @staticmethod
+    def __kmeans(rows, k, iterations, random):
+        """
+        Clusters the rows with the k-means algorithm, starting from k random rows.
+
+        :param rows: (n x d) array, with n >= k.
+        :param k: number of clusters.
+        :param iterations: number of iterations.
+        :param random: random generator.
+        :return: (k x d) array of centroids.
+        """
+        centroids = rows[random.choice(len(rows), k, replace=False)].copy()
+        for _ in range(iterations):
+            labels = AnnIndex.__assign(rows, centroids)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, labels, rows)
+            counts = np.bincount(labels, minlength=k)
+            empty = counts == 0
+            centroids[~empty] = sums[~empty] / counts[~empty, np.newaxis]
+            if empty.any():     # Restart the empty clusters from random rows
+                centroids[empty] = rows[random.choice(len(rows), int(empty.sum()), replace=False)]
+        return centroids
@@ -0,0 +1,199 @@
+import abc
+import socket
+import threading
+import cv2
+from Pipeline import LatestQueue
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Variables
+# ----------------------------------------------------------------------------------------------------------------------
+WINDOW_TITLE = "Camera Capture"     # Title of the window
+KEY_WAIT = 1                        # Milliseconds waited for a key, which also lets OpenCV handle the window events
+CLOSE_KEYS = (27, ord("q"))         # Keys that close the window (Esc and q)
+MJPEG_HOST = "127.0.0.1"            # Address of the MJPEG server, local only by default
+MJPEG_PORT = 8080                   # Port of the MJPEG server
+JPEG_QUALITY = 80                   # Quality of the frames sent to the MJPEG clients
+MJPEG_BOUNDARY = b"frame"           # Boundary between two frames of the MJPEG stream
+ACCEPT_TIMEOUT = 0.5                # Seconds after which the MJPEG server checks whether it has to stop
+SINKS = ("window", "null", "mjpeg")     # Names of the available display sinks, chosen from the command line
+
+
+# Class that represents where the processed frames are shown
+#
+# The display loop calls poll() while it waits for a frame and show() when a frame is ready: a sink never converts
+# or copies the frames more than it needs to.
+class DisplaySink(abc.ABC):
+    @abc.abstractmethod
+    def show(self, frame):
+        """
+        Shows a frame.
+
+        :param frame: frame in BGR encoding.
+        """
+
+    def poll(self):
+        """
+        Handles the events of the sink, without blocking.
+
+        :return: False if the user closed the sink, True otherwise.
+        """
+        return True
+
+    def close(self):
+        """
+        Releases the resources of the sink.
+        """
+        pass
+
+
+# Class that shows the frames in an OpenCV window, without any color conversion
+class WindowSink(DisplaySink):
+    # Fields and methods of the class
+    __title = WINDOW_TITLE  # Title of the window
+    __shown = False         # True once the first frame has been shown
+    __closed = False        # True once the user closed the window
+
+    # Builder method
+    def __init__(self, title=WINDOW_TITLE, fullscreen=True):
+        """
+        :param title: title of the window.
+        :param fullscreen: True to show the window in full screen.
+        """
+        self.__title = title
+        self.__shown = False
+        self.__closed = False
+        cv2.namedWindow(title, cv2.WINDOW_NORMAL)
+        if fullscreen:
+            cv2.setWindowProperty(title, cv2.WND_PROP_FULLSCREEN, cv2.WINDOW_FULLSCREEN)
+
+    def show(self, frame):
+        cv2.imshow(self.__title, frame)
+        self.__shown = True
+
+    def poll(self):
+        if self.__closed:
+            return False
+        key = cv2.waitKey(KEY_WAIT) & 0xFF
+        # The window is not visible anymore when the user closed it
+        if key in CLOSE_KEYS or (self.__shown and cv2.getWindowProperty(self.__title, cv2.WND_PROP_VISIBLE) < 1):
+            self.__closed = True
+        return not self.__closed
+
+    def close(self):
+        cv2.destroyWindow(self.__title)
+
+
+# Class that discards the frames, for the servers without a screen
+class NullSink(DisplaySink):
+    # Fields and methods of the class
+    frames = 0              # Number of frames received
+
+    # Builder method
+    def __init__(self):
+        self.frames = 0
+
+    def show(self, frame):
+        self.frames += 1
+
+
+# Class that streams the frames as MJPEG over HTTP, so that they can be watched in a browser or with a video player
+#
+# Each frame is encoded only once, and only if a client is connected; each client has its own sending thread and
+# keeps only the latest frame, so a slow client drops frames instead of slowing down the display loop.
+class MjpegSink(DisplaySink):
+    # Fields and methods of the class
+    __server = None         # Listening socket
+    __clients = []          # Latest frame queue of each connected client
+    __lock = None           # Lock protecting the list of the clients
+    __stop_event = None     # Event set to stop the server and the clients
+    __quality = JPEG_QUALITY    # Quality of the JPEG encoding
+
+    # Builder method
+    def __init__(self, host=MJPEG_HOST, port=MJPEG_PORT, quality=JPEG_QUALITY):
+        """
+        :param host: address of the server, 127.0.0.1 accepts only local clients.
+        :param port: port of the server.
+        :param quality: quality of the JPEG encoding, from 0 to 100.
+        """
+        self.__clients = []
+        self.__lock = threading.Lock()
+        self.__stop_event = threading.Event()
+        self.__quality = quality
+        self.__server = socket.create_server((host, port))
+        self.__server.settimeout(ACCEPT_TIMEOUT)
+        threading.Thread(target=self.__accept, daemon=True).start()
+
+    @property
+    def address(self):
+        """
+        :return: the (host, port) address of the server.
+        """
+        return self.__server.getsockname()[:2]
+
+    @property
+    def clients(self):
+        """
+        :return: the number of connected clients.
+        """
+        with self.__lock:
+            return len(self.__clients)
+
+    def show(self, frame):
+        with self.__lock:
+            clients = list(self.__clients)
+        if not clients:     # Nobody is watching: skipping the encoding
+            return
+        ret, jpeg = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, self.__quality])
+        if not ret:
+            return
+        chunk = (b"--" + MJPEG_BOUNDARY + b"\r\nContent-Type: image/jpeg\r\nContent-Length: " +
+                 str(len(jpeg)).encode() + b"\r\n\r\n" + jpeg.tobytes() + b"\r\n")
+        for client in clients:
+            client.put(chunk)
+
+    def close(self):
+        self.__stop_event.set()
+        with self.__lock:
+            for client in self.__clients:
+                client.put(None)    # Wake up the sending thread
+        self.__server.close()
+
+    def __accept(self):
+        """
+        Accepts the clients, starting a sending thread for each of them.
+        """
+        while not self.__stop_event.is_set():
+            try:
+                connection, _ = self.__server.accept()
+            except socket.timeout:
+                continue
+            except OSError:     # The server has been closed
+                break
+            threading.Thread(target=self.__serve, args=(connection, ), daemon=True).start()
+
+    def __serve(self, connection):
+        """
+        Sends the latest frames to a client, until it disconnects or the sink is closed.
+
+        :param connection: socket of the client.
+        """
+        frames = LatestQueue()
+        with self.__lock:
+            self.__clients.append(frames)
+        try:
+            connection.settimeout(None)
+            connection.recv(4096)   # The request is ignored: every path serves the stream
+            connection.sendall(b"HTTP/1.0 200 OK\r\nCache-Control: no-cache\r\n"
+                               b"Content-Type: multipart/x-mixed-replace; boundary=" + MJPEG_BOUNDARY + b"\r\n\r\n")
+            while not self.__stop_event.is_set():
+                chunk = frames.get()
+                if chunk is None:
+                    break
+                connection.sendall(chunk)
+        except OSError:     # The client disconnected
+            pass
+        finally:
+            with self.__lock:
+                self.__clients.remove(frames)
+            connection.close()
+
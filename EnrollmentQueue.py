@@ -0,0 +1,216 @@
+import itertools
+import logging
+import threading
+import time
+import numpy as np
+from FaceGallery import TOLERANCE
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Variables
+# ----------------------------------------------------------------------------------------------------------------------
+MIN_SAMPLES = 3             # Encodings collected before an unknown face is announced as waiting for a name
+MAX_SAMPLES = 5             # Encodings kept for each unknown face, averaged when it is registered
+PENDING_TIMEOUT = 120       # Seconds after which an unknown face not seen anymore, and without a name, is forgotten
+COMMIT_DELAY = 0.5          # Seconds the names are gathered before being registered together
+RETRY_DELAY = 1.0           # Seconds waited before retrying a failed commit, doubled at each new failure
+MAX_RETRY_DELAY = 60.0      # Maximum seconds waited before retrying a failed commit
+
+logger = logging.getLogger(__name__)
+
+
+# Class that collects the unknown faces waiting to be registered, and registers them in batches once named
+#
+# Each unknown face seen by the recognizer is offered to the queue: a face near an unknown face already waiting is
+# the same person, and only adds an encoding to it, so one person waiting at the entrance triggers one enrollment.
+# The names are given through name(), from any thread, and never block the recognition: the named faces are
+# registered together, COMMIT_DELAY seconds after the first name, by a single call of the commit function.
+class EnrollmentQueue:
+    # Fields and methods of the class
+    __commit = None         # Function that registers a list of encodings with a list of names and returns their Ids
+    __on_pending = None     # Function called with the ID of each unknown face that starts waiting for a name
+    __tolerance = TOLERANCE     # Maximum distance between two encodings of the same unknown face
+    __pending = {}          # Unknown faces waiting for a name or for the commit, by ID
+    __ids = None            # Generator of the IDs of the unknown faces
+    __timer = None          # Timer of the next commit, None if no commit is scheduled
+    __retry_delay = RETRY_DELAY     # Seconds waited before retrying the next failed commit
+    __lock = None           # Lock protecting the unknown faces, never held while committing
+
+    # Builder method
+    def __init__(self, commit, on_pending=None, tolerance=TOLERANCE):
+        """
+        :param commit: function that takes a list of encodings and a list of names, registers them, and returns the
+                       list of their Ids.
+        :param on_pending: optional function called with the ID of each unknown face once it waits for a name.
+        :param tolerance: maximum distance between two encodings of the same unknown face.
+        """
+        self.__commit = commit
+        self.__on_pending = on_pending
+        self.__tolerance = tolerance
+        self.__pending = {}
+        self.__ids = itertools.count(1)
+        self.__timer = None
+        self.__retry_delay = RETRY_DELAY
+        self.__lock = threading.Lock()
+
+    def offer(self, encoding):
+        """
+        Offers the encoding of an unknown face: it is added to the unknown face it belongs to, or starts a new one.
+
+        :param encoding: encoding of the face.
+        :return: the ID of the unknown face.
+        """
+        encoding = np.asarray(encoding, dtype=np.float32)
+        now = time.monotonic()
+        with self.__lock:
+            self.__expire(now)
+            entry = self.__nearest(encoding)
+            if entry is None:
+                entry = {"id": next(self.__ids), "encodings": [], "name": None, "first_seen": now, "announced": False,
+                         "committing": False}
+                self.__pending[entry["id"]] = entry
+            if len(entry["encodings"]) < MAX_SAMPLES:
+                entry["encodings"].append(encoding)
+                entry["mean"] = np.mean(entry["encodings"], axis=0)
+            entry["last_seen"] = now
+            announce = len(entry["encodings"]) >= MIN_SAMPLES and entry["name"] is None and not entry["announced"]
+            entry["announced"] = entry["announced"] or announce
+
+        if announce and self.__on_pending is not None:
+            self.__on_pending(entry["id"])
+        return entry["id"]
+
+    def pending(self):
+        """
+        :return: the list of the unknown faces waiting, oldest first, as dictionaries with their ID, the number of
+                 encodings collected, whether they are ready to be named, their name if already given, and the
+                 seconds since they were first seen.
+        """
+        now = time.monotonic()
+        with self.__lock:
+            return [{"id": entry["id"], "samples": len(entry["encodings"]),
+                     "ready": len(entry["encodings"]) >= MIN_SAMPLES, "name": entry["name"],
+                     "age": now - entry["first_seen"]}
+                    for entry in sorted(self.__pending.values(), key=lambda entry: entry["first_seen"])]
+
+    def name(self, name, pending_id=None):
+        """
+        Gives a name to an unknown face, which is registered with the next batch.
+
+        :param name: name of the user.
+        :param pending_id: ID of the unknown face, None for the oldest one ready and still without a name.
+        :return: the ID of the named face.
+        """
+        with self.__lock:
+            if pending_id is None:
+                waiting = [entry for entry in self.__pending.values()
+                           if entry["name"] is None and len(entry["encodings"]) >= MIN_SAMPLES]
+                if not waiting:
+                    raise KeyError("No face is waiting for a name")
+                pending_id = min(waiting, key=lambda entry: entry["first_seen"])["id"]
+            elif pending_id not in self.__pending or self.__pending[pending_id]["committing"]:
+                raise KeyError(f"No face {pending_id} is waiting for a name")
+
+            self.__pending[pending_id]["name"] = name
+            self.__schedule(COMMIT_DELAY)
+        return pending_id
+
+    def discard(self, pending_id):
+        """
+        Forgets an unknown face, e.g. someone who doesn't want to be registered.
+
+        :param pending_id: ID of the unknown face.
+        """
+        with self.__lock:
+            if pending_id in self.__pending and not self.__pending[pending_id]["committing"]:
+                del self.__pending[pending_id]
+
+    def commit(self):
+        """
+        Registers all the named faces with a single call of the commit function, outside the lock of the queue.
+
+        :return: a dictionary with the Id of the registered user of each named face, by ID of the face.
+        """
+        with self.__lock:
+            self.__timer = None
+            batch = [entry for entry in self.__pending.values()
+                     if entry["name"] is not None and not entry["committing"]]
+            # The faces stay in the queue until they can be recognized, so that their encodings offered meanwhile
+            # are not taken for new unknown faces
+            for entry in batch:
+                entry["committing"] = True
+        if not batch:
+            return {}
+
+        try:
+            user_ids = self.__commit([entry["mean"] for entry in batch], [entry["name"] for entry in batch])
+        except Exception:
+            with self.__lock:   # Kept for the next commit
+                for entry in batch:
+                    entry["committing"] = False
+            raise
+        with self.__lock:
+            for entry in batch:
+                self.__pending.pop(entry["id"], None)
+        return {entry["id"]: user_id for entry, user_id in zip(batch, user_ids)}
+
+    def close(self):
+        """
+        Registers the faces already named, without waiting for the scheduled commit.
+        """
+        with self.__lock:
+            timer = self.__timer
+        if timer is not None:
+            timer.cancel()
+        self.commit()
+
+    def __schedule(self, delay):
+        """
+        Schedules a commit, unless one is already scheduled. Must be called holding the lock.
+
+        :param delay: seconds before the commit.
+        """
+        if self.__timer is None:
+            self.__timer = threading.Timer(delay, self.__scheduled_commit)
+            self.__timer.daemon = True
+            self.__timer.start()
+
+    def __scheduled_commit(self):
+        """
+        Commits the named faces from the timer thread, where an exception would be lost: a failed commit is logged
+        and retried later, waiting longer after each new failure.
+        """
+        try:
+            self.commit()
+        except Exception:
+            with self.__lock:
+                delay = self.__retry_delay
+                self.__retry_delay = min(2 * delay, MAX_RETRY_DELAY)
+                self.__schedule(delay)
+            logger.exception("Cannot register the named faces, retrying in %.1f seconds", delay)
+        else:
+            with self.__lock:
+                self.__retry_delay = RETRY_DELAY
+
+    def __nearest(self, encoding):
+        """
+        Finds the unknown face an encoding belongs to. Must be called holding the lock.
+
+        :param encoding: encoding of the face.
+        :return: the entry of the nearest unknown face within the tolerance, None if there is none.
+        """
+        if not self.__pending:
+            return None
+        entries = list(self.__pending.values())
+        distances = np.linalg.norm(np.array([entry["mean"] for entry in entries]) - encoding, axis=1)
+        nearest = int(np.argmin(distances))
+        return entries[nearest] if distances[nearest] <= self.__tolerance else None
+
+    def __expire(self, now):
+        """
+        Forgets the unknown faces without a name not seen for PENDING_TIMEOUT seconds. Must be called holding the lock.
+
+        :param now: current time, from time.monotonic().
+        """
+        for pending_id in [pending_id for pending_id, entry in self.__pending.items()
+                           if entry["name"] is None and now - entry["last_seen"] > PENDING_TIMEOUT]:
+            del self.__pending[pending_id]
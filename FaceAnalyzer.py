@@ -0,0 +1,141 @@
+from concurrent.futures import ThreadPoolExecutor
+import logic
+from FrameContext import FrameContext
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Variables
+# ----------------------------------------------------------------------------------------------------------------------
+MAX_WORKERS = 4             # Number of threads analyzing the faces of a frame
+RIGHT_EYE = slice(36, 42)   # Indexes of the right eye landmarks
+LEFT_EYE = slice(42, 48)    # Indexes of the left eye landmarks
+
+
+# Class that holds the results of the analysis of a face
+class FaceResult:
+    # Fields and methods of the class
+    track_id = None         # ID of the track of the face, None if the face is not tracked
+    face = None             # Bounding box of the face (dlib.rectangle)
+    landmarks = None        # Reference points of the face, as a (68, 2) array
+    is_looking_re = False   # True if the right eye is looking at the cam
+    is_looking_le = False   # True if the left eye is looking at the cam
+    name = None             # Name of the user, "" if not recognized, None if recognition has not been run
+
+    # Builder method
+    def __init__(self, face, landmarks, is_looking_re, is_looking_le, track_id=None, name=None):
+        self.face = face
+        self.landmarks = landmarks
+        self.is_looking_re = is_looking_re
+        self.is_looking_le = is_looking_le
+        self.track_id = track_id
+        self.name = name
+
+    @property
+    def is_looking(self):
+        """
+        :return: True if both the eyes are looking at the cam.
+        """
+        return self.is_looking_re and self.is_looking_le
+
+    @property
+    def bounding_box(self):
+        """
+        :return: the bounding box of the face in the format used by face_recognition (top, right, bottom, left).
+        """
+        return self.face.top(), self.face.right(), self.face.bottom(), self.face.left()
+
+    def to_dict(self):
+        """
+        :return: a JSON serializable representation of the results.
+        """
+        return {
+            "track_id": self.track_id,
+            "box": [self.face.left(), self.face.top(), self.face.right(), self.face.bottom()],
+            "landmarks": self.landmarks.tolist(),
+            "gaze": {"right": bool(self.is_looking_re), "left": bool(self.is_looking_le)},
+            "looking": bool(self.is_looking),
+            "identity": self.name or None,
+        }
+
+
+# Class that analyzes all the faces of a frame concurrently: landmarks, gaze of each eye and, optionally, identity
+#
+# dlib and OpenCV release the GIL in their heavy functions, so the faces are spread over a thread pool and the
+# latency of a frame grows sub-linearly with the number of faces.
+class FaceAnalyzer:
+    # Fields and methods of the class
+    __executor = None       # Thread pool analyzing the faces, None analyzes them in the calling thread
+    __eye_filtering = True  # Whether the eyes are filtered before being binarized
+
+    # Builder method
+    def __init__(self, max_workers=MAX_WORKERS):
+        """
+        :param max_workers: number of threads analyzing the faces of a frame, 1 analyzes them in the calling thread.
+        """
+        self.__executor = ThreadPoolExecutor(max_workers=max_workers) if max_workers > 1 else None
+        self.__eye_filtering = True
+
+    @property
+    def eye_filtering(self):
+        """
+        :return: True if the eyes are filtered (averaging filter and Gaussian blur) before being binarized.
+        """
+        return self.__eye_filtering
+
+    @eye_filtering.setter
+    def eye_filtering(self, value):
+        self.__eye_filtering = value
+
+    def analyze(self, image, faces, track_ids=None, identify=None, to_identify=None):
+        """
+        Analyzes all the faces of a frame.
+
+        :param image: input image, or its FrameContext.
+        :param faces: list of the faces to analyze, where the first one is the nearest to the cam.
+        :param track_ids: optional list with the ID of the track of each face.
+        :param identify: optional function that takes the frame, a bounding box (top, right, bottom, left) and the
+                         landmarks of the face, and returns the name of the user, e.g. ImageRecognizer.identify_face.
+        :param to_identify: optional list with, for each face, True if it has to be identified; None identifies all.
+        :return: the list of the results, in the same order of the faces.
+        """
+        context = FrameContext.of(image)
+        context.gray     # Convert the frame once, before it is shared between the threads
+        if identify is not None:
+            context.rgb
+        track_ids = track_ids if track_ids is not None else [None] * len(faces)
+        to_identify = to_identify if to_identify is not None else [identify is not None] * len(faces)
+
+        tasks = [(context, face, track_id, identify if identify_face else None, self.__eye_filtering)
+                 for face, track_id, identify_face in zip(faces, track_ids, to_identify)]
+        if self.__executor is None or len(tasks) <= 1:
+            return [self.__analyze_face(*task) for task in tasks]
+        return list(self.__executor.map(lambda task: self.__analyze_face(*task), tasks))
+
+    def close(self):
+        """
+        Stops the thread pool.
+        """
+        if self.__executor is not None:
+            self.__executor.shutdown(wait=False)
+
+    @staticmethod
+    def __analyze_face(context, face, track_id, identify, eye_filtering):
+        """
+        Analyzes a single face.
+
+        :param context: FrameContext of the frame.
+        :param face: face to analyze.
+        :param track_id: ID of the track of the face.
+        :param identify: function used to identify the face, None to skip the identification.
+        :param eye_filtering: True to filter the eyes before binarizing them.
+        :return: the results of the face.
+        """
+        reference_points = logic.face_landmarks_detector(context, face)  # Getting the reference points
+
+        # Verifying if the right eye and left eye are looking at the cam.
+        is_looking_re, is_looking_le = logic.are_looking_at_cam(context, [reference_points[RIGHT_EYE],
+                                                                          reference_points[LEFT_EYE]], eye_filtering)
+
+        result = FaceResult(face, reference_points, is_looking_re, is_looking_le, track_id)
+        if identify is not None:
+            result.name = identify(context, result.bounding_box, reference_points)  # Sharing the landmarks
+        return result
@@ -0,0 +1,311 @@
+import threading
+import numpy as np
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Variables
+# ----------------------------------------------------------------------------------------------------------------------
+ENCODING_SIZE = 128         # Size of a face encoding
+INITIAL_CAPACITY = 64       # Initial number of rows allocated for the encodings
+GROWTH_FACTOR = 2           # Factor used to grow the encodings matrix when it is full
+TOLERANCE = 0.6             # Maximum distance between two faces to be considered a match (face_recognition default)
+SHORTLIST = 64              # Number of candidates of the approximate index re-ranked with their exact distances
+
+
+# Class that stores the known face encodings in a single contiguous matrix and answers nearest-match queries on it
+class FaceGallery:
+    # Fields and methods of the class
+    __encodings = None      # Matrix of the known face encodings (capacity x ENCODING_SIZE, float32)
+    __squared_norms = None  # Squared norm of each known face encoding
+    __names = []            # Array of known names
+    __count = 0             # Number of faces stored in the gallery
+    __tolerance = TOLERANCE     # Matching tolerance
+    __write_lock = None     # Lock held while a face is being added
+    __index = None          # Optional approximate index (AnnIndex), None searches the whole gallery
+
+    # Builder method
+    def __init__(self, encodings=None, names=None, tolerance=TOLERANCE, capacity=INITIAL_CAPACITY):
+        """
+        :param encodings: optional iterable of face encodings used to fill the gallery.
+        :param names: optional iterable of names, one for each encoding.
+        :param tolerance: maximum distance between two faces to be considered a match.
+        :param capacity: number of rows allocated in advance.
+        """
+        self.__encodings = np.zeros((max(capacity, 1), ENCODING_SIZE), dtype=np.float32)
+        self.__squared_norms = np.zeros(max(capacity, 1), dtype=np.float32)
+        self.__names = []
+        self.__count = 0
+        self.__tolerance = tolerance
+        self.__write_lock = threading.Lock()
+        self.__index = None
+
+        if encodings is not None:
+            self.extend(encodings, names)
+
+    @classmethod
+    def wrap(cls, encodings, names, tolerance=TOLERANCE):
+        """
+        Creates a gallery on an existing encodings matrix without copying it, e.g. a matrix in shared memory.
+        The matrix is never written: the first face added to the gallery moves it to a private copy.
+
+        :param encodings: (count x ENCODING_SIZE) float32 matrix of face encodings.
+        :param names: list of names, one for each encoding.
+        :param tolerance: maximum distance between two faces to be considered a match.
+        :return: the gallery.
+        """
+        encodings = np.asarray(encodings).reshape(-1, ENCODING_SIZE)
+        if encodings.dtype != np.float32 or len(names) != len(encodings):
+            raise ValueError("A float32 matrix with one row for each name is needed")
+        gallery = cls(tolerance=tolerance)
+        gallery.__attach(encodings, list(names))
+        return gallery
+
+    def __len__(self):
+        return self.__count
+
+    @property
+    def tolerance(self):
+        return self.__tolerance
+
+    @property
+    def names(self):
+        """
+        :return: a copy of the list of the known names, in insertion order.
+        """
+        return self.__names[:self.__count]
+
+    @property
+    def encodings(self):
+        """
+        :return: a read-only view (count x ENCODING_SIZE) on the known face encodings.
+        """
+        view = self.__encodings[:self.__count]
+        view.flags.writeable = False
+        return view
+
+    @property
+    def index(self):
+        """
+        :return: the approximate index of the gallery, None if the queries search the whole gallery.
+        """
+        return self.__index
+
+    def set_index(self, index):
+        """
+        Attaches a trained approximate index to the gallery, adding to it the faces it doesn't hold yet, so that an
+        index saved before the last registrations can be reused. The queries then re-rank only the candidates of the
+        index with their exact distances, keeping the same tolerance.
+
+        :param index: trained approximate index (AnnIndex), None to search the whole gallery again.
+        """
+        if index is not None and not index.is_trained:
+            raise ValueError("The approximate index must be trained")
+        with self.__write_lock:
+            if index is not None and len(index) < self.__count:
+                index.add(self.__encodings[len(index):self.__count], len(index))
+            self.__index = index
+
+    def name(self, index):
+        """
+        :param index: index of a face in the gallery.
+        :return: the name associated to the face.
+        """
+        return self.__names[index]
+
+    def add(self, encoding, name):
+        """
+        Adds a face encoding to the gallery, growing the matrix when needed.
+
+        :param encoding: encoding of the face.
+        :param name: ID or name of the user.
+        :return: the index of the new face in the gallery.
+        """
+        with self.__write_lock:
+            index = self.__count
+            self.__reserve(index + 1)
+            row = np.asarray(encoding, dtype=np.float32).reshape(ENCODING_SIZE)
+            self.__encodings[index] = row
+            self.__squared_norms[index] = np.dot(row, row)
+            self.__names.append(name)
+            if self.__index is not None:
+                self.__index.add(row, index)
+            # The new face becomes visible to the queries only once it is completely written
+            self.__count = index + 1
+        return index
+
+    def extend(self, encodings, names):
+        """
+        Adds several face encodings to the gallery with a single copy.
+
+        :param encodings: iterable of face encodings.
+        :param names: iterable of names, one for each encoding.
+        """
+        rows = np.asarray(encodings, dtype=np.float32).reshape(-1, ENCODING_SIZE)
+        names = list(names)
+        if len(names) != len(rows):
+            raise ValueError("The number of names must match the number of encodings")
+
+        with self.__write_lock:
+            start = self.__count
+            self.__reserve(start + len(rows))
+            self.__encodings[start:start + len(rows)] = rows
+            self.__squared_norms[start:start + len(rows)] = np.einsum("ij,ij->i", rows, rows)
+            self.__names.extend(names)
+            if self.__index is not None:
+                self.__index.add(rows, start)
+            self.__count = start + len(rows)
+
+    def retire(self, indices):
+        """
+        Retires faces replaced by newer ones, e.g. when a user has been registered again: their rows are kept, so
+        that the indices of the other faces don't change, but they never match again.
+        A single value is written for each face, so the queries running meanwhile see either the old or the new state.
+
+        :param indices: indices of the faces to retire.
+        """
+        with self.__write_lock:
+            for index in indices:
+                if index < self.__count:
+                    self.__squared_norms[index] = np.inf   # Infinite distance from every probe
+
+    def distances(self, probes):
+        """
+        Computes the Euclidean distance between each probe face and every known face in a single vectorized pass.
+
+        :param probes: a face encoding, or a (n_probes x ENCODING_SIZE) array of face encodings.
+        :return: a (n_probes x count) array of distances.
+        """
+        # Read the count first, so a concurrent add() never exposes a partially written row
+        count = self.__count
+        encodings = self.__encodings[:count]
+        squared_norms = self.__squared_norms[:count]
+
+        probes = np.asarray(probes, dtype=np.float32).reshape(-1, ENCODING_SIZE)
+        if count == 0:
+            return np.empty((len(probes), 0), dtype=np.float32)
+
+        # |a - b|^2 = |a|^2 + |b|^2 - 2 a.b
+        squared = squared_norms[np.newaxis, :] - 2 * (probes @ encodings.T)
+        squared += np.einsum("ij,ij->i", probes, probes)[:, np.newaxis]
+        np.maximum(squared, 0, out=squared)
+        return np.sqrt(squared, out=squared)
+
+    def nearest(self, probe):
+        """
+        Finds the known face nearest to the probe face.
+
+        :param probe: encoding of the face to look for.
+        :return: a tuple (index, distance), or (-1, inf) if the gallery is empty.
+        """
+        indices, distances = self.top_k(probe, 1)
+        if indices.shape[1] == 0 or indices[0, 0] < 0:
+            return -1, float("inf")
+        return int(indices[0, 0]), float(distances[0, 0])
+
+    def top_k(self, probes, k):
+        """
+        Finds the k known faces nearest to each probe face.
+
+        :param probes: a face encoding, or a (n_probes x ENCODING_SIZE) array of face encodings.
+        :param k: number of faces to return for each probe.
+        :return: a tuple (indices, distances) of (n_probes x k') arrays sorted by distance, where k' = min(k, count);
+                 with an approximate index, the missing candidates have index -1 and infinite distance.
+        """
+        if self.__index is not None:
+            return self.__approximate_top_k(probes, k)
+
+        distances = self.distances(probes)
+        k = min(k, distances.shape[1])
+        if k == 0:
+            return np.empty((len(distances), 0), dtype=int), distances
+
+        # Partial selection first, then sort only the k selected columns
+        indices = np.argpartition(distances, k - 1, axis=1)[:, :k]
+        selected = np.take_along_axis(distances, indices, axis=1)
+        order = np.argsort(selected, axis=1)
+        return np.take_along_axis(indices, order, axis=1), np.take_along_axis(selected, order, axis=1)
+
+    def match(self, probe):
+        """
+        Tries to match the probe face against the known faces.
+
+        :param probe: encoding of the face to look for.
+        :return: the name of the nearest known face if it is within the tolerance, otherwise an empty string.
+        """
+        return self.match_batch(probe)[0]
+
+    def match_batch(self, probes):
+        """
+        Tries to match several probe faces against the known faces at once.
+
+        :param probes: a face encoding, or a (n_probes x ENCODING_SIZE) array of face encodings.
+        :return: a list with, for each probe, the name of the matching known face or an empty string.
+        """
+        indices, distances = self.top_k(probes, 1)
+        if indices.shape[1] == 0:
+            return [""] * len(indices)
+        names = self.__names
+        return [names[index] if index >= 0 and distance <= self.__tolerance else ""
+                for index, distance in zip(indices[:, 0], distances[:, 0])]
+
+    def __attach(self, encodings, names):
+        """
+        Uses an existing encodings matrix as the storage of the gallery, whose capacity is exactly its size.
+
+        :param encodings: (count x ENCODING_SIZE) float32 matrix of face encodings.
+        :param names: list of names, one for each encoding.
+        """
+        with self.__write_lock:
+            self.__encodings = encodings
+            self.__squared_norms = np.einsum("ij,ij->i", encodings, encodings)
+            self.__names = names
+            self.__count = len(encodings)
+
+    def __approximate_top_k(self, probes, k):
+        """
+        Finds the k known faces nearest to each probe face among the candidates of the approximate index, ranked
+        by their exact distances.
+
+        :param probes: a face encoding, or a (n_probes x ENCODING_SIZE) array of face encodings.
+        :param k: number of faces to return for each probe.
+        :return: a tuple (indices, distances) of (n_probes x k') arrays sorted by distance.
+        """
+        # Read the count first, so a concurrent add() never exposes a partially written row
+        count = self.__count
+        encodings = self.__encodings
+        probes = np.asarray(probes, dtype=np.float32).reshape(-1, ENCODING_SIZE)
+        k = min(k, count)
+        indices = np.full((len(probes), k), -1, dtype=int)
+        distances = np.full((len(probes), k), np.inf, dtype=np.float32)
+        if k == 0:
+            return indices, distances
+
+        squared_norms = self.__squared_norms
+        for i, (probe, candidates) in enumerate(zip(probes, self.__index.search(probes, max(SHORTLIST, k)))):
+            candidates = candidates[candidates < count]
+            exact = np.linalg.norm(encodings[candidates] - probe, axis=1)
+            exact[np.isinf(squared_norms[candidates])] = np.inf    # Retired faces
+            order = np.argsort(exact)[:k]
+            indices[i, :len(order)] = candidates[order]
+            distances[i, :len(order)] = exact[order]
+        return indices, distances
+
+    def __reserve(self, size):
+        """
+        Grows the encodings matrix so that it can hold at least size rows.
+        The old matrix is never modified, so the queries already running on it stay consistent.
+
+        :param size: number of rows needed.
+        """
+        capacity = len(self.__encodings)
+        if size <= capacity:
+            return
+        capacity = max(capacity, 1)     # A wrapped empty matrix has no capacity to grow from
+        while capacity < size:
+            capacity *= GROWTH_FACTOR
+
+        encodings = np.zeros((capacity, ENCODING_SIZE), dtype=np.float32)
+        squared_norms = np.zeros(capacity, dtype=np.float32)
+        encodings[:self.__count] = self.__encodings[:self.__count]
+        squared_norms[:self.__count] = self.__squared_norms[:self.__count]
+        self.__encodings = encodings
+        self.__squared_norms = squared_norms
@@ -0,0 +1,190 @@
+import dlib
+import itertools
+import logic
+from FrameContext import FrameContext
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Variables
+# ----------------------------------------------------------------------------------------------------------------------
+DETECTION_INTERVAL = 10     # Number of frames between two full detections
+MIN_CONFIDENCE = 7          # Minimum peak-to-sidelobe ratio of a correlation tracker to keep following a face
+MIN_OVERLAP = 0.3           # Minimum intersection over union between a detection and a track to be the same face
+ROI_MARGIN = 0.5            # Margin added around a lost face to search it again, as a fraction of its size
+
+
+# Class that represents a face followed across the frames
+class Track:
+    # Fields and methods of the class
+    id = 0              # Stable ID of the track
+    face = None         # Bounding box of the face in the current frame (dlib.rectangle)
+    confidence = 0.0    # Confidence of the last tracker update
+    __tracker = None    # Correlation tracker following the face
+
+    # Builder method
+    def __init__(self, track_id, gray_image, face):
+        """
+        :param track_id: stable ID of the track.
+        :param gray_image: gray frame where the face has been detected.
+        :param face: bounding box of the detected face.
+        """
+        self.id = track_id
+        self.restart(gray_image, face)
+
+    def restart(self, gray_image, face):
+        """
+        Restarts the correlation tracker on a freshly detected bounding box.
+
+        :param gray_image: gray frame where the face has been detected.
+        :param face: bounding box of the detected face.
+        """
+        self.face = face
+        self.confidence = float("inf")
+        self.__tracker = dlib.correlation_tracker()
+        self.__tracker.start_track(gray_image, face)
+
+    def follow(self, gray_image):
+        """
+        Moves the bounding box of the face to its position in a new frame.
+
+        :param gray_image: new gray frame.
+        """
+        self.confidence = self.__tracker.update(gray_image)
+        position = self.__tracker.get_position()
+        self.face = dlib.rectangle(int(position.left()), int(position.top()),
+                                   int(position.right()), int(position.bottom()))
+
+
+# Class that runs the face detector only every few frames, and follows the detected faces in between
+class FaceTracker:
+    # Fields and methods of the class
+    __tracks = []           # Faces currently followed
+    __ids = None            # Generator of the track IDs
+    __frames_since_detection = 0    # Number of frames processed since the last full detection
+    __detection_interval = DETECTION_INTERVAL   # Number of frames between two full detections
+    __min_confidence = MIN_CONFIDENCE           # Minimum tracker confidence
+    __detection_scale = logic.DETECTION_SCALE   # Scale of the image searched by the face detector
+
+    # Builder method
+    def __init__(self, detection_interval=DETECTION_INTERVAL, min_confidence=MIN_CONFIDENCE,
+                 detection_scale=logic.DETECTION_SCALE):
+        """
+        :param detection_interval: number of frames between two full detections, 1 detects on every frame.
+        :param min_confidence: minimum tracker confidence, below it the face is searched again around its last position.
+        :param detection_scale: scale of the image searched by the face detector.
+        """
+        self.__tracks = []
+        self.__ids = itertools.count()
+        self.__frames_since_detection = 0
+        self.__detection_interval = detection_interval
+        self.__min_confidence = min_confidence
+        self.__detection_scale = detection_scale
+
+    @property
+    def tracks(self):
+        return list(self.__tracks)
+
+    @property
+    def detection_interval(self):
+        return self.__detection_interval
+
+    @detection_interval.setter
+    def detection_interval(self, value):
+        self.__detection_interval = value
+
+    @property
+    def detection_scale(self):
+        return self.__detection_scale
+
+    @detection_scale.setter
+    def detection_scale(self, value):
+        self.__detection_scale = value
+
+    def update(self, image):
+        """
+        Finds the faces in a new frame, through a full detection or by following the faces of the previous frames.
+
+        :param image: input image, or its FrameContext.
+        :return: the list of tracks, where the first one is the nearest to the cam.
+        """
+        context = FrameContext.of(image)
+
+        if self.__needs_detection():
+            self.__detect(context)
+        else:
+            for track in self.__tracks:
+                track.follow(context.gray)
+            self.__frames_since_detection += 1
+
+            # Search the faces whose tracker lost confidence only around their last position
+            for track in [track for track in self.__tracks if track.confidence < self.__min_confidence]:
+                self.__redetect(context, track)
+
+        # Keep the nearest face first, as detect_faces() does
+        self.__tracks.sort(key=lambda track: track.face.area(), reverse=True)
+        return list(self.__tracks)
+
+    def reset(self):
+        """
+        Drops all the tracks, so that the next frame is fully detected.
+        """
+        self.__tracks = []
+
+    def __needs_detection(self):
+        """
+        :return: True if a full detection has to be run on the current frame.
+        """
+        return len(self.__tracks) == 0 or self.__frames_since_detection + 1 >= self.__detection_interval
+
+    def __detect(self, context):
+        """
+        Runs a full detection and matches the detected faces with the current tracks, so that they keep their IDs.
+
+        :param context: FrameContext of the frame.
+        """
+        tracks = []
+        unmatched = list(self.__tracks)
+
+        for face in logic.detect_faces(context, scale=self.__detection_scale):
+            # Find the current track that overlaps the most with the detected face
+            best = max(unmatched, key=lambda track: self.__overlap(track.face, face), default=None)
+            if best is not None and self.__overlap(best.face, face) >= MIN_OVERLAP:
+                unmatched.remove(best)
+                best.restart(context.gray, face)
+                tracks.append(best)
+            else:
+                tracks.append(Track(next(self.__ids), context.gray, face))
+
+        self.__tracks = tracks
+        self.__frames_since_detection = 0
+
+    def __redetect(self, context, track):
+        """
+        Searches a face whose tracker lost confidence in a region around its last position, dropping it if not found.
+
+        :param context: FrameContext of the frame.
+        :param track: track that lost confidence.
+        """
+        face = track.face
+        margin_x, margin_y = int(face.width() * ROI_MARGIN), int(face.height() * ROI_MARGIN)
+        roi = dlib.rectangle(face.left() - margin_x, face.top() - margin_y,
+                             face.right() + margin_x, face.bottom() + margin_y)
+
+        faces = logic.detect_faces(context, scale=self.__detection_scale, roi=roi)
+        if len(faces) > 0:
+            track.restart(context.gray, max(faces, key=lambda detected: self.__overlap(face, detected)))
+        else:
+            self.__tracks.remove(track)
+
+    @staticmethod
+    def __overlap(face1, face2):
+        """
+        Function that takes two bounding boxes and returns their intersection over union.
+
+        :param face1: first bounding box
+        :param face2: second bounding box
+        :return: the intersection over union of the two bounding boxes
+        """
+        intersection = face1.intersect(face2)
+        if intersection.is_empty():
+            return 0.0
+        return intersection.area() / (face1.area() + face2.area() - intersection.area())
@@ -0,0 +1,75 @@
+import cv2
+
+
+# Class that wraps a frame in BGR encoding and computes its derived images once, the first time they are needed
+class FrameContext:
+    # Fields and methods of the class
+    __frame = None      # Frame in BGR encoding
+    __gray = None       # Gray version of the frame
+    __rgb = None        # RGB version of the frame
+    __scaled = {}       # Downscaled gray versions of the frame, by scale
+
+    # Builder method
+    def __init__(self, frame):
+        """
+        :param frame: frame in BGR encoding.
+        """
+        self.__frame = frame
+        self.__gray = None
+        self.__rgb = None
+        self.__scaled = {}
+
+    @classmethod
+    def of(cls, image):
+        """
+        Returns the context of an image, so that the functions can accept either a frame or its context.
+
+        :param image: frame in BGR encoding, or its context.
+        :return: the context of the frame.
+        """
+        return image if isinstance(image, cls) else cls(image)
+
+    @property
+    def frame(self):
+        """
+        :return: the frame in BGR encoding.
+        """
+        return self.__frame
+
+    @property
+    def shape(self):
+        """
+        :return: the shape of the frame.
+        """
+        return self.__frame.shape
+
+    @property
+    def gray(self):
+        """
+        :return: the gray version of the frame, computed once.
+        """
+        if self.__gray is None:
+            self.__gray = cv2.cvtColor(self.__frame, cv2.COLOR_BGR2GRAY)
+        return self.__gray
+
+    @property
+    def rgb(self):
+        """
+        :return: the RGB version of the frame, computed once.
+        """
+        if self.__rgb is None:
+            self.__rgb = cv2.cvtColor(self.__frame, cv2.COLOR_BGR2RGB)
+        return self.__rgb
+
+    def scaled_gray(self, scale):
+        """
+        Returns the gray version of the frame resized by the given scale, computed once for each scale.
+
+        :param scale: resize factor, 1 returns the full resolution gray image.
+        :return: the resized gray version of the frame.
+        """
+        if scale == 1:
+            return self.gray
+        if scale not in self.__scaled:
+            self.__scaled[scale] = cv2.resize(self.gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        return self.__scaled[scale]
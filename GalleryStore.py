@@ -0,0 +1,334 @@
+import json
+import os
+import threading
+import numpy as np
+
+try:
+    import fcntl     # File locking between processes, not available on Windows
+except ImportError:
+    fcntl = None
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Variables
+# ----------------------------------------------------------------------------------------------------------------------
+ENCODING_SIZE = 128                 # Size of a face encoding
+ENCODING_DTYPE = np.float32         # Type of the stored encodings
+ROW_SIZE = ENCODING_SIZE * np.dtype(ENCODING_DTYPE).itemsize    # Size in bytes of a stored encoding
+MAGIC = b"WETGAL01"                 # Signature at the beginning of the encodings file
+HEADER_SIZE = 16                    # Size in bytes of the encodings file header (magic + encoding size + store ID)
+ENCODINGS_EXTENSION = ".gallery"    # Extension of the encodings file
+NAMES_EXTENSION = ".names"          # Extension of the names log
+INDEX_EXTENSION = ".index.npz"      # Extension of the approximate index file, rebuilt from the store when missing
+
+
+# Class that stores the registered users in a memory-mapped encodings matrix and an append-only names log
+#
+# The encodings file is a fixed header followed by one float32 row per user, the names log has one JSON line
+# ({"Id": ..., "name": ...}) per user. A new user is appended by writing its row first and its log line afterwards,
+# both synced to disk, so a user exists only once its log line is complete: a crash between the two writes
+# leaves a torn tail that is ignored by the readers and cut away by the next writer.
+# Row i of the encodings file always belongs to line i of the log. A user is changed by appending a new row and a
+# new line with the same Id: the last line of an Id replaces the previous ones, so the files never stop growing
+# at the end and the readers can follow them by reading only what has been appended since their last read.
+class GalleryStore:
+    # Fields and methods of the class
+    __encodings_path = ""   # Path of the encodings file
+    __names_path = ""       # Path of the names log
+    __index_path = ""       # Path of the approximate index file
+    __append_lock = None    # Lock held while a user is being appended
+    __validated = None      # (identity, records, offset in the names log) of the records known to be complete
+
+    # Builder method
+    def __init__(self, base_path):
+        """
+        :param base_path: path of the store without extension, e.g. "registered_user".
+        """
+        self.__encodings_path = base_path + ENCODINGS_EXTENSION
+        self.__names_path = base_path + NAMES_EXTENSION
+        self.__index_path = base_path + INDEX_EXTENSION
+        self.__append_lock = threading.Lock()
+        self.__validated = None
+
+    @property
+    def encodings_path(self):
+        return self.__encodings_path
+
+    @property
+    def names_path(self):
+        return self.__names_path
+
+    @property
+    def index_path(self):
+        return self.__index_path
+
+    def exists(self):
+        """
+        :return: True if the store has already been created on disk.
+        """
+        return os.path.exists(self.__encodings_path) and os.path.exists(self.__names_path)
+
+    def load(self):
+        """
+        Maps the encodings file in memory and reads the names log, without modifying any file.
+
+        :return: a tuple containing the read-only (n x ENCODING_SIZE) encodings matrix and the list of names.
+        """
+        encodings, _, names, _, _ = self.read()
+        return encodings, names
+
+    def read(self, start=0, offset=0):
+        """
+        Reads the records appended to the store after a given position, without modifying any file: called with the
+        position returned by the previous call, it reads only the new records.
+
+        :param start: number of records already read, i.e. index of the first row to read.
+        :param offset: position in bytes, in the names log, of the end of the records already read.
+        :return: a tuple containing the read-only encodings matrix of the new records, the list of their Ids, the list
+                 of their names, and the new position (number of records read, offset in bytes).
+        """
+        if not self.exists():
+            return np.empty((0, ENCODING_SIZE), dtype=ENCODING_DTYPE), [], [], start, offset
+
+        records, line_ends = self.__read_names(offset)
+        count = max(min(len(records), self.__count_rows() - start), 0)
+        return (self.__map_encodings(start, count), [record["Id"] for record in records[:count]],
+                [record["name"] for record in records[:count]], start + count,
+                line_ends[count - 1] if count > 0 else offset)
+
+    def identity(self):
+        """
+        Identifies the files of the store: appending records never changes the identity, while a store replaced by
+        another one, e.g. migrated again or restored from a backup, has a different identity.
+
+        :return: a tuple containing the store ID written in the header of the encodings file (0 for the stores
+                 created before the IDs) and the inodes of the two files; None if the store doesn't exist.
+        """
+        try:
+            with open(self.__encodings_path, "rb") as encodings_file:
+                header = encodings_file.read(HEADER_SIZE)
+                encodings_inode = os.fstat(encodings_file.fileno()).st_ino
+            names_inode = os.stat(self.__names_path).st_ino
+        except OSError:
+            return None
+        store_id = int(np.frombuffer(header, dtype="<u4", count=1, offset=12)[0]) if len(header) == HEADER_SIZE else 0
+        return store_id, encodings_inode, names_inode
+
+    def store_id(self):
+        """
+        :return: the store ID written in the header of the encodings file when the store was created, 0 for the
+                 stores created before the IDs, None if the store doesn't exist.
+        """
+        identity = self.identity()
+        return identity[0] if identity is not None else None
+
+    def size(self):
+        """
+        :return: the size in bytes of the names log, which grows at each new record; 0 if the store doesn't exist.
+        """
+        try:
+            return os.path.getsize(self.__names_path)
+        except OSError:
+            return 0
+
+    def append(self, encoding, name, user_id=None):
+        """
+        Appends a record to the store, writing only the record itself.
+
+        :param encoding: encoding of the user's face.
+        :param name: ID or name of the user.
+        :param user_id: Id of an existing user to change, None to add a new user.
+        :return: the Id of the user.
+        """
+        return self.extend([encoding], [name], None if user_id is None else [user_id])[0]
+
+    def extend(self, encodings, names, user_ids=None):
+        """
+        Appends several records to the store at once, with a single sync of each file.
+
+        :param encodings: iterable of encodings of the users' faces.
+        :param names: iterable of IDs or names of the users, one for each encoding.
+        :param user_ids: optional Ids of existing users to change, one for each encoding, None to add new users.
+        :return: the list of the Ids of the users.
+        """
+        rows = np.ascontiguousarray(encodings, dtype=ENCODING_DTYPE).reshape(-1, ENCODING_SIZE)
+        names = list(names)
+        user_ids = list(user_ids) if user_ids is not None else [None] * len(names)
+        if len(names) != len(rows) or len(user_ids) != len(rows):
+            raise ValueError("The number of names and Ids must match the number of encodings")
+
+        with self.__append_lock:
+            self.__create()
+            with open(self.__names_path, "r+b") as names_file:
+                self.__lock_file(names_file)
+                count = self.__repair(names_file)
+
+                # Write the encodings first, and the names log lines only once the encodings are on disk
+                with open(self.__encodings_path, "ab") as encodings_file:
+                    encodings_file.write(rows.tobytes())
+                    self.__sync(encodings_file)
+
+                # A new user gets the index of its record as Id, which no other record can have
+                user_ids = [count + i if user_id is None else user_id for i, user_id in enumerate(user_ids)]
+                names_file.seek(0, os.SEEK_END)
+                names_file.write(b"".join(self.__encode_record(user_id, name)
+                                          for user_id, name in zip(user_ids, names)))
+                self.__sync(names_file)
+                self.__validated = (self.__validated[0], count + len(rows), names_file.tell())
+        return user_ids
+
+    def migrate_json(self, json_path):
+        """
+        Creates the store from the JSON file used by the previous versions of ImageRecognizer.
+        The new files are written aside and moved in place at the end, so an interrupted migration can be repeated.
+
+        :param json_path: path of the JSON file, e.g. "registered_user.json".
+        :return: the number of migrated users.
+        """
+        with open(json_path, 'r') as file:
+            users = json.load(file)
+
+        encodings = np.array([user["encoding"] for user in users], dtype=ENCODING_DTYPE).reshape(-1, ENCODING_SIZE)
+        encodings_tmp = self.__encodings_path + ".tmp"
+        names_tmp = self.__names_path + ".tmp"
+
+        with open(encodings_tmp, "wb") as encodings_file:
+            encodings_file.write(self.__encode_header(self.__new_id()))
+            encodings_file.write(encodings.tobytes())
+            self.__sync(encodings_file)
+        with open(names_tmp, "wb") as names_file:
+            for i, user in enumerate(users):
+                names_file.write(self.__encode_record(i, user["name"]))
+            self.__sync(names_file)
+
+        # The names log is moved last: until then the store does not exist
+        os.replace(encodings_tmp, self.__encodings_path)
+        os.replace(names_tmp, self.__names_path)
+        return len(users)
+
+    def __create(self):
+        """
+        Creates the empty store files, if they don't exist yet.
+        """
+        if not os.path.exists(self.__encodings_path):
+            with open(self.__encodings_path, "xb") as encodings_file:
+                encodings_file.write(self.__encode_header(self.__new_id()))
+                self.__sync(encodings_file)
+        if not os.path.exists(self.__names_path):
+            open(self.__names_path, "xb").close()
+
+    def __repair(self, names_file):
+        """
+        Cuts away the torn tail left by an interrupted append. Must be called holding the file lock.
+        Complete records are never removed, so only the records appended since the last validation are checked, as
+        long as the files have not been replaced.
+
+        :param names_file: names log opened in read/write mode.
+        :return: the number of users in the store.
+        """
+        identity = self.identity()
+        start, offset = 0, 0
+        if self.__validated is not None and self.__validated[0] == identity:
+            start, offset = self.__validated[1:]
+        records, line_ends = self.__read_names(offset)
+        count = min(start + len(records), self.__count_rows())
+        if count < start:   # Files cut by someone else: validate them again from the beginning
+            self.__validated = None
+            return self.__repair(names_file)
+
+        # Drop the log lines without an encoding and the partial last line
+        offset = line_ends[count - start - 1] if count > start else offset
+        names_file.truncate(offset)
+
+        # Drop the encodings without a log line and the partial last row
+        if os.path.getsize(self.__encodings_path) > HEADER_SIZE + count * ROW_SIZE:
+            os.truncate(self.__encodings_path, HEADER_SIZE + count * ROW_SIZE)
+        self.__validated = (identity, count, offset)
+        return count
+
+    def __read_names(self, offset=0):
+        """
+        Reads the complete lines of the names log.
+
+        :param offset: position in bytes where to start reading, at the beginning of a line.
+        :return: a tuple containing the list of records and the offset in bytes of the end of each line.
+        """
+        with open(self.__names_path, "rb") as names_file:
+            names_file.seek(offset)
+            data = names_file.read()
+
+        records = []
+        line_ends = []
+        for line in data.split(b"\n")[:-1]:     # The last piece is empty, or a line still being written
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                break
+            offset += len(line) + 1
+            line_ends.append(offset)
+        return records, line_ends
+
+    def __count_rows(self):
+        """
+        :return: the number of complete rows in the encodings file.
+        """
+        return max(os.path.getsize(self.__encodings_path) - HEADER_SIZE, 0) // ROW_SIZE
+
+    def __map_encodings(self, start, count):
+        """
+        Maps consecutive rows of the encodings file in memory.
+
+        :param start: index of the first row to map.
+        :param count: number of rows to map.
+        :return: a read-only (count x ENCODING_SIZE) matrix.
+        """
+        with open(self.__encodings_path, "rb") as encodings_file:
+            if encodings_file.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{self.__encodings_path} is not a gallery encodings file")
+        if count <= 0:
+            return np.empty((0, ENCODING_SIZE), dtype=ENCODING_DTYPE)
+        return np.memmap(self.__encodings_path, dtype=ENCODING_DTYPE, mode="r", offset=HEADER_SIZE + start * ROW_SIZE,
+                         shape=(count, ENCODING_SIZE))
+
+    @staticmethod
+    def __new_id():
+        """
+        :return: a random store ID, never 0.
+        """
+        return int.from_bytes(os.urandom(4), "little") or 1
+
+    @staticmethod
+    def __encode_header(store_id):
+        """
+        :param store_id: ID of the store.
+        :return: the header of the encodings file.
+        """
+        return MAGIC + np.array([ENCODING_SIZE, store_id], dtype="<u4").tobytes()
+
+    @staticmethod
+    def __encode_record(user_id, name):
+        """
+        :param user_id: Id of the user.
+        :param name: ID or name of the user.
+        :return: the line of the names log for the user.
+        """
+        return (json.dumps({"Id": int(user_id), "name": name}) + "\n").encode("utf-8")
+
+    @staticmethod
+    def __lock_file(file):
+        """
+        Locks the file against the other processes until it is closed, where supported.
+
+        :param file: file to lock.
+        """
+        if fcntl is not None:
+            fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+
+    @staticmethod
+    def __sync(file):
+        """
+        Forces the written data of the file to disk.
+
+        :param file: file to sync.
+        """
+        file.flush()
+        os.fsync(file.fileno())
@@ -1,117 +1,448 @@
-import json
-import face_recognition
-import cv2
-import numpy as np
+import importlib
+import logging
+import os
 import threading
+import dlib
+import numpy as np
+import logic
+from AnnIndex import AnnIndex
+from FaceGallery import FaceGallery
+from GalleryStore import GalleryStore
+from FrameContext import FrameContext
+from LazyModel import LazyModel
+from EnrollmentQueue import EnrollmentQueue
+import profiler
+import startup
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Variables
+# ----------------------------------------------------------------------------------------------------------------------
+# face_recognition loads its neural networks when it is imported, so it is imported only when first needed
+face_recognition = LazyModel("face encoder", lambda: importlib.import_module("face_recognition"))
+WARM_UP_SIZE = (120, 160)   # Size of the blank frame used to warm up the face encoder
+ANN_MIN_SIZE = 10000        # Number of registered users from which the approximate index is used automatically
+ANN_MIN_TRAIN = 256         # Minimum number of registered users needed to train the approximate index
+ANN_LISTS_FACTOR = 4        # Number of coarse lists of the approximate index, per square root of the users
+WATCH_INTERVAL = 1.0        # Seconds between two checks of the gallery store for records written by other processes
+STORE_PATH = "registered_user"          # Path of the default gallery store, without extension
+JSON_PATH = "registered_user.json"      # Path of the JSON file of the previous versions, migrated by migrate()
+
+logger = logging.getLogger(__name__)
+
 
 # Class that tries to recognize the user's face from a frame in BGR encoding
 class ImageRecognizer:
     # Fields and methods of the class
-    __known_faces = []  # Array of known faces
-    __known_names = []  # Array of known names
-    __file_path = "registered_user.json"    # JSON file path
-    __name_string = "Write your name: "     # String for user's name 
+    __gallery = None    # Gallery of known faces and names
+    __store = None      # Gallery store
     __username = ""     # User's name
-    __data_lock = threading.Lock()     # Data lock
+    __data_lock = threading.Lock()     # Lock held while new users are written to the store and merged in the gallery
+    __encoding_lock = threading.Lock()     # Lock serializing the face encoder, which is not thread-safe
+    __store_position = None     # Position in the store (records read, offset in the names log), None if not followed
+    __store_identity = None     # Identity of the store files the gallery has been loaded from
+    __saved_index_size = 0      # Number of faces held by the approximate index when it was last saved
+    __row_of_id = None          # Gallery index of the current face of each user Id read from the store
+    __refresh_lock = None       # Lock serializing the merges of the store into the gallery
+    __approximate = None        # Whether the gallery is searched with an approximate index
+    __watcher = None            # Thread that merges the store periodically, None if not watching
+    __stop_watching = None      # Event that stops the watcher thread
+    __enrollment = None         # Queue of the unknown faces waiting for a name, None if the recognizer never registers
 
     # Builder method
-    def __init__(self):
-        self.__known_faces, self.__known_names = self.__generate_images_array()
+    def __init__(self, load_async=False, approximate=None, gallery=None, watch=False, on_pending=None,
+                 store_path=STORE_PATH):
+        """
+        :param load_async: True to load the face encoder in a background thread while the gallery is loaded,
+                           otherwise it is loaded when the first face is encoded.
+        :param approximate: True to search the gallery with an approximate index, False to always search the whole
+                            gallery, None to use the index only from ANN_MIN_SIZE registered users.
+        :param gallery: optional FaceGallery to use instead of loading the gallery store, e.g. a gallery shared
+                        between processes; such a recognizer should only identify faces, never register them.
+        :param watch: True to merge in background, every WATCH_INTERVAL seconds, the users registered in the gallery
+                      store by other processes; refresh() can be called instead to merge them on demand.
+        :param on_pending: optional function called with the ID of each unknown face once it waits for a name, which
+                           is then given through the enrollment queue.
+        :param store_path: path of the gallery store, without extension; the JSON file of the previous versions is
+                           never migrated here, but by migrate().
+        """
+        if load_async:
+            face_recognition.load_async()
+        self.__store = GalleryStore(store_path)
+        self.__refresh_lock = threading.Lock()
+        if gallery is not None:
+            self.__gallery = gallery
+            return
+        self.__approximate = approximate
+        self.__gallery = self.__generate_gallery()
+        self.__enrollment = EnrollmentQueue(self.__save_faces, on_pending)
+        if watch:
+            self.watch()
+
+    @staticmethod
+    def migrate(store_path=STORE_PATH, json_path=JSON_PATH):
+        """
+        Creates the gallery store from the JSON file used by the previous versions, if the store doesn't exist yet.
+
+        :param store_path: path of the gallery store, without extension.
+        :param json_path: path of the JSON file.
+        :return: the number of migrated users, 0 if there was nothing to migrate.
+        """
+        store = GalleryStore(store_path)
+        if store.exists() or not os.path.exists(json_path):
+            return 0
+        return store.migrate_json(json_path)
+
+    @staticmethod
+    def build_index(store_path=STORE_PATH):
+        """
+        Brings the approximate index of a large gallery store up to date on disk, training or completing it if needed,
+        so that several processes loading the same gallery afterwards don't do it each. The store itself is only read.
+
+        :param store_path: path of the gallery store, without extension.
+        :return: the path of the index file, None if the gallery is searched without an index.
+        """
+        store = GalleryStore(store_path)
+        identity = store.identity()
+        encodings, _, names, _, _ = store.read()
+        if identity is None or len(names) < ANN_MIN_SIZE:
+            return None
+        gallery = FaceGallery(encodings, names, capacity=len(names))
+        index = ImageRecognizer.__prepare_index(store.index_path, gallery, identity[0])
+        return store.index_path if index is not None else None
+
+    @property
+    def enrollment(self):
+        """
+        :return: the EnrollmentQueue of the unknown faces, through which their names are given.
+        """
+        return self.__enrollment
+
+    def __len__(self):
+        """
+        :return: the number of faces in the gallery, including the faces replaced by newer ones.
+        """
+        return len(self.__gallery)
+
+    def refresh(self):
+        """
+        Merges in the gallery the records appended to the gallery store since the last merge, e.g. by another
+        process: only the new records are read, and the faces they replace are retired.
+        The gallery is never reloaded while the store keeps growing, and the recognitions running meanwhile keep
+        matching, against the gallery either before or after the merge.
+        If the store has been replaced by another one, recognized by its identity, or has been truncated, a new
+        gallery is loaded and swapped in a single assignment.
+
+        :return: the number of records merged, or the number of faces of the new gallery when it has been reloaded.
+        """
+        if self.__store_position is None:   # Gallery not loaded from the store
+            return 0
+
+        with self.__refresh_lock:
+            count, offset = self.__store_position
+            size = self.__store.size()
+            if self.__store.identity() != self.__store_identity or size < offset:
+                self.__gallery = self.__generate_gallery()
+                return len(self.__gallery)
+            if size == offset:
+                return 0
+
+            encodings, ids, names, count, offset = self.__store.read(count, offset)
+            if len(ids) > 0:
+                self.__merge(encodings, ids, names)
+            self.__store_position = (count, offset)
+        return len(ids)
+
+    def watch(self, interval=WATCH_INTERVAL):
+        """
+        Starts a background thread that merges the gallery store into the gallery every interval seconds.
+
+        :param interval: seconds between two merges.
+        """
+        if self.__watcher is not None or self.__store_position is None:
+            return
+        self.__stop_watching = threading.Event()
+        self.__watcher = threading.Thread(target=self.__watch, args=(interval, self.__stop_watching),
+                                          name="gallery watcher", daemon=True)
+        self.__watcher.start()
+
+    def stop_watching(self):
+        """
+        Stops the background thread started by watch(), if any.
+        """
+        if self.__watcher is None:
+            return
+        self.__stop_watching.set()
+        self.__watcher.join()
+        self.__watcher = None
+
+    def save_index(self):
+        """
+        Saves the approximate index of the gallery, if faces have been added to it since it was last saved, so that
+        the next start doesn't add them again.
+
+        :return: True if the index has been saved.
+        """
+        gallery, identity = self.__gallery, self.__store_identity
+        index = gallery.index
+        if index is None or identity is None or len(index) == self.__saved_index_size:
+            return False
+        size = len(index)
+        index.save(self.__store.index_path, identity[0])
+        self.__saved_index_size = size
+        return True
+
+    def close(self):
+        """
+        Stops the watcher thread, registers the faces already named and saves the approximate index.
+        """
+        self.stop_watching()
+        if self.__enrollment is not None:
+            self.__enrollment.close()
+        self.save_index()
+
+    def warm_up(self):
+        """
+        Waits for the face encoder to be loaded and runs it once on a blank frame, so that the first real face
+        doesn't pay for its first-call allocations.
+        """
+        height, width = WARM_UP_SIZE
+        image = np.zeros((height, width, 3), dtype=np.uint8)
+        with self.__encoding_lock:
+            face_recognition.get().face_encodings(image, [(0, width - 1, height - 1, 0)])
  
-    def __generate_images_array(self):
+    def __generate_gallery(self):
         """
-        Loads known face encodings and names from a JSON file.
-        :return: A tuple containing the list of known face encodings and the list of known names.
+        Loads known face encodings and names from the gallery store.
+        :return: the gallery of the current faces of the users, with its approximate index when it is used.
         """
-        face_encodings = []
-        face_names = []
-        
-        with open(self.__file_path, 'r') as file:
-            users = json.load(file)
-        
-        for user in users:
-            face_encodings.append(np.array(user["encoding"]))
-            face_names.append(user["name"])
-        
-        return face_encodings, face_names
+        with startup.phase("load gallery"):
+            # The identity is read first: a store replaced while it is being read is loaded again at the next refresh
+            identity = self.__store.identity()
+            encodings, ids, names, count, offset = self.__store.read()
+            gallery = FaceGallery(encodings, names)
+            self.__row_of_id = {}
+            gallery.retire(self.__update_rows(ids, 0))
+
+        if self.__approximate or (self.__approximate is None and len(gallery) >= ANN_MIN_SIZE):
+            with startup.phase("load index"):
+                self.__load_index(gallery, identity[0] if identity is not None else None)
+        self.__store_position = (count, offset)
+        self.__store_identity = identity
+        return gallery
 
-    def __save_face(self, face_encoding, name_id):
+    def __merge(self, encodings, ids, names):
         """
-        Saves the face encoding and name in a JSON file for all registered users.
+        Merges new records of the gallery store in the gallery, keeping gallery index i equal to store row i.
+        The new faces are published before the faces they replace are retired, so that a changed user is never
+        missing from the gallery.
 
-        :param face_encoding: encoding of the user's face
-        :param name_id: ID or name of the user
+        :param encodings: encodings of the new records.
+        :param ids: user Ids of the new records.
+        :param names: names of the new records.
         """
-        res = []
-        json_file = open(self.__file_path, "w")
+        start = len(self.__gallery)
+        self.__gallery.extend(encodings, names)
+        self.__gallery.retire(self.__update_rows(ids, start))
 
-        # Append the new face encoding and name to the known faces list
-        self.__known_faces.append(face_encoding[0])
-        self.__known_names.append(name_id)
+    def __update_rows(self, ids, start):
+        """
+        Records the gallery index of the current face of each user.
 
-        # Create the JSON representation for each user
-        for user in zip(np.arange(len(self.__known_names), dtype=int), self.__known_names, self.__known_faces):
-            res.append({"Id": int(user[0]), "name": user[1], "encoding": user[2].tolist()})
+        :param ids: user Ids of consecutive records.
+        :param start: gallery index of the first record.
+        :return: the list of the gallery indices whose faces have been replaced by the records.
+        """
+        replaced = []
+        for row, user_id in enumerate(ids, start):
+            previous = self.__row_of_id.get(user_id)
+            if previous is not None:
+                replaced.append(previous)
+            self.__row_of_id[user_id] = row
+        return replaced
 
-        # Write the JSON data to the file
-        json.dump(res, json_file)
-        json_file.close()
+    def __watch(self, interval, stop):
+        """
+        Merges the gallery store into the gallery every interval seconds, until stopped.
 
-    def __sign_in(self, face_encoding):
+        :param interval: seconds between two merges.
+        :param stop: event that stops the thread.
         """
-        Signs in a user, asking for its name, and saving the face encoding and name in a JSON file.
+        while not stop.wait(interval):
+            try:
+                self.refresh()
+            except (OSError, ValueError):   # Store being replaced, retried at the next interval
+                logger.warning("Cannot refresh the gallery, retrying in %.1f seconds", interval, exc_info=True)
+
+    def __load_index(self, gallery, store_id):
+        """
+        Attaches the approximate index to the gallery, reading it from the disk or training it the first time.
+        The users registered after the index was saved are added to it, and the index is saved again.
+
+        :param gallery: gallery loaded from the store.
+        :param store_id: ID of the store the gallery has been loaded from.
+        """
+        if self.__prepare_index(self.__store.index_path, gallery, store_id) is not None:
+            self.__saved_index_size = len(gallery.index)
+
+    @staticmethod
+    def __prepare_index(index_path, gallery, store_id):
+        """
+        Attaches to the gallery the approximate index saved for its store, or trains a new one, and saves it when it
+        has changed.
+
+        :param index_path: path of the index file.
+        :param gallery: gallery loaded from the store.
+        :param store_id: ID of the store the gallery has been loaded from.
+        :return: the index, None if the gallery is too small to train one.
+        """
+        count = len(gallery)
+        index = None
+        if os.path.exists(index_path):
+            index = AnnIndex.load(index_path)
+            if index.store_id != store_id or len(index) > count:    # Saved for a different store
+                index = None
+        if index is None:
+            if count < ANN_MIN_TRAIN:
+                return None
+            index = AnnIndex(int(ANN_LISTS_FACTOR * np.sqrt(count)))
+            index.train(gallery.encodings)
+
+        saved_count = len(index)
+        gallery.set_index(index)
+        if len(index) != saved_count or index.store_id != store_id:
+            index.save(index_path, store_id)
+        return index
 
-        :param face_encoding: encoding of the user's face
+    def __save_faces(self, face_encodings, names_ids):
         """
+        Saves several face encodings and names in the gallery store at once, writing only the new users.
+
+        :param face_encodings: encodings of the users' faces
+        :param names_ids: IDs or names of the users
+        :return: the list of the Ids of the new users
+        """
+        # Append the new face encodings and names to the store first, and merge them in the gallery once they are on
+        # disk, together with the users registered meanwhile by other processes. The recognitions running meanwhile
+        # keep matching against the gallery, which is never locked.
         with self.__data_lock:
-            # Ask for the user's name
-            self.__username = input(self.__name_string)
+            user_ids = self.__store.extend(face_encodings, names_ids)
+            self.refresh()
+        profiler.count("enrollments", len(user_ids))
+        return user_ids
+
+    def __encode_face(self, frame, face_bounding_box, landmarks=None):
+        """
+        Computes the encoding of the user's face.
+        :param frame: frame containing the user's face in BGR encoding, or its FrameContext.
+        :param face_bounding_box: bounding box of the user's face (top, right, bottom, left).
+        :param landmarks: optional landmarks of the face already found by logic.face_landmarks_detector(), as a
+                          (68, 2) array or as a dlib.full_object_detection; when given, the descriptor is computed
+                          from them, without running the landmarks model of face_recognition again.
+        :return: a list containing the encoding of the user's face.
+        """
+        # Convert frame to RGB, once for the whole frame when a FrameContext is given
+        small_frame = FrameContext.of(frame).rgb
+
+        if landmarks is None:
+            # Get face encoding, finding the landmarks of the face again
+            with self.__encoding_lock, profiler.span("encoding"):
+                return face_recognition.get().face_encodings(small_frame, list([face_bounding_box]))
+
+        if not isinstance(landmarks, dlib.full_object_detection):
+            top, right, bottom, left = face_bounding_box
+            landmarks = logic.array_to_shape(landmarks, dlib.rectangle(left, top, right, bottom))
+
+        # Get face encoding from the given landmarks
+        with self.__encoding_lock, profiler.span("encoding"):
+            face_encoder = face_recognition.get().api.face_encoder
+            return [np.array(face_encoder.compute_face_descriptor(small_frame, landmarks))]
+
+    def identify_face(self, frame, face_bounding_box, landmarks=None):
+        """
+        Tries to recognize the user's face, without ever asking an unknown user to sign in.
+        :param frame: frame containing the user's face in BGR encoding, or its FrameContext.
+        :param face_bounding_box: bounding box of the user's face (top, right, bottom, left).
+        :param landmarks: optional landmarks of the face, (68, 2) array or dlib.full_object_detection.
+        :return: the user's name if recognized, otherwise an empty string.
+        """
+        face_encoding = self.__encode_face(frame, face_bounding_box, landmarks)
+        with profiler.span("matching"):
+            return self.__gallery.match(face_encoding[0])
+
+    def identify_faces(self, faces):
+        """
+        Tries to recognize several faces at once, possibly of different frames: their encodings are computed by a
+        single call of the face encoder, and matched against the gallery in a single vectorized pass.
+        :param faces: list of (frame or FrameContext, bounding box, landmarks) tuples, where the landmarks can be None.
+        :return: the list of the users' names, with an empty string for each face not recognized.
+        """
+        if len(faces) == 0:
+            return []
 
-            # Save the face encoding and name in a JSON file for all registered users
-            self.__save_face(face_encoding, self.__username)
+        # Grouping the faces by frame, which is converted to RGB once
+        contexts, shapes, order = {}, {}, []
+        for frame, face_bounding_box, landmarks in faces:
+            context = FrameContext.of(frame)
+            top, right, bottom, left = face_bounding_box
+            face = dlib.rectangle(left, top, right, bottom)
+            if landmarks is None:
+                landmarks = logic.face_landmarks_detector(context, face)
+            if not isinstance(landmarks, dlib.full_object_detection):
+                landmarks = logic.array_to_shape(landmarks, face)
+            contexts[id(context)] = context
+            shapes.setdefault(id(context), dlib.full_object_detections()).append(landmarks)
+            order.append((id(context), len(shapes[id(context)]) - 1))
 
-        print("The user has been registered!")
+        # Get the face encodings of all the frames in one call
+        keys = list(contexts)
+        with self.__encoding_lock, profiler.span("encoding"):
+            face_encoder = face_recognition.get().api.face_encoder
+            descriptors = face_encoder.compute_face_descriptor([contexts[key].rgb for key in keys],
+                                                               [shapes[key] for key in keys])
+        descriptors = dict(zip(keys, descriptors))
+        face_encodings = np.array([descriptors[key][position] for key, position in order])
 
-    def __thread_sign_in(self, face_encoding):
+        with profiler.span("matching"):
+            return self.__gallery.match_batch(face_encodings)
+
+    def enroll_face(self, frame, face_bounding_box, name_id, landmarks=None):
         """
-        Starts a new thread that will sign in a user, asking for its name, and saving the face encoding and name in a JSON file.
-        :param face_encoding: encoding of the user's face
+        Registers a user from a face, without asking anything.
+        :param frame: frame containing the user's face in BGR encoding, or its FrameContext.
+        :param face_bounding_box: bounding box of the user's face (top, right, bottom, left).
+        :param name_id: ID or name of the user.
+        :param landmarks: optional landmarks of the face, (68, 2) array or dlib.full_object_detection.
+        :return: the Id of the new user.
         """
-        # Create a new thread that will sign in the user
-        thread = threading.Thread(target=self.__sign_in, args=(face_encoding, ))
-        # Start the thread
-        thread.start()
+        face_encoding = self.__encode_face(frame, face_bounding_box, landmarks)
+        return self.__save_faces(face_encoding, [name_id])[0]
 
-    def recognize_face(self, frame, face_bounding_box):
+    def recognize_face(self, frame, face_bounding_box, landmarks=None):
         """
         Tries to recognize the user's face.
-        :param frame: frame containing the user's face in BGR encoding.
-        :param face_bounding_box: bounding box of the user's face (x, y, w, h).
-        :return: the user's name if recognized, otherwise starts a thread to sign in the user.
+        :param frame: frame containing the user's face in BGR encoding, or its FrameContext.
+        :param face_bounding_box: bounding box of the user's face (top, right, bottom, left).
+        :param landmarks: optional landmarks of the face, (68, 2) array or dlib.full_object_detection.
+        :return: the user's name if recognized, otherwise an empty string, and the face waits for a name in the
+                 enrollment queue.
         """
-        # Convert frame to RGB
-        small_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-        
         # Get face encoding
-        face_encoding = face_recognition.face_encodings(small_frame, list([face_bounding_box]))
-
-        # Check if data lock is active
-        if self.__data_lock.locked():
-            return ""
-
-        # Check if known faces exist
-        if len(self.__known_faces) != 0:
-            # Compare face encodings
-            matches = face_recognition.compare_faces(self.__known_faces, face_encoding[0])
-            face_distances = face_recognition.face_distance(self.__known_faces, face_encoding[0])
-            best_match_index = np.argmin(face_distances)
-            
-            # Check if a match is found
-            if matches[best_match_index]:
-                self.__username = self.__known_names[best_match_index]
-                return self.__username
-
-        # User is not recognized, start a thread for sign-in
-        self.__thread_sign_in(face_encoding)
+        face_encoding = self.__encode_face(frame, face_bounding_box, landmarks)
+
+        # Compare the face encoding with the known faces, in a single pass over the gallery; the same gallery is used
+        # until the end, even if a new one is swapped in meanwhile
+        gallery = self.__gallery
+        with profiler.span("matching"):
+            best_match_index, best_match_distance = gallery.nearest(face_encoding[0])
+
+        # Check if a match is found
+        if best_match_index >= 0 and best_match_distance <= gallery.tolerance:
+            self.__username = gallery.name(best_match_index)
+            return self.__username
+
+        # User is not recognized: the face waits for a name, together with the other encodings of the same person
+        if self.__enrollment is not None:
+            self.__enrollment.offer(face_encoding[0])
+            profiler.count("enrollment_offers")
 
         return ""
@@ -0,0 +1,89 @@
+import threading
+import startup
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Variables
+# ----------------------------------------------------------------------------------------------------------------------
+LOAD_TIMEOUT = None         # Seconds waited for a model loading in background, None waits forever
+
+
+# Class that holds a model which is loaded only when it is first used, or in a background thread
+#
+# Loading a model at import time makes every import pay for it, even when the model is never used. A LazyModel
+# loads it at the first get(), or in background with load_async() while the program does something else (opening
+# the camera, loading the gallery): get() then waits only for what is left of the loading.
+class LazyModel:
+    # Fields and methods of the class
+    __name = ""             # Name of the model, used in the startup report
+    __loader = None         # Function that loads and returns the model
+    __model = None          # Loaded model, None until it is loaded
+    __error = None          # Exception raised by the loader, re-raised by get()
+    __loaded = None         # Event set once the model has been loaded or the loading failed
+    __lock = None           # Lock that makes the model loaded only once
+
+    # Builder method
+    def __init__(self, name, loader):
+        """
+        :param name: name of the model, used in the startup report.
+        :param loader: function that loads and returns the model.
+        """
+        self.__name = name
+        self.__loader = loader
+        self.__model = None
+        self.__error = None
+        self.__loaded = threading.Event()
+        self.__lock = threading.Lock()
+
+    @property
+    def name(self):
+        return self.__name
+
+    def is_loaded(self):
+        """
+        :return: True if the model has been loaded.
+        """
+        return self.__loaded.is_set() and self.__error is None
+
+    def load_async(self):
+        """
+        Starts loading the model in a background thread, if it is not loaded or loading yet.
+        """
+        if not self.__loaded.is_set() and not self.__lock.locked():
+            threading.Thread(target=self.__load, name="loader", daemon=True).start()
+
+    def get(self, timeout=LOAD_TIMEOUT):
+        """
+        Gets the model, loading it in the calling thread if nobody is loading it yet.
+
+        :param timeout: seconds to wait for a background loading, None waits forever.
+        :return: the loaded model.
+        """
+        if not self.__loaded.is_set():
+            self.__load()
+            if not self.__loaded.wait(timeout):
+                raise TimeoutError(f"The model {self.__name} is still loading")
+        if self.__error is not None:
+            raise self.__error
+        return self.__model
+
+    def __call__(self, *args, **kwargs):
+        """
+        Calls the model, loading it first if needed.
+        """
+        return self.get()(*args, **kwargs)
+
+    def __load(self):
+        """
+        Loads the model, unless another thread is already loading it.
+        """
+        if not self.__lock.acquire(blocking=False):
+            return
+        try:
+            if not self.__loaded.is_set():
+                with startup.phase(f"load {self.__name}"):
+                    self.__model = self.__loader()
+        except Exception as error:
+            self.__error = error
+        finally:
+            self.__loaded.set()
+            self.__lock.release()
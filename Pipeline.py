@@ -0,0 +1,178 @@
+import queue
+import threading
+import profiler
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Variables
+# ----------------------------------------------------------------------------------------------------------------------
+QUEUE_SIZE = 1          # Number of items kept between two stages, the oldest ones are dropped
+JOIN_TIMEOUT = 2        # Seconds waited for a stage to stop
+
+
+# Class that represents a bounded queue between two stages, where a new item replaces the oldest one when it is full
+class LatestQueue:
+    # Fields and methods of the class
+    __queue = None      # Underlying bounded queue
+    __lock = None       # Lock that makes the replacement of the oldest item atomic
+    dropped = 0         # Number of items dropped because stale
+
+    # Builder method
+    def __init__(self, maxsize=QUEUE_SIZE):
+        """
+        :param maxsize: maximum number of items kept in the queue.
+        """
+        self.__queue = queue.Queue(maxsize=maxsize)
+        self.__lock = threading.Lock()
+        self.dropped = 0
+
+    def put(self, item):
+        """
+        Puts an item in the queue without ever blocking, dropping the oldest item if the queue is full.
+
+        :param item: item to put.
+        :return: the number of items dropped to make room for the new one.
+        """
+        dropped = 0
+        with self.__lock:
+            while True:
+                try:
+                    self.__queue.put_nowait(item)
+                    self.dropped += dropped
+                    return dropped
+                except queue.Full:
+                    try:
+                        self.__queue.get_nowait()
+                        dropped += 1
+                    except queue.Empty:
+                        pass
+
+    def get(self, timeout=None):
+        """
+        Gets the oldest item of the queue.
+
+        :param timeout: seconds to wait for an item, None waits forever.
+        :return: the item, or None if no item arrived in time.
+        """
+        try:
+            return self.__queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+# Class that runs capture and processing of the frames in two threads, so that the stages don't wait for each other
+#
+# The capture thread always keeps the freshest frame, the processing thread takes only the latest one and the
+# display stage, run by the caller, takes only the latest processed frame: a slow stage makes the others drop the
+# stale frames instead of letting them pile up.
+class Pipeline:
+    # Fields and methods of the class
+    __capture = None        # Video capture object (cv2.VideoCapture)
+    __process = None        # Function that takes a frame and returns the processed result
+    __frames = None         # Queue between the capture and the processing stages
+    __results = None        # Queue between the processing and the display stages
+    __threads = []          # Threads of the capture and the processing stages
+    __stop_event = None     # Event set to stop the stages
+    __error = None          # Exception raised by a stage, re-raised to the caller
+
+    # Builder method
+    def __init__(self, capture, process, queue_size=QUEUE_SIZE):
+        """
+        :param capture: opened video capture object (cv2.VideoCapture).
+        :param process: function that takes a frame in BGR encoding and returns the result to display.
+        :param queue_size: number of items kept between two stages.
+        """
+        self.__capture = capture
+        self.__process = process
+        self.__frames = LatestQueue(queue_size)
+        self.__results = LatestQueue(queue_size)
+        self.__threads = []
+        self.__stop_event = threading.Event()
+        self.__error = None
+
+    @property
+    def dropped_frames(self):
+        """
+        :return: the number of captured frames that have not been processed because stale.
+        """
+        return self.__frames.dropped
+
+    @property
+    def dropped_results(self):
+        """
+        :return: the number of processed frames that have not been displayed because stale.
+        """
+        return self.__results.dropped
+
+    def start(self):
+        """
+        Starts the capture and the processing threads.
+        """
+        self.__threads = [threading.Thread(target=self.__run_stage, args=(self.__capture_stage, ), daemon=True),
+                          threading.Thread(target=self.__run_stage, args=(self.__processing_stage, ), daemon=True)]
+        for thread in self.__threads:
+            thread.start()
+
+    def is_running(self):
+        """
+        :return: True until the pipeline is stopped or the capture ends.
+        """
+        return not self.__stop_event.is_set()
+
+    def get(self, timeout=None):
+        """
+        Gets the latest processed result, to be called by the display stage.
+
+        :param timeout: seconds to wait for a result, None waits forever.
+        :return: the latest result, or None if no result arrived in time.
+        """
+        result = self.__results.get(timeout)
+        if self.__error is not None:
+            raise self.__error
+        return result
+
+    def stop(self):
+        """
+        Stops the stages and releases the video capture.
+        """
+        self.__stop_event.set()
+        for thread in self.__threads:
+            if thread is not threading.current_thread():
+                thread.join(JOIN_TIMEOUT)
+        self.__capture.release()
+
+    def __run_stage(self, stage):
+        """
+        Runs a stage, stopping the whole pipeline if it fails.
+
+        :param stage: function of the stage.
+        """
+        try:
+            stage()
+        except Exception as error:
+            self.__error = error
+            self.__stop_event.set()
+            self.__results.put(None)    # Wake up the display stage
+
+    def __capture_stage(self):
+        """
+        Reads the frames from the camera as fast as they come, keeping only the freshest one.
+        """
+        while not self.__stop_event.is_set() and self.__capture.isOpened():
+            with profiler.span("capture"):
+                ret, frame = self.__capture.read()
+            if not ret:
+                break
+            profiler.count("frames_dropped", self.__frames.put(frame))
+        self.__stop_event.set()
+        self.__frames.put(None)     # Wake up the processing stage
+
+    def __processing_stage(self):
+        """
+        Processes the latest captured frame, dropping the stale ones.
+        """
+        while not self.__stop_event.is_set():
+            frame = self.__frames.get()
+            if frame is None:
+                break
+            profiler.count("results_dropped", self.__results.put(self.__process(frame)))
+        self.__results.put(None)    # Wake up the display stage
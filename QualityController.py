@@ -0,0 +1,184 @@
+import collections
+import threading
+import time
+import profiler
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Variables
+# ----------------------------------------------------------------------------------------------------------------------
+TARGET_FPS = 30             # Frame rate held by default
+ADJUST_INTERVAL = 1.0       # Seconds of frames measured before each decision
+RECOVERY_RATIO = 0.6        # Fraction of the budget below which the frame cost leaves room for a better quality
+RECOVERY_WINDOWS = 3        # Number of consecutive intervals with room left before the quality is raised again
+HISTORY_SIZE = 20           # Number of decisions kept for decisions()
+FRAME_SPAN = profiler.FRAME_SPAN    # Span measuring the processing of a whole frame
+INTERVAL_FACTORS = (1, 1.5, 2, 3)   # Factors applied to the initial detection interval, from the best quality
+SCALE_FACTORS = (1, 0.75, 0.5)      # Factors applied to the initial detection scale, from the best quality
+RECHECK_FACTORS = (1, 2, 4)         # Factors applied to the initial recognition re-check interval
+
+
+# Class that adjusts the settings of the pipeline at runtime, to hold a target frame rate or latency budget
+#
+# The cost of each stage is read from the profiler spans recorded during the last interval. When the frames cost
+# more than the budget, the setting of the most expensive stage is lowered by one level: the detection interval and
+# scale for the "detection" span, the eye filtering for "gaze", the recognition re-check interval for "encoding".
+# When the frames have cost much less than the budget for a few intervals, the last lowered setting is raised again,
+# so the quality comes back in the reverse order it was given up.
+class QualityController:
+    # Fields and methods of the class
+    __knobs = []            # Adjustable settings: dictionaries with name, stage, values, current level and setter
+    __budget = 0.0          # Seconds a frame may cost
+    __target_fps = None     # Frame rate to hold, None if a latency budget is given instead
+    __lowered = []          # Names of the lowered settings, the last one is raised first
+    __history = None        # Latest decisions
+    __window_start = 0.0    # Time when the current measurement interval started
+    __headroom = 0          # Number of consecutive intervals with room left
+    __measures = {}         # Measures of the last interval
+    __lock = None           # Lock protecting the settings and the measures read by decisions()
+
+    # Builder method
+    def __init__(self, tracker=None, analyzer=None, recognition=None, target_fps=TARGET_FPS, latency_budget=None):
+        """
+        :param tracker: optional FaceTracker, whose detection interval and scale are adjusted.
+        :param analyzer: optional FaceAnalyzer, whose eye filtering is adjusted.
+        :param recognition: optional RecognitionWorker, whose re-check interval is adjusted.
+        :param target_fps: frame rate to hold.
+        :param latency_budget: seconds a frame may cost; when given, it replaces the budget of the target frame rate.
+        """
+        self.__knobs = []
+        if tracker is not None:
+            interval, scale = tracker.detection_interval, tracker.detection_scale
+            self.__add_knob("detection_interval", "detection",
+                            [round(interval * factor) for factor in INTERVAL_FACTORS],
+                            lambda value: setattr(tracker, "detection_interval", value))
+            self.__add_knob("detection_scale", "detection", [scale * factor for factor in SCALE_FACTORS],
+                            lambda value: setattr(tracker, "detection_scale", value))
+        if analyzer is not None:
+            self.__add_knob("eye_filtering", "gaze", [True, False],
+                            lambda value: setattr(analyzer, "eye_filtering", value))
+        if recognition is not None:
+            interval = recognition.recheck_interval
+            self.__add_knob("recheck_interval", "encoding", [interval * factor for factor in RECHECK_FACTORS],
+                            lambda value: setattr(recognition, "recheck_interval", value))
+
+        self.__target_fps = target_fps if latency_budget is None else None
+        self.__budget = latency_budget if latency_budget is not None else 1 / target_fps
+        self.__lowered = []
+        self.__history = collections.deque(maxlen=HISTORY_SIZE)
+        self.__window_start = time.perf_counter()
+        self.__headroom = 0
+        self.__measures = {}
+        self.__lock = threading.Lock()
+        profiler.enable()   # The stages are measured by the profiler spans
+
+    @property
+    def settings(self):
+        """
+        :return: a dictionary with the current value of each adjusted setting.
+        """
+        with self.__lock:
+            return {knob["name"]: knob["values"][knob["level"]] for knob in self.__knobs}
+
+    def decisions(self):
+        """
+        :return: a JSON serializable dictionary with the budget, the measures of the last interval (frame rate, cost of
+                 a frame and of each stage per frame), the current settings, the lowered ones and the latest changes.
+        """
+        settings = self.settings
+        with self.__lock:
+            return {"target_fps": self.__target_fps, "budget_ms": 1000 * self.__budget, **self.__measures,
+                    "settings": settings, "lowered": list(self.__lowered), "changes": list(self.__history)}
+
+    def update(self):
+        """
+        Called after each processed frame: once every ADJUST_INTERVAL seconds, it measures the interval and lowers or
+        raises one setting if needed. It must be called by the thread that uses the tracker.
+
+        :return: the (setting, value) pair changed, None if nothing has been changed.
+        """
+        now = time.perf_counter()
+        if now - self.__window_start < ADJUST_INTERVAL:
+            return None
+        spans = profiler.totals(self.__window_start)
+        elapsed = now - self.__window_start
+        self.__window_start = now
+        frames, frame_time = spans.get(FRAME_SPAN, (0, 0.0))
+        if frames == 0:
+            return None
+
+        frame_cost = frame_time / frames
+        stage_costs = {name: total / frames for name, (_, total) in spans.items() if name != FRAME_SPAN}
+        with self.__lock:
+            self.__measures = {"fps": frames / elapsed, "frame_ms": 1000 * frame_cost,
+                               "stage_ms": {name: 1000 * cost for name, cost in stage_costs.items()}}
+
+        if frame_cost > self.__budget:
+            self.__headroom = 0
+            return self.__lower(stage_costs, f"frame cost {1000 * frame_cost:.1f} ms over the budget")
+        if frame_cost < self.__budget * RECOVERY_RATIO:
+            self.__headroom += 1
+            if self.__headroom >= RECOVERY_WINDOWS:
+                self.__headroom = 0
+                return self.__raise(f"frame cost {1000 * frame_cost:.1f} ms leaves room")
+        else:
+            self.__headroom = 0
+        return None
+
+    def __add_knob(self, name, stage, values, setter):
+        """
+        Adds an adjustable setting, at its best quality level.
+
+        :param name: name of the setting.
+        :param stage: name of the profiler span whose cost the setting reduces.
+        :param values: values of the setting, from the best quality to the cheapest.
+        :param setter: function that applies a value of the setting.
+        """
+        self.__knobs.append({"name": name, "stage": stage, "values": values, "level": 0, "setter": setter})
+
+    def __lower(self, stage_costs, reason):
+        """
+        Lowers by one level the setting of the most expensive measured stage that can still be lowered.
+
+        :param stage_costs: cost of each stage per frame, in seconds.
+        :param reason: reason of the change, kept in the history.
+        :return: the (setting, value) pair changed, None if every setting of a measured stage is already at its
+                 cheapest level.
+        """
+        # A setting whose stage has not been measured cannot be shown to reduce the frame cost
+        knobs = [knob for knob in self.__knobs
+                 if knob["level"] < len(knob["values"]) - 1 and knob["stage"] in stage_costs]
+        if not knobs:
+            return None
+        # The first of the settings of the most expensive stage, as max() keeps the first maximum
+        knob = max(knobs, key=lambda knob: stage_costs[knob["stage"]])
+        self.__lowered.append(knob["name"])
+        return self.__apply(knob, knob["level"] + 1, reason)
+
+    def __raise(self, reason):
+        """
+        Raises by one level the last lowered setting.
+
+        :param reason: reason of the change, kept in the history.
+        :return: the (setting, value) pair changed, None if every setting is already at its best level.
+        """
+        if not self.__lowered:
+            return None
+        name = self.__lowered.pop()
+        knob = next(knob for knob in self.__knobs if knob["name"] == name)
+        return self.__apply(knob, knob["level"] - 1, reason)
+
+    def __apply(self, knob, level, reason):
+        """
+        Applies a level of a setting and records the decision.
+
+        :param knob: adjustable setting.
+        :param level: new level of the setting.
+        :param reason: reason of the change.
+        :return: the (setting, value) pair changed.
+        """
+        value = knob["values"][level]
+        knob["setter"](value)
+        with self.__lock:
+            knob["level"] = level
+            self.__history.append({"time": time.time(), "setting": knob["name"], "value": value, "reason": reason})
+        return knob["name"], value
@@ -0,0 +1,145 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from FrameContext import FrameContext
+import profiler
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Variables
+# ----------------------------------------------------------------------------------------------------------------------
+RECHECK_INTERVAL = 2        # Seconds after which the identity of a tracked face is verified again
+MAX_WORKERS = 1             # Number of threads computing the face encodings (the face encoder is serialized anyway)
+
+logger = logging.getLogger(__name__)
+
+
+# Class that holds the identity of a tracked face
+class Identity:
+    # Fields and methods of the class
+    name = None             # Name of the user, "" if not recognized, None while the first recognition is running
+    checked_at = 0.0        # Time of the last recognition request
+    future = None           # Future of the running recognition, None if no recognition is running
+    failed = False          # True if the last recognition raised an exception
+
+    # Builder method
+    def __init__(self):
+        self.name = None
+        self.checked_at = 0.0
+        self.future = None
+        self.failed = False
+
+
+# Class that recognizes the tracked faces in a background thread, caching the identity of each track
+#
+# The caller never waits for an encoding: it gets the cached names, while the recognitions of the new tracks and
+# the periodic verifications of the known ones run in background.
+class RecognitionWorker:
+    # Fields and methods of the class
+    __recognize = None      # Function that takes a frame, a bounding box and the landmarks and returns the name
+    __recheck_interval = RECHECK_INTERVAL   # Seconds after which an identity is verified again
+    __executor = None       # Thread pool running the recognitions
+    __identities = {}       # Identity of each track, by track ID
+    __lock = None           # Lock protecting the identities
+
+    # Builder method
+    def __init__(self, recognize, recheck_interval=RECHECK_INTERVAL, max_workers=MAX_WORKERS):
+        """
+        :param recognize: function that takes the frame, a bounding box (top, right, bottom, left) and the landmarks
+                          of the face (or None) and returns the name of the user, e.g. ImageRecognizer.recognize_face.
+        :param recheck_interval: seconds after which the identity of a tracked face is verified again.
+        :param max_workers: number of threads running the recognitions.
+        """
+        self.__recognize = recognize
+        self.__recheck_interval = recheck_interval
+        self.__executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.__identities = {}
+        self.__lock = threading.RLock()     # Reentrant: a callback runs at once if the recognition already ended
+
+    @property
+    def recheck_interval(self):
+        return self.__recheck_interval
+
+    @recheck_interval.setter
+    def recheck_interval(self, value):
+        self.__recheck_interval = value
+
+    def submit(self, image, bounding_box, landmarks=None):
+        """
+        Submits the recognition of a face to the background thread.
+
+        :param image: frame in BGR encoding, or its FrameContext.
+        :param bounding_box: bounding box of the face (top, right, bottom, left).
+        :param landmarks: optional landmarks of the face, so that the recognition doesn't find them again.
+        :return: the future of the recognition, whose result is the name of the user.
+        """
+        context = FrameContext.of(image)
+        context.rgb     # Convert the frame now: the caller may draw on it while the recognition is waiting
+        profiler.count("recognitions")
+        return self.__executor.submit(self.__recognize, context, bounding_box, landmarks)
+
+    def update(self, image, track_ids, bounding_boxes, landmarks=None):
+        """
+        Submits the recognition of the new tracks and of those to verify again, and evicts the tracks that
+        disappeared. It never waits for a recognition.
+
+        :param image: frame in BGR encoding, or its FrameContext.
+        :param track_ids: IDs of the tracks in the frame.
+        :param bounding_boxes: bounding box of each track (top, right, bottom, left).
+        :param landmarks: optional landmarks of each track, shared with the recognitions.
+        :return: the list with the cached name of each track (None while its first recognition is running).
+        """
+        now = time.monotonic()
+        landmarks = landmarks if landmarks is not None else [None] * len(track_ids)
+        with self.__lock:
+            # Evict the tracks that disappeared, their running recognitions are simply ignored
+            active = set(track_ids)
+            for track_id in [track_id for track_id in self.__identities if track_id not in active]:
+                del self.__identities[track_id]
+
+            for track_id, bounding_box, face_landmarks in zip(track_ids, bounding_boxes, landmarks):
+                identity = self.__identities.setdefault(track_id, Identity())
+                # A failed recognition is retried only after the re-check interval, not at every frame
+                if identity.future is None and ((identity.name is None and not identity.failed) or
+                                                now - identity.checked_at > self.__recheck_interval):
+                    identity.checked_at = now
+                    identity.future = self.submit(image, bounding_box, face_landmarks)
+                    identity.future.add_done_callback(
+                        lambda future, track_id=track_id: self.__resolve(track_id, future))
+
+            return [self.__identities[track_id].name for track_id in track_ids]
+
+    def name(self, track_id):
+        """
+        :param track_id: ID of a track.
+        :return: the cached name of the track, None if unknown.
+        """
+        with self.__lock:
+            identity = self.__identities.get(track_id)
+            return identity.name if identity is not None else None
+
+    def close(self):
+        """
+        Stops the background thread, without waiting for the running recognitions.
+        """
+        self.__executor.shutdown(wait=False)
+
+    def __resolve(self, track_id, future):
+        """
+        Stores the result of a recognition in the cache, if the track is still alive.
+
+        :param track_id: ID of the recognized track.
+        :param future: future of the completed recognition.
+        """
+        with self.__lock:
+            identity = self.__identities.get(track_id)
+            if identity is None or identity.future is not future:
+                return
+            identity.future = None
+            error = future.exception()
+            identity.failed = error is not None
+            if error is None:
+                identity.name = future.result()
+                return
+        profiler.count("recognition_errors")
+        logger.error("Cannot recognize the face of track %s", track_id, exc_info=error)
@@ -0,0 +1,147 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+import profiler
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Variables
+# ----------------------------------------------------------------------------------------------------------------------
+MAX_BATCH = 32              # Maximum number of requests processed by a single call
+MAX_WAIT = 0.005            # Seconds a request waits for others to join its batch
+
+
+# Class that coalesces the requests submitted concurrently by several threads into batched calls
+#
+# A request is never delayed by more than MAX_WAIT seconds: the first request of a batch waits at most that long
+# for the others, and the batch leaves as soon as it is full. When the process function is slow, the requests
+# submitted meanwhile queue up and leave together in the next batch, so the batches grow with the load.
+# When a batch fails, its requests are processed again one by one, so that the error only reaches the bad ones.
+class RequestBatcher:
+    # Fields and methods of the class
+    __process = None        # Function that takes a list of requests and returns the list of their results
+    __max_batch = MAX_BATCH     # Maximum number of requests of a batch
+    __max_wait = MAX_WAIT   # Seconds the first request of a batch waits for the others
+    __requests = None       # Queue of the (request, future) pairs waiting for a batch
+    __thread = None         # Thread processing the batches
+    __batches = 0           # Number of batches processed
+    __processed = 0         # Number of requests processed
+
+    # Builder method
+    def __init__(self, process, max_batch=MAX_BATCH, max_wait=MAX_WAIT, name="batcher"):
+        """
+        :param process: function that takes a list of requests and returns the list of their results, in order.
+        :param max_batch: maximum number of requests processed by a single call.
+        :param max_wait: seconds the first request of a batch waits for the others, 0 never waits.
+        :param name: name of the thread processing the batches, also used for its profiler span.
+        """
+        self.__process = process
+        self.__max_batch = max_batch
+        self.__max_wait = max_wait
+        self.__requests = queue.Queue()
+        self.__batches = 0
+        self.__processed = 0
+        self.__thread = threading.Thread(target=self.__run, name=name, daemon=True)
+        self.__thread.start()
+
+    @property
+    def batches(self):
+        return self.__batches
+
+    @property
+    def mean_batch_size(self):
+        """
+        :return: the mean number of requests of the processed batches, 0 if none has been processed yet.
+        """
+        return self.__processed / self.__batches if self.__batches > 0 else 0
+
+    def submit(self, request):
+        """
+        Submits a request, which is processed in the next batch.
+
+        :param request: request passed to the process function.
+        :return: a Future holding the result of the request.
+        """
+        future = Future()
+        self.__requests.put((request, future))
+        return future
+
+    def process(self, requests):
+        """
+        Submits several requests and waits for their results.
+
+        :param requests: list of requests.
+        :return: the list of their results, in order.
+        """
+        return [future.result() for future in [self.submit(request) for request in requests]]
+
+    def close(self):
+        """
+        Stops the thread once the requests already submitted have been processed.
+        """
+        self.__requests.put(None)
+        self.__thread.join()
+
+    def __next_batch(self):
+        """
+        Waits for a request, then collects the requests that arrive within max_wait seconds, up to max_batch.
+
+        :return: the list of the (request, future) pairs of the batch, None if the batcher has been closed.
+        """
+        first = self.__requests.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = time.perf_counter() + self.__max_wait
+        while len(batch) < self.__max_batch:
+            try:
+                # The requests already queued are taken without waiting, even after the deadline
+                pair = self.__requests.get(timeout=max(deadline - time.perf_counter(), 0))
+            except queue.Empty:
+                break
+            if pair is None:
+                self.__requests.put(None)   # Closing once this batch is done
+                break
+            batch.append(pair)
+        return batch
+
+    def __run(self):
+        """
+        Processes the batches until the batcher is closed.
+        """
+        while True:
+            batch = self.__next_batch()
+            if batch is None:
+                break
+            requests, futures = zip(*batch)
+            try:
+                with profiler.span(self.__thread.name):
+                    results = self.__process(list(requests))
+            except Exception as error:
+                if len(batch) == 1:
+                    futures[0].set_exception(error)
+                else:   # A bad request must not fail the others: each request is processed again on its own
+                    profiler.count(f"{self.__thread.name}_retries", len(batch))
+                    for request, future in batch:
+                        self.__process_alone(request, future)
+            else:
+                for future, result in zip(futures, results):
+                    future.set_result(result)
+            self.__batches += 1
+            self.__processed += len(batch)
+            profiler.count(f"{self.__thread.name}_requests", len(batch))
+
+    def __process_alone(self, request, future):
+        """
+        Processes a single request of a failed batch.
+
+        :param request: request passed to the process function.
+        :param future: Future holding the result of the request.
+        """
+        try:
+            with profiler.span(self.__thread.name):
+                result = self.__process([request])[0]
+        except Exception as error:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
@@ -0,0 +1,161 @@
+import argparse
+import json
+import logging
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+import frames
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Variables
+# ----------------------------------------------------------------------------------------------------------------------
+CHUNK_SIZE = 250            # Number of frames analyzed by a worker in a single task
+
+__analyzer = None           # Face analyzer of the worker process
+__recognizer = None         # Face recognizer of the worker process, None if recognition is disabled
+__detection_scale = 1       # Detection scale of the worker process
+
+logger = logging.getLogger(__name__)
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Worker functions
+# ----------------------------------------------------------------------------------------------------------------------
+def __init_worker(recognize, detection_scale, gallery_path):
+    """
+    Function run once in each worker process: it loads the models, so that they are shared by all the chunks.
+
+    :param recognize: True to identify the detected faces against the registered users
+    :param detection_scale: scale of the image searched by the face detector
+    :param gallery_path: path of the gallery store of the registered users, without extension
+    """
+    global __analyzer, __recognizer, __detection_scale
+    import logic
+    from FaceAnalyzer import FaceAnalyzer
+    logic.warm_up()  # Loads the landmarks predictor and the face detector
+    __analyzer = FaceAnalyzer(max_workers=1)  # The frames are already spread over the processes
+    __detection_scale = detection_scale
+    if recognize:
+        import ImageRecognizer as imgRec
+        __recognizer = imgRec.ImageRecognizer(load_async=True, store_path=gallery_path)
+        __recognizer.warm_up()
+
+def __analyze_frame(index, frame):
+    """
+    Function that detects the faces in a frame and analyzes each of them.
+
+    :param index: index of the frame
+    :param frame: frame in BGR encoding
+    :return: a dictionary with the results of the frame
+    """
+    import logic
+    from FrameContext import FrameContext
+
+    context = FrameContext(frame)
+    faces = logic.detect_faces(context, scale=__detection_scale)
+    identify = __recognizer.identify_face if __recognizer is not None else None
+    results = __analyzer.analyze(context, faces, identify=identify)
+    return {"frame": index, "faces": [result.to_dict() for result in results]}
+
+def __analyze_chunk(path, start, stop):
+    """
+    Function that analyzes a chunk of consecutive frames. A frame that cannot be read gets an error record, so that
+    the output keeps one line for each frame.
+
+    :param path: path of the video file or of the directory of images
+    :param start: index of the first frame of the chunk
+    :param stop: index of the frame where the chunk ends
+    :return: a tuple containing the list of the JSON lines of the frames and the index of the frame after the last
+             one read
+    """
+    lines = []
+    next_index = start
+    for index, frame in frames.read_frames(path, start, stop):
+        lines.extend(__unreadable_frames(path, next_index, index))
+        lines.append(json.dumps(__analyze_frame(index, frame)))
+        next_index = index + 1
+    return lines, next_index
+
+def __unreadable_frames(path, start, stop):
+    """
+    Function that logs the frames that cannot be read and returns their error records.
+
+    :param path: path of the video file or of the directory of images
+    :param start: index of the first unreadable frame
+    :param stop: index of the frame after the last unreadable one
+    :return: the list of the JSON lines of the frames
+    """
+    if start < stop:
+        logger.warning("Cannot read the frames %d-%d of %s", start, stop - 1, path)
+    return [json.dumps({"frame": index, "faces": [], "error": "unreadable frame"}) for index in range(start, stop)]
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Functions
+# ----------------------------------------------------------------------------------------------------------------------
+def run(path, output_path, workers=None, chunk_size=CHUNK_SIZE, recognize=False, detection_scale=1,
+        gallery_path=None):
+    """
+    Function that analyzes all the frames of a video file or of a directory of images with a pool of processes,
+    writing one JSON line for each frame, in order.
+
+    :param path: path of the video file or of the directory of images
+    :param output_path: path of the JSONL file where to write the results
+    :param workers: number of worker processes, None uses one for each CPU
+    :param chunk_size: number of frames analyzed by a worker in a single task
+    :param recognize: True to identify the detected faces against the registered users
+    :param detection_scale: scale of the image searched by the face detector
+    :param gallery_path: path of the gallery store of the registered users, without extension, None for the default
+                         one; it is only read, the JSON gallery of the previous versions is not migrated
+    :return: the number of analyzed frames
+    """
+    n_frames = frames.count_frames(path)
+    if n_frames > 0:
+        chunks = [(start, min(start + chunk_size, n_frames)) for start in range(0, n_frames, chunk_size)]
+    else:  # Unknown length: a single worker reads the whole video
+        chunks = [(0, None)]
+
+    if recognize:  # The approximate index of a large gallery is built once, before the workers load the gallery
+        import ImageRecognizer as imgRec
+        gallery_path = gallery_path or imgRec.STORE_PATH
+        imgRec.ImageRecognizer.build_index(gallery_path)
+
+    written = 0
+    with ProcessPoolExecutor(max_workers=workers, initializer=__init_worker,
+                             initargs=(recognize, detection_scale, gallery_path)) as executor, \
+            open(output_path, "w") as output:
+        # The results of the chunks are written in order, as soon as they are ready
+        starts, stops = zip(*chunks)
+        for chunk, (lines, next_index) in enumerate(executor.map(__analyze_chunk, [path] * len(chunks), starts, stops)):
+            # Only the last chunk may end early, when the frame count of the video is overestimated: the frames
+            # missing at the end of another chunk get error records, so that no frame index is left out
+            if chunk < len(chunks) - 1:
+                lines += __unreadable_frames(path, next_index, stops[chunk])
+            for line in lines:
+                output.write(line + "\n")
+            written += len(lines)
+            print(f"\rAnalyzed frames: {written}/{n_frames or '?'}", end="", file=sys.stderr)
+    print(file=sys.stderr)
+    return written
+
+def main():
+    """
+    This function parses the command line and analyzes the recorded frames without camera and window.
+    """
+    parser = argparse.ArgumentParser(description="Headless analysis of a video file or a directory of images.")
+    parser.add_argument("path", help="video file or directory of images to analyze")
+    parser.add_argument("-o", "--output", default=None, help="JSONL file where to write the results "
+                                                             "(default: <path>.jsonl)")
+    parser.add_argument("-w", "--workers", type=int, default=os.cpu_count(), help="number of worker processes")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE, help="number of frames for each worker task")
+    parser.add_argument("--recognize", action="store_true", help="identify the faces against the registered users")
+    parser.add_argument("--scale", type=float, default=1, help="scale of the image searched by the face detector")
+    parser.add_argument("--gallery", default=None, help="gallery store of the registered users, without extension "
+                                                        "(default: registered_user)")
+    args = parser.parse_args()
+
+    output_path = args.output or os.path.normpath(args.path) + ".jsonl"
+    run(args.path, output_path, args.workers, args.chunk_size, args.recognize, args.scale, args.gallery)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,425 @@
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+import cv2
+import dlib
+import numpy as np
+import logic
+import frames
+from FrameContext import FrameContext
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Variables
+# ----------------------------------------------------------------------------------------------------------------------
+FIXTURE_SEED = 0            # Seed of the synthetic fixtures, so that every run measures the same frames
+FRAME_SIZE = (480, 640)     # Size (height, width) of the synthetic frames
+N_EYE_FIXTURES = 500        # Number of synthetic frames with a pair of eyes
+BACKGROUND_RANGE = (120, 220)   # Range of the skin gray levels
+PUPIL_RANGE = (10, 60)      # Range of the pupil gray levels
+REFLECTION_VALUE = 250      # Gray level of the light reflections on the pupils
+N_CORPUS_FRAMES = 200       # Number of frames replayed through each stage
+STAGES = ["detect", "landmarks", "gaze", "recognize", "pipeline"]  # Stages measured by the suite
+FACE_STAGES = ["detect", "landmarks", "pipeline"]   # Stages that need a corpus with faces, the synthetic frames have none
+N_RECOGNIZE_USERS = 1000    # Number of synthetic registered users of the gallery searched by the recognition stage
+PERCENTILES = [50, 95, 99]  # Latency percentiles reported for each stage
+TOLERANCE = 0.2             # Relative degradation, with respect to the baseline, considered a regression
+N_GALLERY_USERS = 100000    # Number of synthetic registered users of the approximate search benchmark
+N_GALLERY_PROBES = 500      # Number of synthetic probe faces, half of them of registered users
+ENCODING_SPREAD = 0.1       # Standard deviation of the synthetic face encodings
+PROBE_NOISE = 0.03          # Standard deviation of the difference between two encodings of the same user
+N_PROBE_VALUES = [1, 2, 4, 8, 16, 32]   # Numbers of coarse lists searched, compared by the benchmark
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Fixtures
+# ----------------------------------------------------------------------------------------------------------------------
+def make_eye_fixtures(n_fixtures=N_EYE_FIXTURES, seed=FIXTURE_SEED):
+    """
+    Function that generates synthetic frames, each one with a pair of eyes whose pupils are in random positions,
+    some with light reflections, dark spots and noise.
+
+    :param n_fixtures: number of frames to generate
+    :param seed: seed of the random generator
+    :return: a list of (frame, [right_eye, left_eye]) tuples, with 6 landmarks for each eye
+    """
+    rng = np.random.default_rng(seed)
+    height, width = FRAME_SIZE
+    fixtures = []
+    for _ in range(n_fixtures):
+        frame = np.full((height, width, 3), rng.integers(*BACKGROUND_RANGE), dtype=np.uint8)
+        eyes = []
+        for _ in range(2):
+            # Eye size and position
+            eye_w = int(rng.integers(12, 60))
+            eye_h = int(eye_w * rng.uniform(0.3, 0.6))
+            x0, y0 = int(rng.integers(50, width - 140)), int(rng.integers(50, height - 80))
+
+            # Pupil, with an optional light reflection
+            center = (x0 + int(rng.uniform(0.1, 0.9) * eye_w), y0 + int(rng.uniform(0.2, 0.8) * eye_h))
+            radius = max(2, int(eye_h * rng.uniform(0.3, 0.7)))
+            cv2.circle(frame, center, radius, (int(rng.integers(*PUPIL_RANGE)), ) * 3, -1)
+            if rng.random() < 0.5:
+                cv2.circle(frame, (center[0] + 1, center[1] - 1), max(1, radius // 3), (REFLECTION_VALUE, ) * 3, -1)
+
+            # Dark spots (eyelashes) and noise
+            for _ in range(int(rng.integers(0, 4))):
+                spot = (x0 + int(rng.integers(0, eye_w)), y0 + int(rng.integers(0, eye_h)))
+                cv2.circle(frame, spot, int(rng.integers(1, 4)), (int(rng.integers(0, 80)), ) * 3, -1)
+            region = frame[y0:y0 + eye_h, x0:x0 + eye_w]
+            region[:] = np.clip(region + rng.normal(0, rng.uniform(0, 25), region.shape), 0, 255)
+
+            # Landmarks, in the order of the 68 points model
+            eyes.append([(x0, y0 + eye_h // 2), (x0 + eye_w // 3, y0), (x0 + 2 * eye_w // 3, y0),
+                         (x0 + eye_w, y0 + eye_h // 2), (x0 + 2 * eye_w // 3, y0 + eye_h),
+                         (x0 + eye_w // 3, y0 + eye_h)])
+        fixtures.append((frame, eyes))
+    return fixtures
+
+
+def make_gallery_fixtures(n_users=N_GALLERY_USERS, n_probes=N_GALLERY_PROBES, seed=FIXTURE_SEED):
+    """
+    Function that generates a synthetic gallery of face encodings and probe faces to look for in it: half of the
+    probes are new encodings of registered users, the others are unknown users.
+
+    :param n_users: number of registered users
+    :param n_probes: number of probe faces
+    :param seed: seed of the random generator
+    :return: a tuple containing the (n_users x 128) encodings and the (n_probes x 128) probes
+    """
+    random = np.random.default_rng(seed)
+    encodings = random.normal(0, ENCODING_SPREAD, (n_users, 128)).astype(np.float32)
+    known = encodings[random.choice(n_users, n_probes // 2, replace=False)]
+    probes = np.concatenate([known + random.normal(0, PROBE_NOISE, known.shape),
+                             random.normal(0, ENCODING_SPREAD, (n_probes - len(known), 128))]).astype(np.float32)
+    return encodings, probes
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Benchmarks
+# ----------------------------------------------------------------------------------------------------------------------
+def bench_gaze(fixtures, repeat=3):
+    """
+    Micro-benchmark that compares is_looking_at_cam(), called once for each eye, with are_looking_at_cam(), called
+    once for both eyes, counting the decisions where they disagree.
+
+    :param fixtures: list of (frame, eyes) tuples
+    :param repeat: number of times the fixtures are processed, the best time is kept
+    :return: a dictionary with the results
+    """
+    contexts = [(FrameContext(frame), eyes) for frame, eyes in fixtures]
+    for context, _ in contexts:
+        context.gray  # Convert the frames before timing, as the main loop shares the conversion between the stages
+
+    def run_reference():
+        return [[logic.is_looking_at_cam(context, eye) for eye in eyes] for context, eyes in contexts]
+
+    def run_batched():
+        return [logic.are_looking_at_cam(context, eyes) for context, eyes in contexts]
+
+    reference_seconds, reference = __best_time(run_reference, repeat)
+    batched_seconds, batched = __best_time(run_batched, repeat)
+    decisions = np.array(reference).ravel()
+    mismatches = int(np.sum(decisions != np.array(batched).ravel()))
+    return {
+        "frames": len(fixtures),
+        "looking_eyes": int(decisions.sum()),
+        "mismatches": mismatches,
+        "reference_us_per_frame": 1e6 * reference_seconds / len(fixtures),
+        "batched_us_per_frame": 1e6 * batched_seconds / len(fixtures),
+        "speedup": reference_seconds / batched_seconds,
+    }
+
+def bench_ann(encodings, probes, n_probe_values=N_PROBE_VALUES, repeat=3):
+    """
+    Benchmark that compares the exact search of the gallery with the approximate index, for several numbers of
+    coarse lists searched: the probes are looked for one at a time, as the recognizer does.
+
+    :param encodings: encodings of the registered users
+    :param probes: probe faces
+    :param n_probe_values: numbers of coarse lists searched
+    :param repeat: number of times the probes are looked for, the best time is kept
+    :return: a dictionary with the description of the index and, for the exact search and each number of lists,
+             the latency per probe, the recall of the nearest user (for the probes of registered users) and the
+             agreement of the match decisions
+    """
+    from AnnIndex import AnnIndex
+    from FaceGallery import FaceGallery
+
+    gallery = FaceGallery(encodings, range(len(encodings)), capacity=len(encodings))
+
+    def run():
+        return [gallery.nearest(probe) for probe in probes]
+
+    exact_seconds, exact = __best_time(run, repeat)
+    exact_indices = np.array([index for index, _ in exact])
+    known = np.arange(len(probes)) < len(probes) // 2   # The first half of the probes are registered users
+    exact_matches = np.array([distance <= gallery.tolerance for _, distance in exact])
+
+    start = time.perf_counter()
+    index = AnnIndex(int(4 * np.sqrt(len(encodings))))
+    index.train(encodings)
+    gallery.set_index(index)
+    build_seconds = time.perf_counter() - start
+
+    results = {
+        "users": len(encodings),
+        "probes": len(probes),
+        "lists": int(4 * np.sqrt(len(encodings))),
+        "build_s": build_seconds,
+        "searches": {"exact": {"us_per_probe": 1e6 * exact_seconds / len(probes), "recall": 1.0, "agreement": 1.0}},
+    }
+    for n_probe in n_probe_values:
+        index.n_probe = n_probe
+        seconds, approximate = __best_time(run, repeat)
+        indices = np.array([index for index, _ in approximate])
+        matches = np.array([distance <= gallery.tolerance for _, distance in approximate])
+        results["searches"][f"n_probe={n_probe}"] = {
+            "us_per_probe": 1e6 * seconds / len(probes),
+            "recall": float(np.mean(indices[known] == exact_indices[known])),
+            "agreement": float(np.mean(matches == exact_matches)),
+        }
+    return results
+
+def __best_time(function, repeat):
+    """
+    Function that runs a function several times, and returns its best time.
+
+    :param function: function to run, without parameters
+    :param repeat: number of runs
+    :return: a tuple containing the best time in seconds and the result of the function
+    """
+    best, result = float("inf"), None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+def load_corpus(path=None, n_frames=N_CORPUS_FRAMES):
+    """
+    Function that loads the frames replayed by the suite: the recorded frames of a video file or of a directory of
+    images, or the synthetic eye fixtures.
+
+    :param path: path of the video file or of the directory of images, None uses the synthetic fixtures
+    :param n_frames: maximum number of frames to load
+    :return: the list of the frames in BGR encoding
+    """
+    if path is None:
+        return [frame for frame, _ in make_eye_fixtures(n_frames)]
+    return [frame for _, frame in frames.read_frames(path, stop=n_frames)]
+
+def prepare_inputs(corpus):
+    """
+    Function that computes, out of the measures, the inputs of the stages that follow the detection: the faces of
+    each frame and their landmarks. When no face is detected in a frame, as in the synthetic fixtures, a box in the
+    middle of the frame is used, so that the following stages are still measured.
+
+    :param corpus: list of the frames in BGR encoding
+    :return: a list of (frame, face, landmarks) tuples
+    """
+    inputs = []
+    for frame in corpus:
+        faces = logic.detect_faces(frame)
+        if len(faces) > 0:
+            face = faces[0]
+        else:
+            height, width = frame.shape[:2]
+            face = dlib.rectangle(width // 4, height // 4, 3 * width // 4, 3 * height // 4)
+        inputs.append((frame, face, logic.face_landmarks_detector(frame, face)))
+    return inputs
+
+def make_stage(stage):
+    """
+    Function that returns the function processing a single frame through a stage, from the raw frame, so that the
+    measures include the color conversions each stage needs.
+
+    :param stage: name of the stage
+    :return: a function that takes an input tuple and processes it
+    """
+    if stage == "detect":
+        return lambda item: logic.detect_faces(FrameContext(item[0]))
+    if stage == "landmarks":
+        return lambda item: logic.face_landmarks_detector(FrameContext(item[0]), item[1])
+    if stage == "gaze":
+        return lambda item: logic.are_looking_at_cam(FrameContext(item[0]), [item[2][36:42], item[2][42:48]])
+    if stage == "recognize":
+        import ImageRecognizer as imgRec
+        from GalleryStore import GalleryStore
+        # A synthetic gallery in a temporary store, so that the measures don't depend on the registered users
+        directory = tempfile.TemporaryDirectory()
+        store_path = os.path.join(directory.name, "gallery")
+        encodings, _ = make_gallery_fixtures(N_RECOGNIZE_USERS, 0)
+        GalleryStore(store_path).extend(encodings, [f"user {i}" for i in range(len(encodings))])
+        recognizer = imgRec.ImageRecognizer(store_path=store_path)
+
+        def process(item, directory=directory):   # The store is removed with the function
+            return recognizer.identify_face(FrameContext(item[0]), (item[1].top(), item[1].right(),
+                                                                    item[1].bottom(), item[1].left()), item[2])
+        return process
+    if stage == "pipeline":
+        from FaceTracker import FaceTracker
+        from FaceAnalyzer import FaceAnalyzer
+        tracker = FaceTracker()
+        analyzer = FaceAnalyzer()
+
+        def process(item):
+            context = FrameContext(item[0])
+            tracks = tracker.update(context)
+            return analyzer.analyze(context, [track.face for track in tracks], [track.id for track in tracks])
+        return process
+    raise ValueError(f"Unknown stage: {stage}")
+
+def bench_stage(stage, inputs):
+    """
+    Function that replays all the inputs through a stage, measuring the latency of each frame and, in a second run,
+    the peak of the memory allocated by Python and NumPy.
+
+    :param stage: name of the stage
+    :param inputs: list of (frame, face, landmarks) tuples
+    :return: a dictionary with the results of the stage
+    """
+    process = make_stage(stage)
+    process(inputs[0])  # Warm-up
+
+    # Latency, without the overhead of the memory tracing
+    latencies = np.empty(len(inputs))
+    for i, item in enumerate(inputs):
+        start = time.perf_counter()
+        process(item)
+        latencies[i] = time.perf_counter() - start
+
+    # Peak memory
+    tracemalloc.start()
+    for item in inputs:
+        process(item)
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    results = {"frames": len(inputs), "fps": len(inputs) / latencies.sum()}
+    for percentile, value in zip(PERCENTILES, np.percentile(latencies, PERCENTILES)):
+        results[f"p{percentile}_ms"] = 1000 * value
+    results["peak_memory_kb"] = peak_memory / 1024
+    return results
+
+def run_suite(corpus_path=None, n_frames=N_CORPUS_FRAMES, stages=None):
+    """
+    Function that runs the benchmark suite over a fixed corpus of frames.
+
+    :param corpus_path: path of the video file or of the directory of images, None uses the synthetic fixtures
+    :param n_frames: maximum number of frames replayed through each stage
+    :param stages: list of the stages to measure, None for all the stages that can be measured on the corpus; the
+                   stages of FACE_STAGES need a corpus, as no face is found in the synthetic fixtures
+    :return: a dictionary with the description of the run and the results of each stage
+    """
+    if stages is None:
+        stages = STAGES if corpus_path is not None else [stage for stage in STAGES if stage not in FACE_STAGES]
+    elif corpus_path is None and any(stage in FACE_STAGES for stage in stages):
+        raise ValueError(f"The stages {', '.join(FACE_STAGES)} need a corpus with faces")
+    inputs = prepare_inputs(load_corpus(corpus_path, n_frames))
+    return {
+        "meta": {
+            "corpus": corpus_path or f"synthetic(seed={FIXTURE_SEED})",
+            "frames": len(inputs),
+            "frame_size": list(inputs[0][0].shape[:2]) if inputs else None,
+            "python": sys.version.split()[0],
+            "opencv": cv2.__version__,
+            "dlib": dlib.__version__,
+            "machine": platform.platform(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "stages": {stage: bench_stage(stage, inputs) for stage in stages},
+    }
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    """
+    Function that compares the results of a run with a stored baseline.
+
+    :param results: results of the run
+    :param baseline: results of the baseline run
+    :param tolerance: relative degradation considered a regression
+    :return: the list of the regressions found, as readable strings
+    """
+    regressions = []
+    for stage, stage_results in results["stages"].items():
+        reference = baseline.get("stages", {}).get(stage)
+        if reference is None:
+            continue
+        for key, value in stage_results.items():
+            if key not in reference or key == "frames":
+                continue
+            higher_is_better = key == "fps"
+            limit = reference[key] * (1 - tolerance if higher_is_better else 1 + tolerance)
+            if (value < limit) if higher_is_better else (value > limit):
+                regressions.append(f"{stage}.{key}: {value:.2f} (baseline {reference[key]:.2f})")
+    return regressions
+
+def main():
+    """
+    This function parses the command line and runs the requested benchmark.
+    """
+    parser = argparse.ArgumentParser(description="Benchmarks of the eye-tracking pipeline.")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+    gaze_parser = subparsers.add_parser("gaze", help="batched versus per-eye gaze analysis")
+    gaze_parser.add_argument("--fixtures", type=int, default=N_EYE_FIXTURES, help="number of synthetic frames")
+    gaze_parser.add_argument("--repeat", type=int, default=3, help="number of runs, the best one is kept")
+    ann_parser = subparsers.add_parser("ann", help="approximate versus exact search of a large gallery")
+    ann_parser.add_argument("--users", type=int, default=N_GALLERY_USERS, help="number of synthetic registered users")
+    ann_parser.add_argument("--probes", type=int, default=N_GALLERY_PROBES, help="number of synthetic probe faces")
+    ann_parser.add_argument("--n-probe", type=int, nargs="+", default=N_PROBE_VALUES,
+                            help="numbers of coarse lists searched")
+    ann_parser.add_argument("--repeat", type=int, default=3, help="number of runs, the best one is kept")
+    suite_parser = subparsers.add_parser("suite", help="throughput, latency and memory of each stage")
+    suite_parser.add_argument("--corpus", default=None, help="video file or directory of images to replay, needed by "
+                                                             "the stages " + ", ".join(FACE_STAGES) +
+                                                             " (default: synthetic frames)")
+    suite_parser.add_argument("--frames", type=int, default=N_CORPUS_FRAMES, help="number of frames to replay")
+    suite_parser.add_argument("--stages", nargs="+", choices=STAGES, default=None,
+                              help="stages to measure (default: all the stages measurable on the corpus)")
+    suite_parser.add_argument("-o", "--output", default=None, help="JSON file where to save the results")
+    suite_parser.add_argument("--baseline", default=None, help="JSON file of a previous run to compare with")
+    suite_parser.add_argument("--tolerance", type=float, default=TOLERANCE, help="relative degradation considered "
+                                                                                 "a regression")
+    args = parser.parse_args()
+
+    if args.benchmark == "gaze":
+        results = bench_gaze(make_eye_fixtures(args.fixtures), args.repeat)
+        for key, value in results.items():
+            print(f"{key:>24}: {value:.2f}" if isinstance(value, float) else f"{key:>24}: {value}")
+        if results["mismatches"] > 0:
+            raise SystemExit("are_looking_at_cam() and is_looking_at_cam() took different decisions")
+
+    if args.benchmark == "ann":
+        results = bench_ann(*make_gallery_fixtures(args.users, args.probes), args.n_probe, args.repeat)
+        print(f"{results['users']} users, {results['lists']} lists, index built in {results['build_s']:.1f} s")
+        print(f"{'search':>12} {'us/probe':>10} {'recall':>8} {'agreement':>10}")
+        for search, search_results in results["searches"].items():
+            print(f"{search:>12} {search_results['us_per_probe']:>10.1f} {search_results['recall']:>8.3f} "
+                  f"{search_results['agreement']:>10.3f}")
+
+    if args.benchmark == "suite":
+        if args.corpus is None and args.stages is not None and any(stage in FACE_STAGES for stage in args.stages):
+            suite_parser.error(f"--corpus is needed by the stages {', '.join(FACE_STAGES)}")
+        results = run_suite(args.corpus, args.frames, args.stages)
+        print(f"{'stage':>10} " + " ".join(f"{key:>14}" for key in next(iter(results["stages"].values()))))
+        for stage, stage_results in results["stages"].items():
+            print(f"{stage:>10} " + " ".join(f"{value:>14.2f}" for value in stage_results.values()))
+
+        if args.output is not None:
+            with open(args.output, "w") as file:
+                json.dump(results, file, indent=2)
+
+        if args.baseline is not None:
+            with open(args.baseline, "r") as file:
+                regressions = compare(results, json.load(file), args.tolerance)
+            for regression in regressions:
+                print(f"Regression: {regression}")
+            if regressions:
+                raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
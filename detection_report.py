@@ -0,0 +1,118 @@
+import argparse
+import json
+import time
+import numpy as np
+import logic
+import frames
+from FrameContext import FrameContext
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Variables
+# ----------------------------------------------------------------------------------------------------------------------
+DEFAULT_SCALES = [1, 0.75, 0.5, 0.35, 0.25]     # Detection scales compared by default
+MATCH_OVERLAP = 0.5                             # Minimum intersection over union to consider two faces the same
+REPORT_HEADER = f"{'scale':>6} {'ms/frame':>9} {'speedup':>8} {'recall':>7} {'precision':>10} {'mean IoU':>9}"
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Functions
+# ----------------------------------------------------------------------------------------------------------------------
+def __overlap(face1, face2):
+    """
+    Function that takes two faces and returns their intersection over union.
+
+    :param face1: first face
+    :param face2: second face
+    :return: the intersection over union of the two faces
+    """
+    intersection = face1.intersect(face2)
+    if intersection.is_empty():
+        return 0.0
+    return intersection.area() / (face1.area() + face2.area() - intersection.area())
+
+def __match(reference, detected):
+    """
+    Function that greedily matches the detected faces with the reference ones.
+
+    :param reference: faces detected at full resolution
+    :param detected: faces detected at the scale under test
+    :return: the list of the intersections over union of the matched pairs
+    """
+    overlaps = []
+    unmatched = list(detected)
+    for face in reference:
+        best = max(unmatched, key=lambda other: __overlap(face, other), default=None)
+        if best is not None and __overlap(face, best) >= MATCH_OVERLAP:
+            unmatched.remove(best)
+            overlaps.append(__overlap(face, best))
+    return overlaps
+
+def evaluate(path, scales, max_frames=None):
+    """
+    Function that runs the face detector at several scales on recorded frames, using the full resolution
+    detections as reference.
+
+    :param path: path of the video file or of the directory of images
+    :param scales: list of the detection scales to evaluate
+    :param max_frames: maximum number of frames to read, None reads them all
+    :return: a list with a dictionary of results for each scale
+    """
+    stats = {scale: {"seconds": 0.0, "reference": 0, "detected": 0, "overlaps": []} for scale in scales}
+    reference_seconds = 0.0
+    n_frames = 0
+
+    for _, frame in frames.read_frames(path, stop=max_frames):
+        n_frames += 1
+        context = FrameContext(frame)
+        context.gray  # Convert the frame before timing, as the main loop shares the conversion between the stages
+
+        start = time.perf_counter()
+        reference = logic.detect_faces(context)
+        reference_seconds += time.perf_counter() - start
+
+        for scale in scales:
+            start = time.perf_counter()
+            detected = logic.detect_faces(context, scale=scale)
+            stats[scale]["seconds"] += time.perf_counter() - start
+            stats[scale]["reference"] += len(reference)
+            stats[scale]["detected"] += len(detected)
+            stats[scale]["overlaps"] += __match(reference, detected)
+
+    results = []
+    for scale in scales:
+        stat = stats[scale]
+        matched = len(stat["overlaps"])
+        results.append({
+            "scale": scale,
+            "ms_per_frame": 1000 * stat["seconds"] / max(n_frames, 1),
+            "speedup": reference_seconds / stat["seconds"] if stat["seconds"] > 0 else 0.0,
+            "recall": matched / stat["reference"] if stat["reference"] > 0 else 1.0,
+            "precision": matched / stat["detected"] if stat["detected"] > 0 else 1.0,
+            "mean_iou": float(np.mean(stat["overlaps"])) if matched > 0 else 0.0,
+        })
+    return results
+
+def main():
+    """
+    This function parses the command line, evaluates the detection scales and prints the accuracy-versus-speed report.
+    """
+    parser = argparse.ArgumentParser(description="Accuracy-versus-speed report of the face detection scales.")
+    parser.add_argument("path", help="video file or directory of images with the recorded frames")
+    parser.add_argument("--scales", type=float, nargs="+", default=DEFAULT_SCALES, help="detection scales to compare")
+    parser.add_argument("--max-frames", type=int, default=None, help="maximum number of frames to read")
+    parser.add_argument("--json", default=None, help="optional path where to save the report in JSON format")
+    args = parser.parse_args()
+
+    results = evaluate(args.path, args.scales, args.max_frames)
+
+    print(REPORT_HEADER)
+    for result in results:
+        print(f"{result['scale']:>6} {result['ms_per_frame']:>9.2f} {result['speedup']:>7.2f}x "
+              f"{result['recall']:>7.3f} {result['precision']:>10.3f} {result['mean_iou']:>9.3f}")
+
+    if args.json is not None:
+        with open(args.json, "w") as file:
+            json.dump(results, file, indent=2)
+
+if __name__ == "__main__":
+    main()
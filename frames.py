@@ -0,0 +1,91 @@
+import os
+import cv2
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Variables
+# ----------------------------------------------------------------------------------------------------------------------
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp")     # Extensions of the images read from a directory
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Public functions
+# ----------------------------------------------------------------------------------------------------------------------
+def count_frames(path):
+    """
+    Function that takes a video file or a directory of images, and returns its number of frames.
+
+    :param path: path of the video file or of the directory of images
+    :return: the number of frames
+    """
+    if os.path.isdir(path):
+        return len(__list_images(path))
+    capture = cv2.VideoCapture(path)
+    count = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+    capture.release()
+    return count
+
+def read_frames(path, start=0, stop=None):
+    """
+    Generator that reads the frames of a video file or of a directory of images, in BGR encoding.
+
+    :param path: path of the video file or of the directory of images
+    :param start: index of the first frame to read
+    :param stop: index of the frame where to stop, None reads until the end
+    :return: a generator of (frame index, frame) tuples
+    """
+    if os.path.isdir(path):
+        for index, image_path in enumerate(__list_images(path)[start:stop], start):
+            frame = cv2.imread(image_path)
+            if frame is not None:
+                yield index, frame
+        return
+
+    capture = __open_at(path, start)
+    index = start
+    try:
+        while stop is None or index < stop:
+            ret, frame = capture.read()
+            if not ret:
+                break
+            yield index, frame
+            index += 1
+    finally:
+        capture.release()
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Private functions
+# ----------------------------------------------------------------------------------------------------------------------
+def __open_at(path, start):
+    """
+    Function that opens a video file positioned on a given frame.
+
+    Seeking a compressed video may land on a keyframe instead of the requested frame, so the position is checked
+    after the seek: when it is before the requested frame, the missing frames are read and discarded; when it is
+    after it, or unknown, the video is read again from the beginning.
+
+    :param path: path of the video file
+    :param start: index of the first frame to read
+    :return: the opened cv2.VideoCapture, whose next frame is the frame start
+    """
+    capture = cv2.VideoCapture(path)
+    if start == 0:
+        return capture
+    capture.set(cv2.CAP_PROP_POS_FRAMES, start)
+    position = int(capture.get(cv2.CAP_PROP_POS_FRAMES))
+    if position < 0 or position > start:
+        capture.release()
+        capture = cv2.VideoCapture(path)
+        position = 0
+    while position < start and capture.grab():
+        position += 1
+    return capture
+
+def __list_images(path):
+    """
+    Function that returns the sorted paths of the images in a directory.
+
+    :param path: path of the directory
+    :return: the sorted list of the image paths
+    """
+    return sorted(os.path.join(path, name) for name in os.listdir(path) if name.lower().endswith(IMAGE_EXTENSIONS))
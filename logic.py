@@ -2,18 +2,25 @@ import cv2
 import numpy as np
 import dlib
 import math
+import functools
+from FrameContext import FrameContext
+from LazyModel import LazyModel
+import profiler
 
 # ----------------------------------------------------------------------------------------------------------------------
 # Variables
 # ----------------------------------------------------------------------------------------------------------------------
-predictor = dlib.shape_predictor("predictor/shape_predictor_68_face_landmarks.dat")     # Landmarks detector
-detectFace = dlib.get_frontal_face_detector()                                           # Face detector object
+PREDICTOR_PATH = "predictor/shape_predictor_68_face_landmarks.dat"                         # Landmarks model
+predictor = LazyModel("landmarks predictor", lambda: dlib.shape_predictor(PREDICTOR_PATH))  # Landmarks detector
+detectFace = LazyModel("face detector", dlib.get_frontal_face_detector)                     # Face detector object
+WARM_UP_SIZE = (120, 160)   # Size of the blank frame used to warm up the models
 LANDMARKS_N = 68        # Number of landmarks
 CENTER_INDEX = 2        # Index of the center landmark
 BLUR_MASK_SIZE = 5      # Gaussian kernel size
 BLUR_SIGMA_X = 0        # Gaussian kernel standard deviation in X direction
 THRESHOLD_VALUE = 60    # Threshold value for binarization
 SPATIAL_MASK_SIZE = 3   # Spatial kernel size
+DETECTION_SCALE = 1     # Scale of the image searched by the face detector
 BLACK_VALUE = 0
 WHITE_VALUE = 255
 
@@ -21,14 +28,48 @@ WHITE_VALUE = 255
 # ----------------------------------------------------------------------------------------------------------------------
 # Public functions
 # ----------------------------------------------------------------------------------------------------------------------
-def detect_faces(image):
+def load_models():
+    """
+    Function that starts loading the face detector and the landmarks predictor in background threads, so that the
+    caller can open the camera in the meantime. Without it, the models are loaded when they are first used.
+    """
+    predictor.load_async()
+    detectFace.load_async()
+
+def warm_up():
+    """
+    Function that waits for the models to be loaded and runs them once on a blank frame, so that the first real
+    frame doesn't pay for their first-call allocations.
+    """
+    image = np.zeros(WARM_UP_SIZE, dtype=np.uint8)
+    height, width = WARM_UP_SIZE
+    detectFace(image)
+    predictor(image, dlib.rectangle(0, 0, width - 1, height - 1))
+
+def detect_faces(image, scale=DETECTION_SCALE, roi=None):
     """
     Function that takes an image as input, and returns a list of faces, where the first one is the nearest to the cam
 
-    :param image: input image
+    The search can be run on a downscaled version of the image and restricted to a region of interest: in both cases
+    the returned faces are mapped back to the coordinates of the full resolution image.
+
+    :param image: input image, or its FrameContext
+    :param scale: scale of the image searched by the detector, e.g. 0.5 searches an image of half width and height
+    :param roi: optional region of the full resolution image where to search the faces (dlib.rectangle)
     :return: a list of faces, where the first one is the nearest to the cam
     """
-    faces = detectFace(__get_gray_image(image))  # Detect faces in the image
+    gray_image = FrameContext.of(image).scaled_gray(scale)
+    left, top = 0, 0
+    if roi is not None:  # Crop the region of interest, in the coordinates of the downscaled image
+        height, width = gray_image.shape
+        left, top = max(int(roi.left() * scale), 0), max(int(roi.top() * scale), 0)
+        right, bottom = min(int(roi.right() * scale) + 1, width), min(int(roi.bottom() * scale) + 1, height)
+        if right <= left or bottom <= top:
+            return np.array([])
+        gray_image = gray_image[top:bottom, left:right]
+
+    with profiler.span("detection"):
+        faces = [__to_frame_coordinates(face, scale, left, top) for face in detectFace(gray_image)]  # Detect faces
     ret = np.array(faces)
     if len(ret) > 1:  # If there are more than one face
         for i in np.arange(1, len(ret)):  # Loop over the faces
@@ -38,24 +79,41 @@ def detect_faces(image):
 
 def face_landmarks_detector(image, face):
     """
-    Function that takes as input an image and a face, and returns a list of reference points of the face
-    :param image: input image
+    Function that takes as input an image and a face, and returns the reference points of the face
+    :param image: input image, or its FrameContext
     :param face: input face
-    :return: a list of reference points of the face
+    :return: a (68, 2) array with the x,y coordinates of the reference points of the face
     """
-    reference_points = []
-    landmarks = predictor(__get_gray_image(image), face)  # Landmarks predictor
-    for i in range(0, LANDMARKS_N):
-        point = (landmarks.part(i).x, landmarks.part(i).y)  # Get x,y coordinates of each landmark
-        reference_points.append(point)
-    return reference_points
+    gray_image = __get_gray_image(image)
+    with profiler.span("landmarks"):
+        landmarks = predictor(gray_image, face)  # Landmarks predictor
+    return shape_to_array(landmarks)
 
-def is_looking_at_cam(image, eye):
+def shape_to_array(shape):
+    """
+    Function that converts the landmarks found by the dlib predictor into an array, reading all the points at once
+    :param shape: landmarks found by the predictor (dlib.full_object_detection)
+    :return: a (68, 2) array with the x,y coordinates of the landmarks
+    """
+    return np.array([(point.x, point.y) for point in shape.parts()], dtype=np.int32)
+
+def array_to_shape(landmarks, face):
+    """
+    Function that converts an array of landmarks back into the dlib format, e.g. to compute a face descriptor from
+    landmarks found earlier without running the predictor again
+    :param landmarks: (68, 2) array with the x,y coordinates of the landmarks
+    :param face: bounding box of the face (dlib.rectangle)
+    :return: the landmarks in the dlib format (dlib.full_object_detection)
+    """
+    return dlib.full_object_detection(face, [dlib.point(int(x), int(y)) for x, y in landmarks])
+
+def is_looking_at_cam(image, eye, filtering=True):
     """
     Function that determines if the eye is looking at the camera based on image and eye coordinates.
     
-    :param image: Input image
+    :param image: Input image, or its FrameContext
     :param eye: Eye coordinates
+    :param filtering: True to filter the eye before binarizing it, False to binarize it directly, which is cheaper
     :return: True if the eye is looking at the camera, False otherwise
     """
     
@@ -68,26 +126,10 @@ def is_looking_at_cam(image, eye):
     max_y = max(eye, key=lambda item: item[1])[1]
     min_y = min(eye, key=lambda item: item[1])[1]
     cropped_eye = image_grey[min_y:max_y, min_x:max_x]
-    height, width = cropped_eye.shape
-
-    # Apply spatial filtering to the eye
-    if height > SPATIAL_MASK_SIZE * 2 and width > SPATIAL_MASK_SIZE * 2:
-        margin = int((SPATIAL_MASK_SIZE - 1) / 2)
-        cropped_eye = __averaging_filtering(cropped_eye, SPATIAL_MASK_SIZE)
-        cropped_eye = cropped_eye[margin:(height - margin), margin:(width - margin)]
-        height, width = cropped_eye.shape
-
-    # Apply Gaussian blur to the eye
-    if height > BLUR_MASK_SIZE and width > BLUR_MASK_SIZE:
-        cropped_eye_blurred = cv2.GaussianBlur(cropped_eye, (BLUR_MASK_SIZE, BLUR_MASK_SIZE), BLUR_SIGMA_X)
-        ret, threshold_eye = cv2.threshold(cropped_eye_blurred, THRESHOLD_VALUE, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
-    else:
-        ret, threshold_eye = cv2.threshold(cropped_eye, THRESHOLD_VALUE, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
 
-    # Apply erosion and dilation to the eye for noise reduction
-    p_size = int(height / 4) + 1
-    threshold_eye_e = cv2.erode(threshold_eye, cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (p_size, p_size)))
-    threshold_eye_d = cv2.dilate(threshold_eye_e, cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (p_size, p_size)))
+    # Filter and binarize the eye
+    threshold_eye_d = __binarize_eye(cropped_eye, filtering)
+    height, width = threshold_eye_d.shape
 
     # Find the largest component in the image
     threshold_eye = __largest_component_mask(threshold_eye_d)
@@ -116,6 +158,56 @@ def is_looking_at_cam(image, eye):
     return False
 
 
+def are_looking_at_cam(image, eyes, filtering=True):
+    """
+    Function that determines, for several eyes at once, if they are looking at the camera.
+
+    It follows is_looking_at_cam(), but the eyes are cropped from a single gray image, the pupil is isolated with
+    labeling passes instead of tracing the contours, and the position of the pupil is checked with vectorized
+    reductions over the columns instead of Python loops. The decisions can differ when the binarized eye has several
+    components: the pupil is the component with the most pixels here, and the one with the largest contour area in
+    is_looking_at_cam(), which is not always the same component.
+
+    :param image: Input image, or its FrameContext
+    :param eyes: list of eye coordinates, e.g. [right_eye, left_eye]
+    :param filtering: True to filter the eyes before binarizing them, False to binarize them directly, which is cheaper
+    :return: a list with, for each eye, True if it is looking at the camera, False otherwise
+    """
+    # Convert the image to grayscale, once for all the eyes
+    image_grey = __get_gray_image(image)
+
+    with profiler.span("gaze"):
+        decisions = []
+        for eye in eyes:
+            # Crop the eye from the image
+            points = np.asarray(eye)
+            min_x, min_y = points.min(axis=0)
+            max_x, max_y = points.max(axis=0)
+            cropped_eye = image_grey[min_y:max_y, min_x:max_x]
+            if cropped_eye.size == 0:
+                decisions.append(False)
+                continue
+
+            # Filter and binarize the eye, then keep the largest component filled, as the pupil
+            pupil = __largest_component_filled(__binarize_eye(cropped_eye, filtering))
+            height, width = pupil.shape
+
+            div_part = int(width / 3)
+            if div_part == 0:  # Empty center part
+                decisions.append(False)
+                continue
+
+            # Count the pupil pixels in each column, and in each of the three parts of the eye
+            column_px = np.count_nonzero(pupil, axis=0)
+            right_black_px, center_black_px, left_black_px = np.add.reduceat(column_px, (0, div_part, div_part * 2))
+
+            # The pupil is in the center if the center part has strictly the most pupil pixels, and at least one of its
+            # columns is crossed by the pupil from top to bottom (less than two other pixels)
+            decisions.append(bool(center_black_px > right_black_px and center_black_px > left_black_px
+                                  and column_px[div_part:div_part * 2].max() > height - 2))
+    return decisions
+
+
 # ----------------------------------------------------------------------------------------------------------------------
 # Private functions
 # ----------------------------------------------------------------------------------------------------------------------
@@ -146,11 +238,27 @@ def __euclidean_distance(cord1, cord2):
 def __get_gray_image(image):
     """
     Function that takes an image as input and returns its gray version.
+    When a FrameContext is given, the gray version is computed only once for the whole frame.
 
-    :param image: input image
+    :param image: input image, or its FrameContext
     :return: gray version of the input image
     """
-    return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    return FrameContext.of(image).gray
+
+def __to_frame_coordinates(face, scale, left, top):
+    """
+    Function that maps a face detected in a cropped and downscaled image back to the full resolution image.
+
+    :param face: face detected in the cropped and downscaled image
+    :param scale: scale of the downscaled image
+    :param left: left margin of the crop in the downscaled image
+    :param top: top margin of the crop in the downscaled image
+    :return: the face in the coordinates of the full resolution image
+    """
+    if scale == 1 and left == 0 and top == 0:
+        return face
+    return dlib.rectangle(int((face.left() + left) / scale), int((face.top() + top) / scale),
+                          int((face.right() + left) / scale), int((face.bottom() + top) / scale))
 
 def __get_face_area(face):
     """
@@ -171,6 +279,48 @@ def __averaging_filtering(image, mask_size):
     """
     return cv2.blur(image, (mask_size, mask_size))
 
+def __binarize_eye(cropped_eye, filtering=True):
+    """
+    Function that filters the cropped eye and binarizes it, so that the pupil is white and the rest is black.
+
+    An averaging filter and a Gaussian blur are applied first, then the image is binarized with the Otsu technique
+    and an aperture (erosion followed by dilation) removes what is not part of the pupil. Without filtering, the eye
+    is binarized directly: the decisions are noisier, but cheaper.
+
+    :param cropped_eye: gray image of the eye
+    :param filtering: True to apply the averaging filter and the Gaussian blur
+    :return: the binary image of the eye, smaller than the input by the margin of the averaging filter, when applied
+    """
+    height, width = cropped_eye.shape
+
+    # Apply spatial filtering to the eye
+    if filtering and height > SPATIAL_MASK_SIZE * 2 and width > SPATIAL_MASK_SIZE * 2:
+        margin = int((SPATIAL_MASK_SIZE - 1) / 2)
+        cropped_eye = __averaging_filtering(cropped_eye, SPATIAL_MASK_SIZE)
+        cropped_eye = cropped_eye[margin:(height - margin), margin:(width - margin)]
+        height, width = cropped_eye.shape
+
+    # Apply Gaussian blur to the eye
+    if filtering and height > BLUR_MASK_SIZE and width > BLUR_MASK_SIZE:
+        cropped_eye_blurred = cv2.GaussianBlur(cropped_eye, (BLUR_MASK_SIZE, BLUR_MASK_SIZE), BLUR_SIGMA_X)
+        ret, threshold_eye = cv2.threshold(cropped_eye_blurred, THRESHOLD_VALUE, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+    else:
+        ret, threshold_eye = cv2.threshold(cropped_eye, THRESHOLD_VALUE, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+
+    # Apply erosion and dilation (aperture) to the eye for noise reduction
+    p_size = int(height / 4) + 1
+    return cv2.morphologyEx(threshold_eye, cv2.MORPH_OPEN, __get_structuring_element(p_size))
+
+@functools.lru_cache(maxsize=None)
+def __get_structuring_element(size):
+    """
+    Function that returns the elliptic structuring element of the given size, built only once for each size.
+
+    :param size: size of the structuring element
+    :return: the structuring element
+    """
+    return cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (size, size))
+
 def __largest_component_mask(image):
     """
     Function that finds the largest component in a binary image and returns the component as a mask.
@@ -201,3 +351,28 @@ def __largest_component_mask(image):
     cv2.drawContours(labeled_image, contours, max_area[0], color=255, thickness=-1)
 
     return labeled_image  # Return the mask of the largest component
+
+def __largest_component_filled(image):
+    """
+    Function that finds the largest component in a binary image and returns it as a boolean mask, with its holes filled.
+
+    The components are labeled, with connectivity 8, in a single pass that also measures their areas, and the one with
+    the most pixels is kept, without tracing any contour. Its holes are found from the labels of its background, as
+    the regions that don't touch the border of the image.
+
+    :param image: input binary image
+    :return: boolean mask of the largest component in the image
+    """
+    n_labels, labels, stats = cv2.connectedComponentsWithStats(image, connectivity=8)[:3]
+    if n_labels < 2:  # No component
+        return np.zeros(image.shape, dtype=bool)
+    if n_labels > 2:  # More components, as it seldom happens after the aperture: keep only the largest one
+        largest = 1 + int(np.argmax(stats[1:, cv2.CC_STAT_AREA]))  # Label 0 is the background
+        image = np.where(labels == largest, 255, 0).astype(np.uint8)
+
+    # Label the background of the component, with connectivity 4 as the contours see it
+    n_labels, labels = cv2.connectedComponents(cv2.bitwise_not(image), connectivity=4)[:2]
+    is_hole = np.ones(n_labels, dtype=bool)  # Label 0 is the component itself
+    is_hole[np.concatenate((labels[0, :], labels[-1, :], labels[:, 0], labels[:, -1]))] = False
+    is_hole[0] = True
+    return is_hole[labels]
@@ -1,9 +1,18 @@
+import startup     # Imported first, so that the startup report includes the time spent importing the other modules
+import argparse
+import functools
+import threading
 import cv2
-import numpy as np
-import matplotlib.pyplot as plt
 import logic
 import ImageRecognizer as imgRec
-import time
+from FrameContext import FrameContext
+from FaceTracker import FaceTracker
+from Pipeline import Pipeline
+from FaceAnalyzer import FaceAnalyzer
+from RecognitionWorker import RecognitionWorker
+from QualityController import QualityController
+import DisplaySink
+import profiler
 
 # ----------------------------------------------------------------------------------------------------------------------
 # Colors
@@ -18,6 +27,7 @@ COLOR_BLACK = (0, 0, 0)
 # ----------------------------------------------------------------------------------------------------------------------
 FACE_DETECTION_MULTIPLE = "Number of faces:"
 FACE_DETECTION_ERROR = "No face detected"
+NAME_REQUEST = "A new face is waiting to be registered, write your name: "
 INTERFACE_TITLE = "Camera Capture"
 FONT = cv2.FONT_HERSHEY_COMPLEX     # Font used for the text
 FONT_SCALE = 1                      # Font scale
@@ -31,13 +41,15 @@ MARGIN_TEXT_NAME = 6                # Margin between the name and the rectangle
 # ----------------------------------------------------------------------------------------------------------------------
 # Variables
 # ----------------------------------------------------------------------------------------------------------------------
-FRAME_RATE = 30                     # Frame rate
+FRAME_RATE = 30                     # Frame rate, used as the display refresh timeout
 RECT_THICKNESS = 2                  # Thickness of the rectangle
-CHECK_TIME = 2                      # Check time
+CHECK_TIME = 2                      # Seconds after which the identity of a tracked face is verified again
+DETECTION_INTERVAL = 10             # Number of frames between two full face detections
 
 # ----------------------------------------------------------------------------------------------------------------------
 # Functions
 # ----------------------------------------------------------------------------------------------------------------------
+@functools.lru_cache(maxsize=None)
 def __get_pixel_text_size(text):
     """
     Function that takes a text as input, and returns its length in pixels.
@@ -53,12 +65,14 @@ def __get_pixel_text_size(text):
     """
     return cv2.getTextSize(text, FONT, FONT_SCALE, TEXT_THICKNESS)[0]
 
+@functools.lru_cache(maxsize=None)
 def __get_start_point_centered_text(text, width):
     """
     Function used to have the text centered according to the width of the window.
     
     This function takes a text and the width of the window as input, and returns the start point of the text
-    in order to have it centered on the window.
+    in order to have it centered on the window. The texts and the width of the window don't change between the
+    frames, so the start point is computed only once.
     
     Parameters:
     text (str): input text
@@ -69,144 +83,223 @@ def __get_start_point_centered_text(text, width):
     """
     return int(width / 2 - __get_pixel_text_size(text)[0] / 2)
 
-def __draw_rectangle_face(image, faces, name=""):
+def __draw_rectangle_face(image, results):
     """
     Function that takes an image as input, and returns the image with the faces identified.
     
-    The nearest is inside a green rectangle, and the others, if there are, they are inside red rectangles
+    The nearest is inside a green rectangle, and the others, if there are, they are inside red rectangles.
+    Each face has a label with the name of the user below it.
     :param image: input image
-    :param faces: faces list
-    :param name: username
+    :param results: list of the results of each face (FaceResult), where the first one is the nearest to the cam
     """
-    # Draw a green rectangle around the nearest face
-    cv2.rectangle(image, (faces[0].left(), faces[0].top()),
-                  (faces[0].right(), faces[0].bottom()), COLOR_GREEN, RECT_THICKNESS)
-    
-    # Draw a label with a name below the face
-    cv2.rectangle(image, (faces[0].left(), faces[0].bottom() - PADDING_NAME), (faces[0].right(), faces[0].bottom()),
-                  COLOR_GREEN, cv2.FILLED)
-    cv2.putText(image, name if name != "" else "?",
-                (faces[0].left() + MARGIN_TEXT_NAME, faces[0].bottom() - MARGIN_TEXT_NAME), FONT,
-                FONT_SCALE_LOW, COLOR_BLACK, TEXT_THICKNESS)
-    
-    # If there are more than one face, draw a red rectangle around them
-    if len(faces) > 1:
-        for i in np.arange(1, len(faces)):
-            cv2.rectangle(image, (faces[i].left(), faces[i].top()),
-                          (faces[i].right(), faces[i].bottom()), COLOR_RED, RECT_THICKNESS)
-    
-    # If the name is empty, display a message to register the name in the command line
-    if name == "":
+    for i, result in enumerate(results):
+        face = result.face
+        color = COLOR_GREEN if i == 0 else COLOR_RED    # Green for the nearest face, red for the others
+
+        # Draw a rectangle around the face
+        cv2.rectangle(image, (face.left(), face.top()), (face.right(), face.bottom()), color, RECT_THICKNESS)
+
+        # Draw a label with a name below the face
+        cv2.rectangle(image, (face.left(), face.bottom() - PADDING_NAME), (face.right(), face.bottom()),
+                      color, cv2.FILLED)
+        cv2.putText(image, result.name if result.name else "?",
+                    (face.left() + MARGIN_TEXT_NAME, face.bottom() - MARGIN_TEXT_NAME), FONT,
+                    FONT_SCALE_LOW, COLOR_BLACK, TEXT_THICKNESS)
+
+    # If the name of the nearest face is empty, display a message to register the name in the command line
+    if results[0].name == "":
         cv2.putText(image, f'Register your name in the command line',
                     (__get_start_point_centered_text(FACE_DETECTION_ERROR, image.shape[1]), TEXT_TOP_PADDING * 7),
                     FONT, FONT_SCALE_LOW, COLOR_RED, TEXT_THICKNESS_BOLD)
 
-def __handle_close(event, cap):
+def __process_frame(frame, tracker, analyzer, recognition):
     """
-    Handles the close event of the Matplotlib window by closing the camera capture.
+    Function that detects the faces in a frame, analyzes all of them (landmarks, gaze and identity),
+    and draws the results on the frame.
     
-    This function is called when the Matplotlib window is closed, and it is used to
-    release the camera capture object.
+    Parameters:
+    frame (numpy.ndarray): frame in BGR encoding, modified in place
+    tracker (FaceTracker): face tracker
+    analyzer (FaceAnalyzer): face analyzer
+    recognition (RecognitionWorker): background face recognition, caching the identity of each track
     
+    Returns:
+    list: the results of each face (FaceResult), where the first one is the nearest to the cam
+    """
+    # Sharing the color conversions of the frame between all the functions.
+    context = FrameContext(frame)
+    height, width = context.gray.shape
+
+    # Detecting or tracking the faces in the frame and eventually highlight with a colored square.
+    with profiler.span("tracking"):
+        tracks = tracker.update(context)
+    faces = [track.face for track in tracks]
+    track_ids = [track.id for track in tracks]
+
+    # Analyzing all the faces concurrently.
+    results = analyzer.analyze(context, faces, track_ids)
+
+    # Getting the cached identities, while the new tracks and those to verify again are recognized in background.
+    names = recognition.update(context, track_ids, [result.bounding_box for result in results],
+                               [result.landmarks for result in results])
+    for result, name in zip(results, names):
+        result.name = name
+
+    if len(faces) == 0:  # No detected faces case.
+        cv2.putText(frame, f'No faces detected',
+                    (__get_start_point_centered_text(FACE_DETECTION_ERROR, width), TEXT_TOP_PADDING),
+                    FONT, FONT_SCALE, COLOR_RED, TEXT_THICKNESS_BOLD)
+
+    if len(faces) > 0:  # Detected faces case.
+        is_looking = results[0].is_looking  # The nearest face is the user of the system.
+
+        # Drawing UI
+        cv2.putText(frame, f'Faces detected: {len(faces)}',
+                    (__get_start_point_centered_text(FACE_DETECTION_MULTIPLE, width), TEXT_TOP_PADDING),
+                    FONT, FONT_SCALE, COLOR_YELLOW, TEXT_THICKNESS_BOLD)
+
+        __draw_rectangle_face(frame, results)
+        cv2.putText(frame, f'Is looking?: ',
+                    (__get_start_point_centered_text(FACE_DETECTION_ERROR, width), TEXT_TOP_PADDING * 2),
+                    FONT, FONT_SCALE, COLOR_GREEN, TEXT_THICKNESS_BOLD)
+        cv2.putText(frame, f'             {is_looking}',
+                    (__get_start_point_centered_text(FACE_DETECTION_ERROR, width), TEXT_TOP_PADDING * 2),
+                    FONT, FONT_SCALE,
+                    COLOR_GREEN if is_looking else COLOR_RED, TEXT_THICKNESS_BOLD)
+
+    return results
+
+def __read_names(enrollment):
+    """
+    Function run by the console thread: each line written in the console is the name of the oldest unknown face
+    waiting in the enrollment queue, which is registered without stopping the recognition of the other faces.
+
     Parameters:
-    event (matplotlib.backend_tkagg.KeyEvent): the close event
-    cap (cv2.VideoCapture): the VideoCapture object to be closed
+    enrollment (EnrollmentQueue): queue of the unknown faces of the recognizer
     """
-    # Release the camera capture object
-    cap.release()
+    while True:
+        try:
+            name = input().strip()
+        except EOFError:  # No console
+            return
+        if not name:
+            continue
+        try:
+            enrollment.name(name)
+            print("The user is being registered!")
+        except KeyError as error:
+            print(error.args[0])
 
 def main():
     """
-    This function initializes the face recognizer, camera, and starts an infinite loop to detect faces and show the results.
+    This function initializes the face recognizer, camera, and the capture and processing threads, then shows the
+    processed frames as long as the camera remains open.
     """
-    # Initializing the face recognizer.
-    recognizer = imgRec.ImageRecognizer()
-
-    # Initializing the camera.
-    cap = cv2.VideoCapture(0)
-
-    # Enabling the Matplotlib interactive mode.
-    plt.ion()
-
-    # Creating a figure to be updated.
-    fig = plt.figure(INTERFACE_TITLE)
-
-    # Intercepting the window's close event to call the __handle_close() function.
-    fig.canvas.mpl_connect("close_event", lambda event: __handle_close(event, cap))
-
-    # Preparing a variable for the first run.
-    img = None
-
-    # Initializing variable for last counted detected faces.
-    last_time = 0
-    last_n_detected_faces = 0
-
-    # Initializing username variable.
-    name = ""
-
-    # Starting the infinite loop, as long as the camera remains open.
-    while cap.isOpened():
-        ret, frame = cap.read()
-        if img is None:  # First run.
-            # Showing the frame.
-            img = plt.imshow(frame)
-            plt.axis("off")
-            plt.get_current_fig_manager().window.state('zoomed')  # Setting the window to full screen.
-            plt.show()
-        else:
-            frame_gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-            height, width = frame_gray.shape
-
-            # Detecting if there are faces in the frame and eventually highlight with a colored square.
-            faces = logic.detect_faces(frame)
-
-            if len(faces) == 0:  # No detected faces case.
-                cv2.putText(frame, f'No faces detected',
-                            (__get_start_point_centered_text(FACE_DETECTION_ERROR, width), TEXT_TOP_PADDING),
-                            FONT, FONT_SCALE, COLOR_RED, TEXT_THICKNESS_BOLD)
-
-            if len(faces) > 0:  # Detected faces case.
-                if (last_n_detected_faces != len(faces)) or (len(faces) > 1 and (time.time() - last_time) > CHECK_TIME):
-                    last_time = time.time()
-                    bounding_box = (faces[0].top(), faces[0].right(), faces[0].bottom(), faces[0].left())
-                    name = recognizer.recognize_face(frame, bounding_box)
-                
-                reference_points = logic.face_landmarks_detector(frame, faces[0])  # Getting the reference
-
-                # Getting the reference points of the right and left eye.
-                right_eye = reference_points[36:42]
-                left_eye = reference_points[42:48]
-
-                # Verifying if the right eye and left eye are looking at the cam.
-                is_looking_re = logic.is_looking_at_cam(frame, right_eye)
-                is_looking_le = logic.is_looking_at_cam(frame, left_eye)
-                
-                # Drawing UI
-                cv2.putText(frame, f'Faces detected: {len(faces)}',
-                            (__get_start_point_centered_text(FACE_DETECTION_MULTIPLE, width), TEXT_TOP_PADDING),
-                            FONT, FONT_SCALE, COLOR_YELLOW, TEXT_THICKNESS_BOLD)
-
-                __draw_rectangle_face(frame, faces, name=name)
-                cv2.putText(frame, f'Is looking?: ',
-                            (__get_start_point_centered_text(FACE_DETECTION_ERROR, width), TEXT_TOP_PADDING * 2),
-                            FONT, FONT_SCALE, COLOR_GREEN, TEXT_THICKNESS_BOLD)
-                cv2.putText(frame, f'             {is_looking_le and is_looking_re}',
-                            (__get_start_point_centered_text(FACE_DETECTION_ERROR, width), TEXT_TOP_PADDING * 2),
-                            FONT, FONT_SCALE,
-                            COLOR_GREEN if is_looking_le and is_looking_re else COLOR_RED, TEXT_THICKNESS_BOLD)
-
-                # Setting the current image as the data to show
-                image = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-                img.set_data(image)
-            else:
-                # Setting the current frame as the data to show
-                frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-                img.set_data(frame)
-            last_n_detected_faces = len(faces)
-            # Updating the figure associated to the shown plot
-            fig.canvas.draw()
-            fig.canvas.flush_events()
-            plt.pause(1 / FRAME_RATE)  # pause: 30 frames per second
+    # Parsing the command line.
+    parser = argparse.ArgumentParser(description="Webcam face recognition and eye tracking.")
+    parser.add_argument("--display", choices=DisplaySink.SINKS, default="window",
+                        help="where to show the frames: a window, nowhere (servers) or an MJPEG stream")
+    parser.add_argument("--mjpeg-port", type=int, default=DisplaySink.MJPEG_PORT,
+                        help="local port of the MJPEG stream, e.g. http://127.0.0.1:8080/")
+    parser.add_argument("--startup-report", action="store_true",
+                        help="print how long each startup phase took once the first frame has been processed")
+    parser.add_argument("--target-fps", type=float, default=None,
+                        help="frame rate held by lowering the quality of the analysis under load, and raising it back")
+    parser.add_argument("--latency-budget", type=float, default=None,
+                        help="milliseconds a frame may cost, held like --target-fps")
+    parser.add_argument("--profile-overlay", action="store_true", help="show the latency of each stage on the frames")
+    parser.add_argument("--profile-dump", default=None, help="JSON file where to dump the latency of each stage")
+    parser.add_argument("--profile-interval", type=float, default=profiler.DUMP_INTERVAL,
+                        help="seconds between two dumps of the latencies")
+    args = parser.parse_args()
+    startup.mark("imports done")
+
+    # Loading the face detector and the landmarks predictor in background, while the rest is initialized.
+    logic.load_models()
+
+    # Enabling the profiler only when its results are shown or dumped, so that it costs nothing otherwise.
+    profiler.enable(args.profile_overlay or args.profile_dump is not None)
+    if args.profile_dump is not None:
+        stop_dump = profiler.start_periodic_dump(args.profile_dump, args.profile_interval)
+
+    # Initializing the face recognizer, whose face encoder is loaded in background while the gallery is loaded, and
+    # which merges the users registered by other processes while running. The unknown faces wait for their names,
+    # written in the console by a separate thread. The JSON gallery of the previous versions is migrated first.
+    imgRec.ImageRecognizer.migrate()
+    recognizer = imgRec.ImageRecognizer(load_async=True, watch=True,
+                                        on_pending=lambda pending_id: print(NAME_REQUEST, end="", flush=True))
+    threading.Thread(target=__read_names, args=(recognizer.enrollment, ), name="console", daemon=True).start()
+
+    # Initializing the face tracker, which runs the face detector only every few frames.
+    tracker = FaceTracker(detection_interval=DETECTION_INTERVAL)
+
+    # Initializing the face analyzer, which processes all the faces of a frame concurrently.
+    analyzer = FaceAnalyzer()
+
+    # Initializing the background face recognition, which verifies the identity of each track every CHECK_TIME seconds.
+    recognition = RecognitionWorker(recognizer.recognize_face, recheck_interval=CHECK_TIME)
+
+    # Initializing the quality controller, which adjusts the tracker, the analyzer and the recognition at runtime.
+    controller = None
+    if args.target_fps is not None or args.latency_budget is not None:
+        controller = QualityController(tracker, analyzer, recognition, target_fps=args.target_fps or FRAME_RATE,
+                                       latency_budget=args.latency_budget / 1000 if args.latency_budget else None)
+
+    first_frame = [True]    # True until the first frame has been processed
+
+    def process(frame):
+        # Drawing the results of the faces on the frame, which is then displayed.
+        with profiler.span("frame"):
+            __process_frame(frame, tracker, analyzer, recognition)
+        if controller is not None:
+            controller.update()
+        if args.profile_overlay:
+            profiler.draw_overlay(frame)
+        if first_frame[0]:
+            first_frame[0] = False
+            startup.mark("first frame processed")
+            if args.startup_report:
+                print(startup.format_report())
+        return frame
+
+    # Initializing the camera, while the models are still loading, and the threads capturing and processing its frames.
+    with startup.phase("open camera"):
+        cap = cv2.VideoCapture(0)
+    pipeline = Pipeline(cap, process)
+
+    # Waiting for the models and running them once, so that the first frame is not slower than the others.
+    with startup.phase("warm up"):
+        logic.warm_up()
+        recognizer.warm_up()
+
+    # Initializing the display, where the processed frames are shown.
+    if args.display == "window":
+        sink = DisplaySink.WindowSink(INTERFACE_TITLE)
+    elif args.display == "mjpeg":
+        sink = DisplaySink.MjpegSink(port=args.mjpeg_port)
+    else:
+        sink = DisplaySink.NullSink()
+
+    # Starting the capture and processing threads.
+    pipeline.start()
+
+    # Showing the latest processed frame, as long as the camera and the display remain open.
+    while pipeline.is_running() and sink.poll():
+        frame = pipeline.get(timeout=1 / FRAME_RATE)
+        if frame is None:  # No new frame yet: only handling the display events.
+            continue
+
+        with profiler.span("rendering"):
+            sink.show(frame)
+
+    pipeline.stop()
+    sink.close()
+    analyzer.close()
+    recognition.close()
+    recognizer.close()
+    if args.profile_dump is not None:
+        stop_dump.set()
+        profiler.dump(args.profile_dump)
 
 if __name__ == "__main__":
     try:
@@ -0,0 +1,355 @@
+import argparse
+import collections
+import json
+import multiprocessing
+import os
+import queue
+import sys
+import time
+from multiprocessing import shared_memory
+import numpy as np
+import frames
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Variables
+# ----------------------------------------------------------------------------------------------------------------------
+METRICS_INTERVAL = 5        # Seconds between two metrics reports of a stream
+RESULTS_QUEUE_SIZE = 256    # Results waiting to be written; when full, live streams drop the new ones, recorded ones wait
+GET_TIMEOUT = 0.1           # Seconds waited for a result by the runner, before checking the streams
+LATENCY_WINDOW = 300        # Number of frame latencies kept by each stream for its percentiles
+DETECTION_INTERVAL = 10     # Number of frames between two full face detections
+RECHECK_INTERVAL = 2        # Seconds after which the identity of a tracked face is verified again
+JOIN_TIMEOUT = 5            # Seconds waited for a stream to stop, before terminating it
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Worker functions
+# ----------------------------------------------------------------------------------------------------------------------
+def __run_stream(stream_id, source, gallery_info, detection_scale, results, metrics, stop_event):
+    """
+    Function run by the process of a stream: it reads the frames of the source, analyzes them and sends the results
+    and the metrics of the stream to the runner.
+
+    :param stream_id: index of the stream
+    :param source: device index, video file, directory of images or URL of the stream
+    :param gallery_info: (shared memory name, number of records, names, retired records, approximate index path) of
+                         the shared gallery, None to skip the recognition
+    :param detection_scale: scale of the image searched by the face detector
+    :param results: queue where the results of each frame are sent
+    :param metrics: queue where the metrics of the stream are sent
+    :param stop_event: event set by the runner to stop the stream
+    """
+    import logic
+    from FaceAnalyzer import FaceAnalyzer
+    from FaceTracker import FaceTracker
+    from FrameContext import FrameContext
+    from RecognitionWorker import RecognitionWorker
+
+    # Attaching the shared gallery, without copying it
+    shared_gallery, recognition = None, None
+    if gallery_info is not None:
+        import ImageRecognizer as imgRec
+        from FaceGallery import FaceGallery, ENCODING_SIZE
+        name, count, names, retired, index_path = gallery_info
+        shared_gallery = shared_memory.SharedMemory(name=name)    # Kept open as long as the stream runs
+        gallery = FaceGallery.wrap(np.ndarray((count, ENCODING_SIZE), dtype=np.float32, buffer=shared_gallery.buf),
+                                   names)
+        gallery.retire(retired)
+        if index_path is not None:  # The approximate index is small, each stream reads its own copy
+            from AnnIndex import AnnIndex
+            gallery.set_index(AnnIndex.load(index_path))
+        recognizer = imgRec.ImageRecognizer(gallery=gallery)
+        recognition = RecognitionWorker(recognizer.identify_face, recheck_interval=RECHECK_INTERVAL)
+
+    logic.warm_up()     # Already loaded when the process has been forked from the runner
+    tracker = FaceTracker(detection_interval=DETECTION_INTERVAL, detection_scale=detection_scale)
+    analyzer = FaceAnalyzer(max_workers=1)     # The streams are already spread over the processes
+    stream = {"frames": 0, "results_dropped": 0, "latencies": collections.deque(maxlen=LATENCY_WINDOW)}
+
+    def process(frame):
+        start = time.perf_counter()
+        context = FrameContext(frame)
+        tracks = tracker.update(context)
+        track_ids = [track.id for track in tracks]
+        faces = analyzer.analyze(context, [track.face for track in tracks], track_ids)
+        if recognition is not None:
+            names = recognition.update(context, track_ids, [face.bounding_box for face in faces],
+                                       [face.landmarks for face in faces])
+            for face, face_name in zip(faces, names):
+                face.name = face_name
+        stream["latencies"].append(time.perf_counter() - start)
+        return {"stream": stream_id, "frame": stream["frames"], "time": time.time(),
+                "faces": [face.to_dict() for face in faces]}
+
+    def send(result, live):
+        stream["frames"] += 1
+        if live:
+            try:
+                results.put_nowait(result)
+            except queue.Full:  # The runner is late: dropping the result instead of slowing down the stream
+                stream["results_dropped"] += 1
+            return
+        # A recorded source waits for the runner instead, so that no result is lost
+        while True:
+            try:
+                results.put(result, timeout=GET_TIMEOUT)
+                return
+            except queue.Full:
+                if stop_event.is_set():     # The runner is stopping and may not read anymore
+                    stream["results_dropped"] += 1
+                    return
+
+    pipeline = None
+    started = last_report = time.monotonic()
+    try:
+        if __is_recorded(source):
+            # Recorded sources are analyzed frame by frame, without dropping any of them
+            frame_iterator = frames.read_frames(source)
+            while not stop_event.is_set():
+                item = next(frame_iterator, None)
+                if item is None:
+                    break
+                send(process(item[1]), live=False)
+                last_report = __report(metrics, stream_id, stream, None, started, last_report)
+        else:
+            # Live sources keep only the latest frame, so a slow stream drops frames instead of lagging behind
+            from Pipeline import Pipeline
+            import cv2
+            pipeline = Pipeline(cv2.VideoCapture(source), process)
+            pipeline.start()
+            while pipeline.is_running() and not stop_event.is_set():
+                result = pipeline.get(timeout=GET_TIMEOUT)
+                if result is not None:
+                    send(result, live=True)
+                last_report = __report(metrics, stream_id, stream, pipeline, started, last_report)
+    finally:
+        if pipeline is not None:
+            pipeline.stop()
+        __report(metrics, stream_id, stream, pipeline, started, 0, final=True)
+        analyzer.close()
+        if recognition is not None:
+            recognition.close()
+
+def __report(metrics, stream_id, stream, pipeline, started, last_report, final=False):
+    """
+    Function that sends the metrics of a stream to the runner, every METRICS_INTERVAL seconds.
+
+    :param metrics: queue where the metrics are sent
+    :param stream_id: index of the stream
+    :param stream: dictionary with the counters and the latencies of the stream
+    :param pipeline: pipeline of a live stream, None for a recorded one
+    :param started: time when the stream started
+    :param last_report: time of the last report
+    :param final: True if the stream is ending
+    :return: the time of the last report
+    """
+    now = time.monotonic()
+    if not final and now - last_report < METRICS_INTERVAL:
+        return last_report
+    latencies = 1000 * np.array(stream["latencies"])
+    metrics.put({
+        "stream": stream_id,
+        "frames": stream["frames"],
+        "fps": stream["frames"] / max(now - started, 1e-9),
+        "p50_ms": float(np.percentile(latencies, 50)) if len(latencies) else 0.0,
+        "p95_ms": float(np.percentile(latencies, 95)) if len(latencies) else 0.0,
+        "frames_dropped": pipeline.dropped_frames if pipeline is not None else 0,
+        "results_dropped": stream["results_dropped"],
+        "running": not final,
+    })
+    return now
+
+def __is_recorded(source):
+    """
+    Function that tells if a source is recorded (video file or directory of images) or live (device or URL).
+
+    :param source: source of a stream
+    :return: True if the source is recorded
+    """
+    return isinstance(source, str) and (os.path.isfile(source) or os.path.isdir(source))
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Functions
+# ----------------------------------------------------------------------------------------------------------------------
+def parse_source(source):
+    """
+    Function that converts a source given on the command line: a number is a device index, anything else is a video
+    file, a directory of images or a URL.
+
+    :param source: source of a stream
+    :return: the device index, or the source unchanged
+    """
+    return int(source) if source.isdigit() else source
+
+def share_gallery(store_path=None):
+    """
+    Function that loads the gallery of the registered users once and copies its encodings in shared memory, so
+    that all the streams read the same matrix.
+
+    :param store_path: path of the gallery store, without extension, None for the default one; it is only read, the
+                       JSON gallery of the previous versions is not migrated
+    :return: a tuple containing the shared memory block (to be unlinked by the caller) and the (shared memory name,
+             number of records, names, indices of the records replaced by newer ones, approximate index path) tuple
+             passed to the streams
+    """
+    import ImageRecognizer as imgRec
+    from GalleryStore import GalleryStore
+    store_path = store_path or imgRec.STORE_PATH
+    index_path = imgRec.ImageRecognizer.build_index(store_path)
+    store = GalleryStore(store_path)
+    encodings, ids, names, _, _ = store.read()
+    last_row_of_id = {user_id: row for row, user_id in enumerate(ids)}
+    retired = [row for row, user_id in enumerate(ids) if last_row_of_id[user_id] != row]
+    shared = shared_memory.SharedMemory(create=True, size=max(encodings.nbytes, 1))
+    np.ndarray(encodings.shape, dtype=np.float32, buffer=shared.buf)[:] = encodings
+    return shared, (shared.name, len(names), list(names), retired, index_path)
+
+def aggregate(stream_metrics):
+    """
+    Function that aggregates the latest metrics of all the streams.
+
+    :param stream_metrics: latest metrics of each stream, by stream index
+    :return: a dictionary with the totals and the metrics of each stream
+    """
+    streams = [stream_metrics[stream_id] for stream_id in sorted(stream_metrics)]
+    return {
+        "streams": streams,
+        "running": sum(stream["running"] for stream in streams),
+        "frames": sum(stream["frames"] for stream in streams),
+        "fps": sum(stream["fps"] for stream in streams),
+        "frames_dropped": sum(stream["frames_dropped"] for stream in streams),
+        "results_dropped": sum(stream["results_dropped"] for stream in streams),
+        "max_p95_ms": max((stream["p95_ms"] for stream in streams), default=0.0),
+    }
+
+def run(sources, output_path=None, recognize=False, detection_scale=1, duration=None, metrics_path=None,
+        gallery_path=None):
+    """
+    Function that analyzes several sources at once, each one in its own process, until all of them end, the duration
+    elapses or the user interrupts the program.
+
+    On systems that fork the processes, the models are loaded once by the runner and their memory is shared by
+    all the streams; the gallery is always loaded once and shared through shared memory.
+
+    :param sources: list of device indices, video files, directories of images or URLs
+    :param output_path: optional JSONL file where to write the results of each frame of each stream
+    :param recognize: True to identify the detected faces against the registered users
+    :param detection_scale: scale of the image searched by the face detector
+    :param duration: optional number of seconds after which the streams are stopped
+    :param metrics_path: optional JSON file where to write the aggregated metrics at each report
+    :param gallery_path: path of the gallery store of the registered users, without extension, None for the default
+    :return: the aggregated metrics of the streams when they stopped
+    """
+    import logic
+    method = "fork" if "fork" in multiprocessing.get_all_start_methods() else "spawn"
+    context = multiprocessing.get_context(method)
+    if method == "fork":    # Loading the models before forking, so that their memory is shared
+        logic.warm_up()
+        if recognize:
+            import ImageRecognizer as imgRec
+            imgRec.face_recognition.get()
+
+    shared, gallery_info = share_gallery(gallery_path) if recognize else (None, None)
+    results = context.Queue(RESULTS_QUEUE_SIZE)
+    metrics = context.Queue()
+    stop_event = context.Event()
+    processes = [context.Process(target=__run_stream, args=(stream_id, source, gallery_info, detection_scale,
+                                                            results, metrics, stop_event), daemon=True)
+                 for stream_id, source in enumerate(sources)]
+    for process in processes:
+        process.start()
+
+    stream_metrics = {}
+    output = open(output_path, "w") if output_path is not None else None
+
+    def drain(timeout):
+        # Writing all the queued results, waiting for the first one at most timeout seconds, and keeping the latest
+        # metrics of each stream
+        try:
+            result = results.get(timeout=timeout)
+            while True:
+                if output is not None:
+                    output.write(json.dumps(result) + "\n")
+                result = results.get_nowait()
+        except queue.Empty:
+            pass
+        while True:
+            try:
+                item = metrics.get_nowait()
+            except queue.Empty:
+                break
+            stream_metrics[item["stream"]] = item
+
+    started = last_report = time.monotonic()
+    try:
+        while any(process.is_alive() for process in processes):
+            if duration is not None and time.monotonic() - started > duration:
+                stop_event.set()
+            drain(GET_TIMEOUT)
+            if time.monotonic() - last_report >= METRICS_INTERVAL and stream_metrics:
+                last_report = time.monotonic()
+                __print_metrics(aggregate(stream_metrics), metrics_path)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # A process can't end while its queued items have not been read, so the queues are drained while waiting
+        stop_event.set()
+        deadline = time.monotonic() + JOIN_TIMEOUT
+        while any(process.is_alive() for process in processes) and time.monotonic() < deadline:
+            drain(GET_TIMEOUT)
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+        while not results.empty() or not metrics.empty():
+            drain(0)
+        if output is not None:
+            output.close()
+        if shared is not None:
+            shared.close()
+            shared.unlink()
+
+    summary = aggregate(stream_metrics)
+    __print_metrics(summary, metrics_path)
+    return summary
+
+def __print_metrics(summary, metrics_path):
+    """
+    Function that prints the aggregated metrics of the streams and, optionally, writes them in a JSON file.
+
+    :param summary: aggregated metrics
+    :param metrics_path: JSON file where to write the metrics, None to only print them
+    """
+    print(f"{'stream':>6} {'frames':>8} {'fps':>8} {'p50 ms':>8} {'p95 ms':>8} {'dropped':>8} {'lost':>6}",
+          file=sys.stderr)
+    for stream in summary["streams"]:
+        print(f"{stream['stream']:>6} {stream['frames']:>8} {stream['fps']:>8.1f} {stream['p50_ms']:>8.1f} "
+              f"{stream['p95_ms']:>8.1f} {stream['frames_dropped']:>8} {stream['results_dropped']:>6}",
+              file=sys.stderr)
+    print(f"{'total':>6} {summary['frames']:>8} {summary['fps']:>8.1f} {'':>8} {summary['max_p95_ms']:>8.1f} "
+          f"{summary['frames_dropped']:>8} {summary['results_dropped']:>6}", file=sys.stderr)
+    if metrics_path is not None:
+        with open(metrics_path, "w") as file:
+            json.dump(summary, file, indent=2)
+
+def main():
+    """
+    This function parses the command line and analyzes all the given sources at once.
+    """
+    parser = argparse.ArgumentParser(description="Analysis of several cameras or video sources on one host.")
+    parser.add_argument("sources", nargs="+", help="device indices, video files, directories of images or URLs")
+    parser.add_argument("-o", "--output", default=None, help="JSONL file where to write the results of each frame")
+    parser.add_argument("--recognize", action="store_true", help="identify the faces against the registered users")
+    parser.add_argument("--scale", type=float, default=1, help="scale of the image searched by the face detector")
+    parser.add_argument("--duration", type=float, default=None, help="seconds after which the streams are stopped")
+    parser.add_argument("--metrics", default=None, help="JSON file where to write the aggregated metrics")
+    parser.add_argument("--gallery", default=None, help="gallery store of the registered users, without extension "
+                                                        "(default: registered_user)")
+    args = parser.parse_args()
+
+    run([parse_source(source) for source in args.sources], args.output, args.recognize, args.scale, args.duration,
+        args.metrics, args.gallery)
+
+if __name__ == "__main__":
+    main()
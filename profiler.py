@@ -0,0 +1,199 @@
+import collections
+import contextlib
+import json
+import threading
+import time
+import cv2
+import numpy as np
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Variables
+# ----------------------------------------------------------------------------------------------------------------------
+WINDOW = 300                # Number of latencies kept for each span, the older ones are forgotten
+DUMP_INTERVAL = 10          # Seconds between two JSON dumps
+FRAME_SPAN = "frame"        # Span whose rate is shown as the FPS of the overlay
+PERCENTILES = [50, 95, 99]  # Latency percentiles reported for each span
+FONT = cv2.FONT_HERSHEY_SIMPLEX     # Font of the overlay
+FONT_SCALE = 0.45                   # Font scale of the overlay
+LINE_HEIGHT = 18                    # Height in pixels of a line of the overlay
+OVERLAY_ORIGIN = (10, 20)           # Position of the first line of the overlay
+COLOR_OVERLAY = (255, 255, 255)     # Color of the overlay text
+COLOR_OVERLAY_BACKGROUND = (0, 0, 0)    # Color of the overlay text outline
+
+__enabled = False           # True if the spans and the counters are recorded
+__histograms = {}           # Rolling (end time, duration) pairs of each span, by name
+__counters = collections.Counter()  # Counters, by name
+__lock = threading.Lock()   # Lock protecting the creation of the histograms and the counters
+__null_span = contextlib.nullcontext()  # Span returned when the profiler is disabled, which records nothing
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Public functions
+# ----------------------------------------------------------------------------------------------------------------------
+def enable(enabled=True):
+    """
+    Function that enables or disables the profiler. When disabled, spans and counters cost a function call.
+
+    :param enabled: True to record the spans and the counters
+    """
+    global __enabled
+    __enabled = enabled
+
+def is_enabled():
+    """
+    :return: True if the profiler is enabled
+    """
+    return __enabled
+
+def span(name):
+    """
+    Function that returns a context manager measuring the latency of the code it wraps, e.g.
+    `with profiler.span("detection"): ...`
+
+    :param name: name of the span
+    :return: the context manager
+    """
+    if not __enabled:
+        return __null_span
+    return _Span(name)
+
+def count(name, increment=1):
+    """
+    Function that increments a counter.
+
+    :param name: name of the counter
+    :param increment: value added to the counter
+    """
+    if __enabled:
+        with __lock:
+            __counters[name] += increment
+
+def record(name, duration, end_time=None):
+    """
+    Function that adds a latency to the rolling histogram of a span.
+
+    :param name: name of the span
+    :param duration: latency in seconds
+    :param end_time: time when the span ended, None uses the current time
+    """
+    histogram = __histograms.get(name)
+    if histogram is None:
+        with __lock:
+            histogram = __histograms.setdefault(name, collections.deque(maxlen=WINDOW))
+    histogram.append((end_time if end_time is not None else time.perf_counter(), duration))
+
+def snapshot():
+    """
+    Function that summarizes the rolling histograms and the counters.
+
+    :return: a JSON serializable dictionary with, for each span, the number of samples, the rate per second and the
+             latency statistics in milliseconds, and the values of the counters
+    """
+    now = time.perf_counter()
+    spans = {}
+    for name, histogram in list(__histograms.items()):
+        samples = np.array(list(histogram))
+        if len(samples) == 0:
+            continue
+        latencies = 1000 * samples[:, 1]
+        elapsed = now - samples[0, 0]
+        stats = {"samples": len(samples), "rate": float((len(samples) - 1) / elapsed) if elapsed > 0 else 0.0,
+                 "mean_ms": float(latencies.mean()), "max_ms": float(latencies.max())}
+        for percentile, value in zip(PERCENTILES, np.percentile(latencies, PERCENTILES)):
+            stats[f"p{percentile}_ms"] = float(value)
+        spans[name] = stats
+    with __lock:
+        counters = dict(__counters)
+    return {"time": time.time(), "spans": spans, "counters": counters}
+
+def totals(since):
+    """
+    Function that sums the latencies of each span recorded after a given time, e.g. to measure the cost of each stage
+    over the last few seconds.
+
+    :param since: time, from time.perf_counter(), after which the spans are counted
+    :return: a dictionary with, for each span, the number of samples and their total latency in seconds
+    """
+    result = {}
+    for name, histogram in list(__histograms.items()):
+        durations = [duration for end_time, duration in list(histogram) if end_time > since]
+        if durations:
+            result[name] = (len(durations), sum(durations))
+    return result
+
+def draw_overlay(image):
+    """
+    Function that draws the FPS, the p95 latency of each span and the counters on a frame.
+
+    :param image: frame in BGR encoding, modified in place
+    """
+    if not __enabled:
+        return
+    summary = snapshot()
+    frame_stats = summary["spans"].get(FRAME_SPAN)
+    lines = [f"FPS: {frame_stats['rate']:.1f}" if frame_stats is not None else "FPS: -"]
+    lines += [f"{name}: p50 {stats['p50_ms']:.1f} ms, p95 {stats['p95_ms']:.1f} ms"
+              for name, stats in sorted(summary["spans"].items())]
+    lines += [f"{name}: {value}" for name, value in sorted(summary["counters"].items())]
+
+    x, y = OVERLAY_ORIGIN
+    for line in lines:
+        cv2.putText(image, line, (x, y), FONT, FONT_SCALE, COLOR_OVERLAY_BACKGROUND, 3)
+        cv2.putText(image, line, (x, y), FONT, FONT_SCALE, COLOR_OVERLAY, 1)
+        y += LINE_HEIGHT
+
+def dump(path):
+    """
+    Function that writes the summary of the profiler in a JSON file.
+
+    :param path: path of the JSON file
+    """
+    with open(path, "w") as file:
+        json.dump(snapshot(), file, indent=2)
+
+def start_periodic_dump(path, interval=DUMP_INTERVAL):
+    """
+    Function that starts a background thread writing the summary of the profiler in a JSON file periodically.
+
+    :param path: path of the JSON file
+    :param interval: seconds between two dumps
+    :return: an event to set to stop the thread
+    """
+    stop_event = threading.Event()
+
+    def run():
+        while not stop_event.wait(interval):
+            dump(path)
+
+    threading.Thread(target=run, daemon=True).start()
+    return stop_event
+
+def reset():
+    """
+    Function that forgets all the recorded latencies and counters.
+    """
+    with __lock:
+        __histograms.clear()
+        __counters.clear()
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Private classes
+# ----------------------------------------------------------------------------------------------------------------------
+# Class that measures the latency of the code it wraps
+class _Span:
+    __slots__ = ("name", "start")
+
+    # Builder method
+    def __init__(self, name):
+        self.name = name
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        end = time.perf_counter()
+        record(self.name, end - self.start, end)
+        return False
@@ -0,0 +1,275 @@
+import argparse
+import json
+import os
+import socketserver
+import sys
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+import cv2
+import numpy as np
+import logic
+import startup
+import ImageRecognizer as imgRec
+from FaceAnalyzer import FaceAnalyzer
+from FrameContext import FrameContext
+from RequestBatcher import RequestBatcher, MAX_BATCH, MAX_WAIT
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Variables
+# ----------------------------------------------------------------------------------------------------------------------
+SERVICE_HOST = "127.0.0.1"  # Address of the service, local only by default
+SERVICE_PORT = 8090         # Port of the service
+MAX_BODY_SIZE = 16 << 20    # Maximum size in bytes of an uploaded image
+REQUEST_QUEUE_SIZE = 128    # Number of connections waiting to be accepted, so that bursts of clients are not refused
+
+
+# Class of the HTTP server listening on a TCP port, with a thread for each request
+class TcpHTTPServer(ThreadingHTTPServer):
+    request_queue_size = REQUEST_QUEUE_SIZE
+
+
+# Class of the HTTP server listening on a Unix socket, with a thread for each request
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+    request_queue_size = REQUEST_QUEUE_SIZE
+
+
+# Class that handles the requests of the service
+#
+# Every endpoint takes the image in the body of a POST request (any format decoded by OpenCV, e.g. JPEG or PNG) and
+# its parameters in the query string. The models, the recognizer and the batcher are attributes of the server.
+class RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"   # Keeps the connections of the clients open between two requests
+
+    def do_GET(self):
+        if urlsplit(self.path).path != "/status":
+            self.__send(404, {"error": "Unknown endpoint"})
+            return
+        batcher = self.server.batcher
+        self.__send(200, {"faces": len(self.server.recognizer), "batches": batcher.batches,
+                          "mean_batch_size": round(batcher.mean_batch_size, 2)})
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        endpoint = ENDPOINTS.get(url.path)
+        if endpoint is None:
+            self.close_connection = True    # The body is not read, so the connection cannot be reused
+            self.__send(404, {"error": "Unknown endpoint"})
+            return
+        try:
+            image = self.__read_image()
+            params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+            self.__send(200, endpoint(self.server, image, params))
+        except ValueError as error:
+            self.__send(400, {"error": str(error)})
+        except Exception as error:
+            self.__send(500, {"error": f"{type(error).__name__}: {error}"})
+
+    def address_string(self):
+        # The clients of a Unix socket have no address
+        return self.client_address[0] if self.client_address else "unix"
+
+    def __read_image(self):
+        """
+        Reads and decodes the image in the body of the request.
+
+        :return: the image in BGR encoding.
+        """
+        length = int(self.headers.get("Content-Length", 0))
+        if length <= 0 or length > MAX_BODY_SIZE:
+            self.close_connection = True    # The body is not read, so the connection cannot be reused
+            raise ValueError(f"The body must be an image of at most {MAX_BODY_SIZE} bytes")
+        image = cv2.imdecode(np.frombuffer(self.rfile.read(length), dtype=np.uint8), cv2.IMREAD_COLOR)
+        if image is None:
+            raise ValueError("The body is not a valid image")
+        return image
+
+    def __send(self, status, body):
+        """
+        Sends a JSON response.
+
+        :param status: HTTP status code.
+        :param body: JSON serializable body.
+        """
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Private functions
+# ----------------------------------------------------------------------------------------------------------------------
+def __parse_box(value):
+    """
+    Function that parses a bounding box given as "left,top,right,bottom".
+
+    :param value: string of the bounding box
+    :return: the dlib.rectangle of the bounding box
+    """
+    import dlib
+    try:
+        left, top, right, bottom = (int(coordinate) for coordinate in value.split(","))
+    except ValueError:
+        raise ValueError("The box must be given as left,top,right,bottom") from None
+    return dlib.rectangle(left, top, right, bottom)
+
+def __find_faces(server, context, params):
+    """
+    Function that finds the faces of a request: the one given by its "box" parameter, or all the detected ones.
+
+    :param server: server of the service
+    :param context: FrameContext of the image
+    :param params: parameters of the request
+    :return: the list of the faces, where the first one is the nearest to the cam
+    """
+    if "box" in params:
+        return [__parse_box(params["box"])]
+    return logic.detect_faces(context, scale=server.detection_scale)
+
+def __identify(server, context, results):
+    """
+    Function that identifies the analyzed faces of a request, in the batches shared with the concurrent requests.
+
+    :param server: server of the service
+    :param context: FrameContext of the image
+    :param results: list of the FaceResults of the faces
+    """
+    names = server.batcher.process([(context, result.bounding_box, result.landmarks) for result in results])
+    for result, name in zip(results, names):
+        result.name = name
+
+def __analyze(server, image, params):
+    """
+    Function that handles the /analyze endpoint: it finds the faces of the image and analyzes them (landmarks, gaze
+    and identity). Parameters: box=left,top,right,bottom to analyze only that face, recognize=0 to skip the
+    identification.
+
+    :param server: server of the service
+    :param image: image of the request in BGR encoding
+    :param params: parameters of the request
+    :return: the JSON serializable results of the faces
+    """
+    context = FrameContext(image)
+    results = server.analyzer.analyze(context, __find_faces(server, context, params))
+    if params.get("recognize", "1") != "0":
+        __identify(server, context, results)
+    return {"faces": [result.to_dict() for result in results]}
+
+def __recognize(server, image, params):
+    """
+    Function that handles the /recognize endpoint: it identifies the faces of the image, without the gaze analysis.
+    Parameters: box=left,top,right,bottom to identify only that face.
+
+    :param server: server of the service
+    :param image: image of the request in BGR encoding
+    :param params: parameters of the request
+    :return: the JSON serializable bounding box and identity of each face
+    """
+    context = FrameContext(image)
+    faces = __find_faces(server, context, params)
+    names = server.batcher.process([(context, (face.top(), face.right(), face.bottom(), face.left()),
+                                     logic.face_landmarks_detector(context, face)) for face in faces])
+    return {"faces": [{"box": [face.left(), face.top(), face.right(), face.bottom()], "identity": name or None}
+                      for face, name in zip(faces, names)]}
+
+def __enroll(server, image, params):
+    """
+    Function that handles the /enroll endpoint: it registers the only face of the image with the given name.
+    Parameters: name=<name of the user> (required), box=left,top,right,bottom to register that face when the image
+    contains several ones.
+
+    :param server: server of the service
+    :param image: image of the request in BGR encoding
+    :param params: parameters of the request
+    :return: the JSON serializable Id, name and bounding box of the new user
+    """
+    name = params.get("name", "").strip()
+    if not name:
+        raise ValueError("The name of the user is required")
+    context = FrameContext(image)
+    faces = __find_faces(server, context, params)
+    if len(faces) == 0:
+        raise ValueError("No face found in the image")
+    if len(faces) > 1:
+        raise ValueError(f"{len(faces)} faces found in the image, give the box of the face to register")
+    face = faces[0]
+    user_id = server.recognizer.enroll_face(context, (face.top(), face.right(), face.bottom(), face.left()), name,
+                                            logic.face_landmarks_detector(context, face))
+    return {"Id": user_id, "name": name, "box": [face.left(), face.top(), face.right(), face.bottom()]}
+
+ENDPOINTS = {               # Function handling each POST endpoint
+    "/analyze": __analyze,
+    "/recognize": __recognize,
+    "/enroll": __enroll,
+}
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Public functions
+# ----------------------------------------------------------------------------------------------------------------------
+def create_server(host=SERVICE_HOST, port=SERVICE_PORT, unix_path=None, max_batch=MAX_BATCH, max_wait=MAX_WAIT,
+                  detection_scale=1):
+    """
+    Function that loads the models and the gallery, and creates the server of the service.
+
+    :param host: address of the server, 127.0.0.1 accepts only local clients
+    :param port: port of the server
+    :param unix_path: path of a Unix socket to listen on instead of host and port
+    :param max_batch: maximum number of faces encoded by a single call of the face encoder
+    :param max_wait: seconds a face waits for the faces of the other requests to join its batch
+    :param detection_scale: scale of the image searched by the face detector
+    :return: the server, to be run with serve_forever()
+    """
+    # Loading all the models now, so that no request pays for them
+    logic.load_models()
+    imgRec.ImageRecognizer.migrate()    # The JSON gallery of the previous versions, the first time
+    recognizer = imgRec.ImageRecognizer(load_async=True, watch=True)
+    with startup.phase("warm up"):
+        logic.warm_up()
+        recognizer.warm_up()
+
+    if unix_path is not None:
+        if os.path.exists(unix_path):   # Left behind by a previous run
+            os.remove(unix_path)
+        server = UnixHTTPServer(unix_path, RequestHandler)
+    else:
+        server = TcpHTTPServer((host, port), RequestHandler)
+    server.recognizer = recognizer
+    server.batcher = RequestBatcher(recognizer.identify_faces, max_batch, max_wait, name="identification")
+    server.analyzer = FaceAnalyzer(max_workers=1)  # The requests are already spread over the threads
+    server.detection_scale = detection_scale
+    return server
+
+def main():
+    """
+    This function parses the command line and runs the service until it is interrupted.
+    """
+    parser = argparse.ArgumentParser(description="Local face recognition and gaze analysis service.")
+    parser.add_argument("--host", default=SERVICE_HOST, help="address of the service")
+    parser.add_argument("--port", type=int, default=SERVICE_PORT, help="port of the service")
+    parser.add_argument("--unix", default=None, help="path of a Unix socket to listen on instead of host and port")
+    parser.add_argument("--max-batch", type=int, default=MAX_BATCH, help="maximum number of faces encoded together")
+    parser.add_argument("--max-wait", type=float, default=MAX_WAIT,
+                        help="seconds a face waits for the faces of other requests to join its batch")
+    parser.add_argument("--scale", type=float, default=1, help="scale of the image searched by the face detector")
+    args = parser.parse_args()
+
+    server = create_server(args.host, args.port, args.unix, args.max_batch, args.max_wait, args.scale)
+    print(f"Serving on {args.unix or '%s:%d' % server.server_address[:2]}", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.batcher.close()
+        server.analyzer.close()
+        server.recognizer.close()
+        if args.unix is not None:
+            os.remove(args.unix)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+import contextlib
+import threading
+import time
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Variables
+# ----------------------------------------------------------------------------------------------------------------------
+__origin = time.perf_counter()  # Time when the module was imported, i.e. when the program started
+__phases = []               # (name, thread, start, duration) of each recorded phase, in seconds since the origin
+__lock = threading.Lock()   # Lock protecting the list of the phases
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Public functions
+# ----------------------------------------------------------------------------------------------------------------------
+@contextlib.contextmanager
+def phase(name):
+    """
+    Function that returns a context manager recording how long a startup phase takes, e.g.
+    `with startup.phase("open camera"): ...`. Phases run in different threads can overlap.
+
+    :param name: name of the phase
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        end = time.perf_counter()
+        with __lock:
+            __phases.append((name, threading.current_thread().name, start - __origin, end - start))
+
+def mark(name):
+    """
+    Function that records an instant of the startup, e.g. when the first frame has been processed.
+
+    :param name: name of the instant
+    """
+    with __lock:
+        __phases.append((name, threading.current_thread().name, time.perf_counter() - __origin, 0.0))
+
+def elapsed():
+    """
+    :return: the seconds passed since the program started
+    """
+    return time.perf_counter() - __origin
+
+def report():
+    """
+    Function that summarizes the recorded phases.
+
+    :return: a JSON serializable list with the name, the thread, the start and the duration in milliseconds of each
+             phase, sorted by start
+    """
+    with __lock:
+        phases = sorted(__phases, key=lambda item: item[2])
+    return [{"phase": name, "thread": thread, "start_ms": 1000 * start, "duration_ms": 1000 * duration}
+            for name, thread, start, duration in phases]
+
+def format_report():
+    """
+    Function that formats the startup report as a readable table.
+
+    :return: the table, as a string
+    """
+    lines = [f"{'phase':<28}{'thread':<16}{'start ms':>10}{'duration ms':>14}"]
+    lines += [f"{item['phase']:<28}{item['thread'][:15]:<16}{item['start_ms']:>10.1f}{item['duration_ms']:>14.1f}"
+              for item in report()]
+    return "\n".join(lines)
@@ -0,0 +1,19 @@
+import os
+import sys
+import numpy as np
+
+# The modules of the project are at the root of the repository, next to this directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+ENCODING_SIZE = 128         # Size of a face encoding
+
+
+def random_encodings(count, seed=0):
+    """
+    Generates synthetic face encodings, the same ones for the same seed.
+
+    :param count: number of encodings.
+    :param seed: seed of the random generator.
+    :return: a (count x ENCODING_SIZE) float32 matrix.
+    """
+    return np.random.default_rng(seed).normal(0, 0.1, (count, ENCODING_SIZE)).astype(np.float32)
@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+from AnnIndex import AnnIndex, ENCODING_SIZE
+from FaceGallery import FaceGallery
+
+N_USERS = 2000              # Number of synthetic registered users
+N_PROBES = 100              # Number of probes, all of them new encodings of registered users
+
+
+@pytest.fixture(scope="module")
+def fixtures():
+    random = np.random.default_rng(0)
+    encodings = random.normal(0, 0.1, (N_USERS, ENCODING_SIZE)).astype(np.float32)
+    known = random.choice(N_USERS, N_PROBES, replace=False)
+    probes = (encodings[known] + random.normal(0, 0.03, (N_PROBES, ENCODING_SIZE))).astype(np.float32)
+    index = AnnIndex(int(4 * np.sqrt(N_USERS)))
+    index.train(encodings)
+    return encodings, probes, known, index
+
+
+def test_untrained_index():
+    index = AnnIndex(4)
+
+    assert not index.is_trained
+    assert len(index.search(np.zeros((2, ENCODING_SIZE)))) == 2
+    with pytest.raises(RuntimeError):
+        index.add(np.zeros(ENCODING_SIZE), 0)
+    with pytest.raises(ValueError):
+        index.train(np.zeros((2, ENCODING_SIZE)))
+
+
+def test_recall_of_the_gallery(fixtures):
+    encodings, probes, known, index = fixtures
+    gallery = FaceGallery(encodings, range(N_USERS), capacity=N_USERS)
+    exact = [gallery.nearest(probe)[0] for probe in probes]
+    gallery.set_index(index)
+
+    assert len(index) == N_USERS
+    approximate = [gallery.nearest(probe)[0] for probe in probes]
+    assert np.mean(np.array(approximate) == np.array(exact)) >= 0.95
+    assert np.mean(np.array(exact) == known) == 1.0
+
+
+def test_candidates_are_gallery_indices(fixtures):
+    _, probes, known, index = fixtures
+    candidates = index.search(probes, shortlist=32)
+
+    assert all(len(members) <= 32 for members in candidates)
+    assert np.mean([user in members for user, members in zip(known, candidates)]) >= 0.9
+
+
+def test_save_and_load(fixtures, tmp_path):
+    _, probes, _, index = fixtures
+    path = str(tmp_path / "registered_user.index.npz")
+    index.save(path, store_id=42)
+    loaded = AnnIndex.load(path)
+
+    assert (len(loaded), loaded.store_id, loaded.n_probe) == (len(index), 42, index.n_probe)
+    for expected, candidates in zip(index.search(probes), loaded.search(probes)):
+        np.testing.assert_array_equal(np.sort(expected), np.sort(candidates))
+    assert [file.name for file in tmp_path.iterdir()] == ["registered_user.index.npz"]
+
+
+def test_load_without_store_id(fixtures, tmp_path):
+    _, _, _, index = fixtures
+    path = str(tmp_path / "index.npz")
+    index.save(path)
+
+    assert AnnIndex.load(path).store_id is None
@@ -0,0 +1,106 @@
+import threading
+import numpy as np
+import pytest
+import EnrollmentQueue as enrollment
+from EnrollmentQueue import EnrollmentQueue, MIN_SAMPLES, MAX_SAMPLES
+from conftest import ENCODING_SIZE, random_encodings
+
+
+def person(seed):
+    return random_encodings(1, seed)[0]
+
+
+def sample(encoding, seed):
+    return encoding + np.random.default_rng(seed).normal(0, 0.005, ENCODING_SIZE).astype(np.float32)
+
+
+class Registry:
+    """
+    Commit function that records the registered faces.
+    """
+    def __init__(self, failures=0):
+        self.batches = []
+        self.failures = failures
+        self.committed = threading.Event()
+
+    def __call__(self, encodings, names):
+        if self.failures > 0:
+            self.failures -= 1
+            raise OSError("store not writable")
+        self.batches.append((encodings, names))
+        self.committed.set()
+        return [100 + i for i in range(len(names))]
+
+
+def test_same_person_is_one_pending_face():
+    announced = []
+    queue = EnrollmentQueue(Registry(), on_pending=announced.append)
+    alice = person(1)
+    ids = {queue.offer(sample(alice, seed)) for seed in range(MIN_SAMPLES + 2)}
+    bob_id = queue.offer(person(2))
+
+    assert len(ids) == 1
+    assert bob_id not in ids
+    assert announced == list(ids)
+    pending = queue.pending()
+    assert [entry["id"] for entry in pending] == [ids.pop(), bob_id]
+    assert (pending[0]["samples"], pending[0]["ready"]) == (min(MIN_SAMPLES + 2, MAX_SAMPLES), True)
+    assert (pending[1]["samples"], pending[1]["ready"]) == (1, False)
+
+
+def test_named_faces_are_committed_together():
+    registry = Registry()
+    queue = EnrollmentQueue(registry)
+    alice, bob = person(1), person(2)
+    for seed in range(MIN_SAMPLES):
+        alice_id = queue.offer(sample(alice, seed))
+        bob_id = queue.offer(sample(bob, seed))
+
+    assert queue.name("Alice") == alice_id     # The oldest face ready
+    queue.name("Bob", bob_id)
+    assert queue.commit() == {alice_id: 100, bob_id: 101}
+
+    assert len(registry.batches) == 1
+    encodings, names = registry.batches[0]
+    assert names == ["Alice", "Bob"]
+    np.testing.assert_allclose(encodings[0], np.mean([sample(alice, seed) for seed in range(MIN_SAMPLES)], axis=0),
+                               rtol=1e-5, atol=1e-6)
+    assert queue.pending() == []
+    queue.close()
+
+
+def test_name_needs_a_waiting_face():
+    queue = EnrollmentQueue(Registry())
+    with pytest.raises(KeyError):
+        queue.name("Nobody")
+    face_id = queue.offer(person(1))
+    with pytest.raises(KeyError):
+        queue.name("Too early")     # Not enough samples yet
+    queue.discard(face_id)
+    with pytest.raises(KeyError):
+        queue.name("Gone", face_id)
+
+
+def test_failed_commit_keeps_the_faces():
+    registry = Registry(failures=1)
+    queue = EnrollmentQueue(registry)
+    face_id = queue.offer(person(1))
+    queue.name("Alice", face_id)
+
+    with pytest.raises(OSError):
+        queue.commit()
+    assert queue.pending()[0]["name"] == "Alice"
+    assert queue.commit() == {face_id: 100}
+
+
+def test_scheduled_commit_is_retried(monkeypatch):
+    monkeypatch.setattr(enrollment, "COMMIT_DELAY", 0.01)
+    monkeypatch.setattr(enrollment, "RETRY_DELAY", 0.01)
+    registry = Registry(failures=2)
+    queue = EnrollmentQueue(registry)
+    face_id = queue.offer(person(1))
+    queue.name("Alice", face_id)
+
+    assert registry.committed.wait(5)
+    assert registry.batches[0][1] == ["Alice"]
+    assert queue.pending() == []
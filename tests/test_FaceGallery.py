@@ -0,0 +1,88 @@
+import numpy as np
+import pytest
+from conftest import random_encodings
+from FaceGallery import FaceGallery, ENCODING_SIZE
+
+
+def test_nearest_matches_brute_force():
+    encodings = random_encodings(200)
+    gallery = FaceGallery(encodings, [f"user {i}" for i in range(200)], capacity=4)
+    probes = random_encodings(20, seed=1)
+
+    indices, distances = gallery.top_k(probes, 5)
+    expected = np.linalg.norm(probes[:, np.newaxis] - encodings[np.newaxis], axis=2)
+    assert len(gallery) == 200
+    np.testing.assert_array_equal(indices, np.argsort(expected, axis=1)[:, :5])
+    np.testing.assert_allclose(distances, np.sort(expected, axis=1)[:, :5], rtol=1e-4, atol=1e-5)
+    assert gallery.nearest(probes[0]) == (int(indices[0, 0]), pytest.approx(float(distances[0, 0])))
+
+
+def test_match_within_tolerance():
+    encodings = random_encodings(3)
+    gallery = FaceGallery(encodings, ["a", "b", "c"])
+    far = np.full(ENCODING_SIZE, 10, dtype=np.float32)
+
+    assert gallery.match(encodings[1] + 0.001) == "b"
+    assert gallery.match_batch(np.stack([encodings[2], far])) == ["c", ""]
+
+
+def test_empty_gallery():
+    gallery = FaceGallery()
+
+    assert len(gallery) == 0
+    assert gallery.nearest(random_encodings(1)[0]) == (-1, float("inf"))
+    assert gallery.match_batch(random_encodings(2)) == ["", ""]
+
+
+def test_add_grows_the_matrix():
+    encodings = random_encodings(10)
+    gallery = FaceGallery(capacity=1)
+    for i, encoding in enumerate(encodings):
+        assert gallery.add(encoding, str(i)) == i
+
+    np.testing.assert_array_equal(gallery.encodings, encodings)
+    assert gallery.names == [str(i) for i in range(10)]
+    assert not gallery.encodings.flags.writeable
+
+
+def test_extend_checks_the_names():
+    with pytest.raises(ValueError):
+        FaceGallery().extend(random_encodings(2), ["only one"])
+
+
+def test_retired_faces_never_match():
+    encodings = random_encodings(3)
+    gallery = FaceGallery(encodings, ["a", "b", "c"])
+    gallery.retire([1])
+
+    assert gallery.match(encodings[1]) == ""
+    assert gallery.nearest(encodings[1])[0] != 1
+    assert len(gallery) == 3
+
+
+def test_wrap_does_not_copy_until_a_face_is_added():
+    encodings = random_encodings(4)
+    gallery = FaceGallery.wrap(encodings, ["a", "b", "c", "d"])
+    assert np.shares_memory(gallery.encodings, encodings)
+    assert gallery.match(encodings[3]) == "d"
+
+    original = encodings.copy()
+    gallery.add(random_encodings(1, seed=1)[0], "e")
+    np.testing.assert_array_equal(encodings, original)
+    assert len(gallery) == 5
+    assert gallery.match(encodings[0]) == "a"
+
+
+def test_wrap_rejects_other_types():
+    with pytest.raises(ValueError):
+        FaceGallery.wrap(random_encodings(2).astype(np.float64), ["a", "b"])
+
+
+def test_wrapped_empty_gallery_grows():
+    gallery = FaceGallery.wrap(np.empty((0, ENCODING_SIZE), dtype=np.float32), [])
+    encodings = random_encodings(3)
+    gallery.add(encodings[0], "a")
+    gallery.extend(encodings[1:], ["b", "c"])
+
+    assert len(gallery) == 3
+    assert gallery.match_batch(encodings) == ["a", "b", "c"]
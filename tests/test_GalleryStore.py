@@ -0,0 +1,149 @@
+import json
+import os
+import numpy as np
+import pytest
+from conftest import random_encodings
+from GalleryStore import GalleryStore, ENCODING_SIZE, HEADER_SIZE, ROW_SIZE
+
+
+@pytest.fixture
+def store(tmp_path):
+    return GalleryStore(str(tmp_path / "registered_user"))
+
+
+def test_missing_store_reads_nothing(store):
+    encodings, ids, names, count, offset = store.read()
+
+    assert not store.exists()
+    assert encodings.shape == (0, ENCODING_SIZE)
+    assert (ids, names, count, offset) == ([], [], 0, 0)
+    assert store.size() == 0
+    assert store.identity() is None
+
+
+def test_extend_and_read(store):
+    encodings = random_encodings(3)
+    assert store.extend(encodings, ["a", "b", "c"]) == [0, 1, 2]
+    assert store.append(encodings[0], "d") == 3
+
+    read_encodings, ids, names, count, offset = store.read()
+    np.testing.assert_array_equal(read_encodings, np.concatenate([encodings, encodings[:1]]))
+    assert ids == [0, 1, 2, 3]
+    assert names == ["a", "b", "c", "d"]
+    assert (count, offset) == (4, store.size())
+
+
+def test_read_follows_the_appended_records(store):
+    store.extend(random_encodings(2), ["a", "b"])
+    _, _, _, count, offset = store.read()
+    encodings = random_encodings(1, seed=1)
+    store.extend(encodings, ["c"])
+
+    new_encodings, ids, names, count, offset = store.read(count, offset)
+    np.testing.assert_array_equal(new_encodings, encodings)
+    assert (ids, names, count) == ([2], ["c"], 3)
+    assert store.read(count, offset)[1] == []
+
+
+def test_extend_changes_an_existing_user(store):
+    store.extend(random_encodings(2), ["a", "b"])
+    assert store.extend(random_encodings(1, seed=1), ["a again"], user_ids=[0]) == [0]
+
+    _, ids, names, _, _ = store.read()
+    assert ids == [0, 1, 0]
+    assert names == ["a", "b", "a again"]
+
+
+def test_extend_checks_the_lengths(store):
+    with pytest.raises(ValueError):
+        store.extend(random_encodings(2), ["a"])
+
+
+def test_torn_tail_is_ignored_and_repaired(store):
+    store.extend(random_encodings(2), ["a", "b"])
+    # Crash after writing an encoding and part of another, and part of a log line
+    with open(store.encodings_path, "ab") as file:
+        file.write(random_encodings(1, seed=1).tobytes() + b"\x00" * 10)
+    with open(store.names_path, "ab") as file:
+        file.write(b'{"Id": 2, "na')
+
+    assert store.read()[1] == [0, 1]
+    assert store.extend(random_encodings(1, seed=2), ["c"]) == [2]
+    encodings, ids, names, _, _ = store.read()
+    assert (ids, names) == ([0, 1, 2], ["a", "b", "c"])
+    np.testing.assert_array_equal(encodings[2], random_encodings(1, seed=2)[0])
+    assert os.path.getsize(store.encodings_path) == HEADER_SIZE + 3 * ROW_SIZE
+
+
+def test_log_line_without_encoding_is_dropped(store):
+    store.extend(random_encodings(1), ["a"])
+    with open(store.names_path, "ab") as file:
+        file.write(b'{"Id": 1, "name": "b"}\n')
+
+    assert store.read()[2] == ["a"]
+    assert store.extend(random_encodings(1, seed=1), ["c"]) == [1]
+    assert store.read()[2] == ["a", "c"]
+
+
+def test_migrate_json(store, tmp_path):
+    encodings = random_encodings(2)
+    json_path = tmp_path / "registered_user.json"
+    json_path.write_text(json.dumps([{"name": "a", "encoding": encodings[0].tolist()},
+                                     {"name": "b", "encoding": encodings[1].tolist()}]))
+
+    assert store.migrate_json(str(json_path)) == 2
+    read_encodings, ids, names, _, _ = store.read()
+    np.testing.assert_allclose(read_encodings, encodings)
+    assert (ids, names) == ([0, 1], ["a", "b"])
+    assert not any(name.endswith(".tmp") for name in os.listdir(tmp_path))
+
+
+def test_identity_changes_only_when_replaced(store, tmp_path):
+    store.extend(random_encodings(1), ["a"])
+    identity = store.identity()
+    store.extend(random_encodings(1, seed=1), ["b"])
+    assert store.identity() == identity
+    assert store.store_id() == identity[0] != 0
+
+    json_path = tmp_path / "registered_user.json"
+    json_path.write_text(json.dumps([{"name": "c", "encoding": random_encodings(1)[0].tolist()}]))
+    store.migrate_json(str(json_path))
+    assert store.identity() != identity
+
+
+def test_rejects_other_files(store):
+    store.extend(random_encodings(1), ["a"])
+    with open(store.encodings_path, "r+b") as file:
+        file.write(b"NOTAGAL!")
+
+    with pytest.raises(ValueError):
+        store.read()
+
+
+def test_extend_checks_only_the_new_records(store, monkeypatch):
+    store.extend(random_encodings(3), ["a", "b", "c"])
+    size = store.size()
+    offsets = []
+    read_names = store._GalleryStore__read_names
+    monkeypatch.setattr(store, "_GalleryStore__read_names", lambda offset=0: offsets.append(offset) or
+                        read_names(offset))
+
+    store.extend(random_encodings(1, seed=1), ["d"])
+    assert offsets == [size]
+    assert store.read()[2] == ["a", "b", "c", "d"]
+
+
+def test_extend_after_another_writer_and_a_replacement(store, tmp_path):
+    store.extend(random_encodings(1), ["a"])
+    other = GalleryStore(str(tmp_path / "registered_user"))
+    other.extend(random_encodings(1, seed=1), ["b"])
+    with open(store.names_path, "ab") as file:
+        file.write(b'{"Id": 2, "na')
+    assert store.extend(random_encodings(1, seed=2), ["c"]) == [2]
+    assert store.read()[2] == ["a", "b", "c"]
+
+    json_path = tmp_path / "registered_user.json"
+    json_path.write_text(json.dumps([{"name": "d", "encoding": random_encodings(1)[0].tolist()}]))
+    store.migrate_json(str(json_path))
+    assert store.extend(random_encodings(1, seed=3), ["e"]) == [1]
+    assert store.read()[2] == ["d", "e"]
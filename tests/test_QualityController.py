@@ -0,0 +1,82 @@
+from types import SimpleNamespace
+import pytest
+import profiler
+import QualityController as quality
+from QualityController import QualityController, RECOVERY_WINDOWS
+
+
+@pytest.fixture
+def components(monkeypatch):
+    monkeypatch.setattr(quality, "ADJUST_INTERVAL", 0)  # Every update() measures the frames recorded since the last
+    profiler.reset()
+    yield (SimpleNamespace(detection_interval=2, detection_scale=1.0), SimpleNamespace(eye_filtering=True),
+           SimpleNamespace(recheck_interval=2.0))
+    profiler.reset()
+    profiler.enable(False)
+
+
+def record_frames(frame_cost, stage_costs, count=10):
+    for _ in range(count):
+        profiler.record(quality.FRAME_SPAN, frame_cost)
+        for stage, cost in stage_costs.items():
+            profiler.record(stage, cost)
+
+
+def test_lowers_the_most_expensive_stage(components):
+    tracker, analyzer, recognition = components
+    controller = QualityController(tracker, analyzer, recognition, target_fps=50)
+
+    record_frames(0.04, {"detection": 0.005, "gaze": 0.03, "encoding": 0.001})
+    assert controller.update() == ("eye_filtering", False)
+    assert analyzer.eye_filtering is False
+
+    record_frames(0.04, {"detection": 0.03, "gaze": 0.005, "encoding": 0.001})
+    assert controller.update() == ("detection_interval", 3)
+    assert tracker.detection_interval == 3
+
+    decisions = controller.decisions()
+    assert decisions["budget_ms"] == pytest.approx(20)
+    assert decisions["lowered"] == ["eye_filtering", "detection_interval"]
+    assert [change["setting"] for change in decisions["changes"]] == ["eye_filtering", "detection_interval"]
+    assert decisions["stage_ms"]["detection"] == pytest.approx(30)
+
+
+def test_raises_back_in_reverse_order(components):
+    tracker, analyzer, recognition = components
+    controller = QualityController(tracker, analyzer, recognition, latency_budget=0.02)
+    record_frames(0.04, {"gaze": 0.03})
+    controller.update()
+    record_frames(0.04, {"encoding": 0.03})
+    controller.update()
+    assert recognition.recheck_interval == 4.0
+
+    changes = []
+    for _ in range(2 * RECOVERY_WINDOWS):
+        record_frames(0.001, {})
+        changes.append(controller.update())
+
+    assert [change for change in changes if change is not None] == [("recheck_interval", 2.0),
+                                                                     ("eye_filtering", True)]
+    assert controller.settings == {"detection_interval": 2, "detection_scale": 1.0, "eye_filtering": True,
+                                   "recheck_interval": 2.0}
+    assert controller.decisions()["target_fps"] is None
+
+
+def test_nothing_to_measure(components):
+    controller = QualityController(*components)
+
+    assert controller.update() is None
+    assert controller.decisions()["changes"] == []
+
+
+def test_only_measured_stages_are_lowered(components):
+    tracker, analyzer, recognition = components
+    controller = QualityController(tracker, analyzer, recognition, target_fps=50)
+
+    record_frames(0.04, {"decoding": 0.035})     # The cost is in a stage that no setting reduces
+    assert controller.update() is None
+    assert controller.decisions()["lowered"] == []
+
+    record_frames(0.04, {"decoding": 0.03, "encoding": 0.005})
+    assert controller.update() == ("recheck_interval", 4.0)
+    assert recognition.recheck_interval == 4.0
@@ -0,0 +1,91 @@
+import threading
+import time
+import pytest
+from RequestBatcher import RequestBatcher
+
+
+def test_results_in_order():
+    batcher = RequestBatcher(lambda requests: [2 * request for request in requests])
+    try:
+        assert batcher.process([1, 2, 3]) == [2, 4, 6]
+        assert batcher.submit(5).result(timeout=1) == 10
+    finally:
+        batcher.close()
+
+
+def test_concurrent_requests_share_batches():
+    sizes = []
+
+    def process(requests):
+        sizes.append(len(requests))
+        time.sleep(0.01)
+        return requests
+
+    batcher = RequestBatcher(process, max_batch=8, max_wait=0.05)
+    results = {}
+    barrier = threading.Barrier(16)
+
+    def client(i):
+        barrier.wait()
+        results[i] = batcher.submit(i).result(timeout=5)
+
+    threads = [threading.Thread(target=client, args=(i, )) for i in range(16)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    batcher.close()
+
+    assert results == {i: i for i in range(16)}
+    assert sum(sizes) == 16
+    assert max(sizes) <= 8
+    assert batcher.batches == len(sizes) < 16
+    assert batcher.mean_batch_size == pytest.approx(16 / len(sizes))
+
+
+def test_errors_reach_only_the_bad_request():
+    calls = []
+
+    def process(requests):
+        calls.append(list(requests))
+        if "bad" in requests:
+            raise ValueError("malformed image")
+        return [request.upper() for request in requests]
+
+    batcher = RequestBatcher(process, max_wait=0.05)
+    futures = [batcher.submit(request) for request in ["a", "bad", "c"]]
+    assert futures[0].result(timeout=1) == "A"
+    with pytest.raises(ValueError, match="malformed image"):
+        futures[1].result(timeout=1)
+    assert futures[2].result(timeout=1) == "C"
+    batcher.close()
+
+    assert calls == [["a", "bad", "c"], ["a"], ["bad"], ["c"]]
+
+
+def test_errors_of_every_request():
+    def process(requests):
+        raise RuntimeError("encoder failed")
+
+    batcher = RequestBatcher(process, max_wait=0.05)
+    futures = [batcher.submit(i) for i in range(3)]
+    for future in futures:
+        with pytest.raises(RuntimeError, match="encoder failed"):
+            future.result(timeout=1)
+    batcher.close()
+
+
+def test_close_processes_the_pending_requests():
+    release = threading.Event()
+
+    def process(requests):
+        release.wait(1)
+        return requests
+
+    batcher = RequestBatcher(process, max_batch=1, max_wait=0)
+    futures = [batcher.submit(i) for i in range(3)]
+    release.set()
+    batcher.close()
+
+    assert [future.result(timeout=0) for future in futures] == [0, 1, 2]
+    assert batcher.batches == 3
@@ -0,0 +1,15 @@
+import pytest
+
+pytest.importorskip("dlib")     # logic loads its models through dlib
+
+import benchmark
+import logic
+from FrameContext import FrameContext
+
+
+@pytest.mark.parametrize("filtering", [True, False])
+def test_batched_gaze_matches_the_reference(filtering):
+    for frame, eyes in benchmark.make_eye_fixtures():
+        context = FrameContext(frame)
+        expected = [logic.is_looking_at_cam(context, eye, filtering) for eye in eyes]
+        assert logic.are_looking_at_cam(context, eyes, filtering) == expected